@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import random
+import string
+import argparse
+import resource
+import multiprocessing
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import psycopg2
+import create_tables
+import etl
+from etl_async import process_data_async, song_writes, log_writes
+from etl_metrics import CountingCursor
+from song_index import SongIndex
+
+
+FIRST_NAMES = ['Kate', 'Walter', 'Kaylee', 'Jacob', 'Lily', 'Sylvie', 'Tegan', 'Sara', 'Ryan', 'Jayden']
+LAST_NAMES = ['Harrell', 'Frye', 'Summers', 'Klein', 'Koch', 'Cruz', 'Levine', 'Johnson', 'Smith', 'Lynch']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Lansing-East Lansing, MI',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/36.0.1985.143 Safari/537.36"']
+OTHER_PAGES = ['Home', 'Logout', 'Settings', 'About', 'Help']
+
+
+def random_id(prefix, length=16):
+    """Return an id in the style of the Million Song Dataset."""
+    return prefix + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(data_dir, num_songs, num_artists):
+    """Write one JSON song file per song in the layout of data/song_data.
+
+    Parameters:
+    data_dir (string): root of the generated data tree
+    num_songs (int): number of song files
+    num_artists (int): number of distinct artists
+
+    Returns: list of (title, artist name, duration) of the generated songs
+
+    """
+    artists = [{'artist_id': random_id('AR'),
+                'artist_name': 'Artist {}'.format(i),
+                'artist_location': random.choice(LOCATIONS + ['']),
+                'artist_latitude': random.choice([None, round(random.uniform(-90, 90), 5)]),
+                'artist_longitude': random.choice([None, round(random.uniform(-180, 180), 5)])}
+               for i in range(num_artists)]
+
+    songs = []
+    for i in range(num_songs):
+        song_id = random_id('TR')
+        record = dict(random.choice(artists), num_songs=1, song_id=random_id('SO'),
+                      title='Song {}'.format(i), duration=round(random.uniform(60, 600), 5),
+                      year=random.choice([0, random.randint(1960, 2018)]))
+        song_dir = os.path.join(data_dir, 'song_data', song_id[2], song_id[3], song_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, song_id + '.json'), 'w') as f:
+            json.dump(record, f)
+        songs.append((record['title'], record['artist_name'], record['duration']))
+
+    return songs
+
+
+def generate_logs(data_dir, songs, num_events, num_users, num_days, dup_rate, match_rate,
+                  start=datetime(2018, 11, 1)):
+    """Write one JSON log file per day in the layout of data/log_data.
+
+    Parameters:
+    data_dir (string): root of the generated data tree
+    songs (list): (title, artist name, duration) of known songs
+    num_events (int): number of log events across all days
+    num_users (int): number of distinct users
+    num_days (int): number of daily log files
+    dup_rate (float): share of NextSong events repeating an earlier event
+    match_rate (float): share of NextSong events playing a known song
+    start (datetime): date of the first log file
+
+    Returns: None
+
+    """
+    users = [{'userId': str(i + 1),
+              'firstName': random.choice(FIRST_NAMES),
+              'lastName': random.choice(LAST_NAMES),
+              'gender': random.choice('MF'),
+              'level': random.choice(['free', 'paid']),
+              'location': random.choice(LOCATIONS),
+              'userAgent': random.choice(USER_AGENTS),
+              'registration': 1540000000000.0 + i}
+             for i in range(num_users)]
+
+    events_per_day = max(1, num_events // num_days)
+    session_id = 0
+    for day in range(num_days):
+        date = start + timedelta(days=day)
+        ts = int(date.timestamp() * 1000)
+        log_dir = os.path.join(data_dir, 'log_data', date.strftime('%Y'), date.strftime('%m'))
+        os.makedirs(log_dir, exist_ok=True)
+
+        previous = []
+        with open(os.path.join(log_dir, date.strftime('%Y-%m-%d-events.json')), 'w') as f:
+            for i in range(events_per_day):
+                if i % 20 == 0:
+                    user = random.choice(users)
+                    session_id += 1
+                    item = 0
+                    # upgrades and downgrades exercise the latest-level rule
+                    if random.random() < 0.1:
+                        user['level'] = 'paid' if user['level'] == 'free' else 'free'
+                ts += random.randint(1, 120000)
+
+                if previous and random.random() < dup_rate:
+                    event = random.choice(previous)
+                elif random.random() < 0.8:
+                    if random.random() < match_rate and songs:
+                        title, artist, duration = random.choice(songs)
+                    else:
+                        title, artist, duration = (random_id('Unknown ', 8), random_id('Unknown ', 8),
+                                                   round(random.uniform(60, 600), 5))
+                    event = dict(user, artist=artist, song=title, length=duration, page='NextSong',
+                                 auth='Logged In', method='PUT', status=200, sessionId=session_id,
+                                 itemInSession=item, ts=ts)
+                    previous.append(event)
+                else:
+                    event = dict(user, artist=None, song=None, length=None, page=random.choice(OTHER_PAGES),
+                                 auth='Logged In', method='GET', status=200, sessionId=session_id,
+                                 itemInSession=item, ts=ts)
+                item += 1
+                f.write(json.dumps(event) + '\n')
+
+
+def count_records(filepaths):
+    """Return number of JSON records in files."""
+    total = 0
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            total += sum(1 for line in f if line.strip())
+    return total
+
+
+def load_stage(conn, cur, data_dir, mode, func, song_index, workers, batch_size):
+    """Load one directory with the loader of a benchmark mode."""
+    loader = partial(func, song_index=song_index)
+    if mode == 'batch':
+        etl.process_data_batch(cur, conn, data_dir, loader)
+    elif mode == 'parallel':
+        etl.process_data_parallel(cur, conn, data_dir, loader, workers, batch_size)
+    elif mode == 'async':
+        name = 'song_write' if func is song_writes else 'log_write'
+        process_data_async(cur, conn, data_dir, loader, name, batch_size=batch_size)
+    else:
+        etl.process_data(cur, conn, data_dir, loader, batch_size=batch_size)
+
+
+def run_stage(data_dir, stage, mode, workers, batch_size, trace_memory):
+    """Load one directory of generated data with one loader mode.
+
+    Called by run_mode in a fresh process for every stage, so the
+    high-water mark of the resident set size belongs to this stage alone.
+
+    Parameters:
+    data_dir (string): root of the generated data tree
+    stage (string): 'song_data' or 'log_data'
+    mode (string): 'row', 'bulk', 'batch', 'parallel' or 'async'
+    workers (int): worker processes of parallel mode
+    batch_size (int): files per transaction
+    trace_memory (boolean): record peak python memory of the stage with
+        tracemalloc, which slows the loader down and misses the worker
+        processes of parallel mode; otherwise report the high-water mark
+        of the resident set size of this process and its workers
+
+    Returns: stage result dictionary
+
+    """
+    conn = psycopg2.connect(etl.DSN, cursor_factory=CountingCursor)
+    cur = conn.cursor()
+    etl.create_staging_tables(cur, conn)
+
+    if mode == 'row':
+        song_func, log_func = etl.process_song_file, etl.process_log_file
+    elif mode == 'batch':
+        song_func, log_func = etl.process_song_batch, etl.process_log_batch
+    elif mode == 'async':
+        song_func, log_func = song_writes, log_writes
+    else:
+        song_func, log_func = etl.process_song_file_bulk, etl.process_log_file_bulk
+
+    # read after the song stage committed, like the parallel loader of etl.py
+    song_index = SongIndex.from_database(cur)
+    func = song_func if stage == 'song_data' else log_func
+    stage_dir = os.path.join(data_dir, stage)
+    files = etl.get_files(stage_dir)
+
+    if trace_memory:
+        tracemalloc.start()
+    CountingCursor.round_trips = 0
+    start = time.perf_counter()
+
+    load_stage(conn, cur, stage_dir, mode, func, song_index, workers, batch_size)
+
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    conn.close()
+
+    rows = count_records(files)
+    return {
+        'mode': mode,
+        'stage': stage,
+        'files': len(files),
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'files_per_sec': round(len(files) / elapsed, 1),
+        'rows_per_sec': round(rows / elapsed, 1),
+        # includes the statements of worker processes and of the asyncpg writer
+        'round_trips': CountingCursor.round_trips,
+        'peak_memory_mb': round(peak / 2 ** 20, 1),
+    }
+
+
+def run_mode(data_dir, mode, workers, batch_size, trace_memory, partitioned=False):
+    """Recreate sparkifydb and load generated data with one loader mode.
+
+    Each stage runs in its own spawned process, the resident set size
+    high-water mark of a process only ever grows.
+
+    Parameters:
+    data_dir (string): root of the generated data tree
+    mode (string): 'row', 'bulk', 'batch', 'parallel' or 'async'
+    workers (int): worker processes of parallel mode
+    batch_size (int): files per transaction
+    trace_memory (boolean): record peak python memory of each stage with
+        tracemalloc instead of the resident set size
+    partitioned (boolean): partition songplays by month of start_time
+
+    Returns: list of stage result dictionaries
+
+    """
+    cur, conn = create_tables.create_database()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn, partitioned)
+    conn.close()
+
+    results = []
+    for stage in ['song_data', 'log_data']:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(run_stage, data_dir, stage, mode, workers, batch_size,
+                                           trace_memory).result())
+    return results
+
+
+def print_results(results):
+    """Print benchmark results as a table."""
+    columns = ['mode', 'stage', 'files', 'rows', 'seconds', 'files_per_sec', 'rows_per_sec',
+               'round_trips', 'peak_memory_mb']
+    print(' '.join('{:>14}'.format(c) for c in columns))
+    for result in results:
+        print(' '.join('{:>14}'.format(str(result[c])) for c in columns))
+
+
+def main():
+    """Generate synthetic Sparkify data and benchmark the loader modes."""
+    parser = argparse.ArgumentParser(description='Benchmark the sparkifydb loader on synthetic data.')
+    parser.add_argument('--data-dir', default='bench_data', help='root of the generated data tree')
+    parser.add_argument('--generate', action='store_true', help='generate a new data tree first')
+    parser.add_argument('--events', type=int, default=10000, help='number of log events')
+    parser.add_argument('--songs', type=int, default=1000, help='number of song files')
+    parser.add_argument('--artists', type=int, default=500, help='number of artists')
+    parser.add_argument('--users', type=int, default=100, help='number of users')
+    parser.add_argument('--days', type=int, default=30, help='number of daily log files')
+    parser.add_argument('--dup-rate', type=float, default=0.01, help='share of duplicated songplays')
+    parser.add_argument('--match-rate', type=float, default=0.1, help='share of songplays of known songs')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the generator')
+    parser.add_argument('--modes', nargs='+', default=['row', 'bulk', 'batch', 'parallel', 'async'],
+                        choices=['row', 'bulk', 'batch', 'parallel', 'async'], help='loader modes to benchmark')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes of parallel mode')
+    parser.add_argument('--batch-size', type=int, default=50, help='files per transaction')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak memory of each stage with tracemalloc (slow)')
+    parser.add_argument('--partitioned', action='store_true', help='partition songplays by month')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    if args.generate:
+        random.seed(args.seed)
+        songs = generate_songs(args.data_dir, args.songs, args.artists)
+        generate_logs(args.data_dir, songs, args.events, args.users, args.days, args.dup_rate, args.match_rate)
+
+    results = []
+    for mode in args.modes:
+        results.extend(run_mode(args.data_dir, mode, args.workers, args.batch_size, args.trace_memory,
+                                args.partitioned))
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
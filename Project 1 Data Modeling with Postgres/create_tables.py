@@ -1,5 +1,10 @@
+import argparse
+from functools import partial
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import etl
+from song_index import SongIndex
+from sql_queries import (create_table_queries, drop_table_queries, bulk_create_table_queries,
+                         bulk_load_tables, constraint_queries, partitioned_create_table_queries)
 
 
 def create_database():
@@ -39,19 +44,77 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
-    """Run create table queries."""
-    for query in create_table_queries:
+def create_tables(cur, conn, partitioned=False):
+    """Run create table queries, with songplays partitioned by month of start_time if partitioned."""
+    for query in partitioned_create_table_queries if partitioned else create_table_queries:
         cur.execute(query)
         conn.commit()
 
 
+def bulk_load(cur, conn, song_path='data/song_data', log_path='data/log_data'):
+    """Create unlogged tables without keys, load all data files and finalize them.
+
+    Each directory is read and deduplicated in memory as one batch and
+    copied straight into its tables, so no index is maintained and no
+    foreign key is checked row by row during the load.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    conn (connection object): database connection
+    song_path (string): directory of song files
+    log_path (string): directory of log files
+
+    Returns: None
+
+    """
+    for query in bulk_create_table_queries:
+        cur.execute(query)
+    conn.commit()
+    etl.create_staging_tables(cur, conn)
+
+    song_index = SongIndex()
+    etl.process_data_batch(cur, conn, song_path,
+                           partial(etl.process_song_batch, song_index=song_index, load=etl.copy_song_data))
+    etl.process_data_batch(cur, conn, log_path,
+                           partial(etl.process_log_batch, song_index=song_index, load=etl.copy_log_data))
+
+    finalize_tables(cur, conn)
+    etl.backfill_rollups(cur, conn)
+
+
+def finalize_tables(cur, conn):
+    """Add keys and foreign keys to bulk loaded tables, analyze them and make them logged."""
+    for query in constraint_queries:
+        cur.execute(query)
+    conn.commit()
+
+    # ANALYZE and SET LOGGED each run in their own transaction
+    conn.set_session(autocommit=True)
+    for table in bulk_load_tables:
+        cur.execute("ANALYZE {}".format(table))
+    for table in bulk_load_tables:
+        cur.execute("ALTER TABLE {} SET LOGGED".format(table))
+    conn.set_session(autocommit=False)
+
+
 def main():
     """Create database and tables."""
+    parser = argparse.ArgumentParser(description='Create sparkifydb and its tables.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--bulk-load', action='store_true',
+                      help='create unlogged tables without keys, load all data files, then add '
+                           'keys, analyze and make the tables logged')
+    mode.add_argument('--partitioned', action='store_true',
+                      help='partition songplays by month of start_time, partitions are created by the loader')
+    args = parser.parse_args()
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if args.bulk_load:
+        bulk_load(cur, conn)
+    else:
+        create_tables(cur, conn, args.partitioned)
 
     conn.close()
 
@@ -1,139 +1,804 @@
 import os
+import io
 import glob
+import uuid
+import time
+import random
+import argparse
+import multiprocessing
 import psycopg2
+from psycopg2.extensions import TransactionRollbackError
 import pandas as pd
+from functools import partial
 from sql_queries import *
+from song_index import SongIndex
+import json_reader
+from json_reader import read_json_batch
+from input_cache import InputCache
+import etl_metrics
+from etl_metrics import stage, CountingCursor
 
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur, filepath):
+# connection and loader function of each parallel worker process
+_worker = {}
+
+# namespace of songplay ids, equal to uuid_nil() in uuid-ossp
+SONGPLAY_NAMESPACE = uuid.UUID(int=0)
+
+# fields of song and log records, the columns of a batch that has no records
+SONG_COLUMNS = ['artist_id', 'artist_latitude', 'artist_location', 'artist_longitude', 'artist_name', 'duration',
+                'num_songs', 'song_id', 'title', 'year']
+LOG_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+               'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+
+
+def extract_song_data(df):
+    """Return song and artist records from a song dataframe.
+
+    Parameters:
+    df (dataframe): raw song data
+
+    Returns:
+    song_df (dataframe): unique rows for the songs table
+    artist_df (dataframe): unique rows for the artists table
+
+    """
+    if df.empty:
+        df = pd.DataFrame(columns=SONG_COLUMNS)
+
+    song_df = df.loc[(df['song_id'].notnull() & df['title'].notnull()
+                      & df['artist_id'].notnull() & df['year'].notnull()),
+                     ['song_id', 'title', 'artist_id', 'year', 'duration']]
+
+    artist_df = df.loc[(df['artist_id'].notnull() & df['artist_name'].notnull()),
+                       ['artist_id', 'artist_name', 'artist_location', 'artist_latitude',
+                        'artist_longitude']]
+    artist_df.columns = ['artist_id', 'name', 'location', 'lattitude', 'longitude']
+
+    # keep the first record of each song and artist
+    song_df = song_df.drop_duplicates('song_id')
+    artist_df = artist_df.drop_duplicates('artist_id')
+
+    return song_df, artist_df
+
+
+def songplay_ids(song, ts, user_id):
+    """Return deterministic songplay uuids for columns of song, ts and userId.
+
+    Each id is the version 5 uuid of str(song) + str(ts) + str(userId) in the
+    nil namespace, byte-identical to uuid_generate_v5(uuid_nil(), name) in
+    postgresql, so rows loaded before keep deduplicating on songplay_id.
+
+    Parameters:
+    song (series): song titles
+    ts (series): event timestamps as datetime
+    user_id (series): user ids
+
+    Returns: list of uuid strings
+
+    """
+    names = song.map(str) + ts.map(str) + user_id.map(str)
+    return [str(uuid.uuid5(SONGPLAY_NAMESPACE, name)) for name in names]
+
+
+def select_songplays(df):
+    """Return NextSong actions from a log dataframe with ts as datetime and userId as nullable integer."""
+    if df.empty:
+        df = pd.DataFrame(columns=LOG_COLUMNS)
+
+    # filter by NextSong action
+    df = df.loc[df.page=='NextSong'].copy()
+
+    # convert timestamp column to datetime
+    df['ts'] = pd.to_datetime(df['ts'], unit='ms')
+
+    # user ids are logged as strings, which are only empty for logged out users; Int64 keeps
+    # the others integers next to missing ids, so songplay names still contain e.g. '39'
+    df['userId'] = pd.to_numeric(df['userId'], errors='coerce').astype('Int64')
+
+    return df
+
+
+def extract_log_data(df, song_index):
+    """Return time, user and songplay records from NextSong log events.
+
+    Parameters:
+    df (dataframe): log data filtered by select_songplays
+    song_index (SongIndex): lookup of song and artist ids
+
+    Returns:
+    time_df (dataframe): unique rows for the time table
+    user_df (dataframe): one row per user with the level of the latest event
+    songplay_df (dataframe): unique songplay rows keyed by song, ts and userId
+
+    """
+    t = df['ts']
+
+    # non-null time data records
+    time_data = list((t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday))
+    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
+    time_df = pd.DataFrame.from_dict(dict(zip(column_labels,time_data)))
+    time_df = time_df.loc[time_df['start_time'].notnull()].drop_duplicates('start_time')
+
+    # filter out rows with no user id, gender, level or timestamp
+    user_df = df.loc[(df['userId'].notnull() & df['gender'].notnull()
+                      & df['level'].notnull() & df['ts'].notnull()),
+                     ['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']]
+    user_df.columns = ['user_id', 'first_name', 'last_name', 'gender', 'level', 'last_start_time']
+
+    # last ts wins: keep the level of each user's latest event
+    user_df = (user_df.sort_values('last_start_time', kind='mergesort')
+               .drop_duplicates('user_id', keep='last'))
+
+    # get songid and artistid for all events with one merge
+    with stage('log_lookup', len(df)) as counts:
+        song_ids = song_index.resolve(df['song'], df['artist'], df['length'])
+        counts['rows_out'] = int(song_ids['song_id'].notnull().sum())
+
+    # create songplay uuids
+    songplay_df = pd.DataFrame({
+        'songplay_id': songplay_ids(df['song'], df['ts'], df['userId']),
+        'start_time': df['ts'],
+        'user_id': df['userId'],
+        'level': df['level'],
+        'song_id': song_ids['song_id'],
+        'artist_id': song_ids['artist_id'],
+        'session_id': df['sessionId'],
+        'location': df['location'],
+        'user_agent': df['userAgent'],
+    }, index=df.index, columns=['songplay_id', 'start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                'session_id', 'location', 'user_agent'])
+    songplay_df = (songplay_df.loc[songplay_df['start_time'].notnull() & songplay_df['user_id'].notnull()]
+                   .drop_duplicates('songplay_id'))
+
+    return time_df, user_df, songplay_df
+
+
+def process_song_file(cur, filepath, song_index=None):
     """Insert record from JSON song file into postgresql tables.
-    
-    Read JSON file to pandas dataframe, clean and process data, 
+
+    Read JSON file to pandas dataframe, clean and process data,
     then load to song and artist tables.
-    
+
     Parameters:
     cur (cursor object): connection cursor
-    filepath (string): filepath
-    
+    filepath (string or list): filepath, or list of filepaths read as one batch
+    song_index (SongIndex): optional song lookup to extend with the new song
+
     Returns: None
-    
+
     """
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    song_df, artist_df = parse_song_batch(filepath, song_index)
 
-    # insert song record
-    song_data = df.loc[(df['song_id'].notnull() & df['title'].notnull() 
-                        & df['artist_id'].notnull() & df['year'].notnull()), 
-                       ['song_id', 'title', 'artist_id', 'year', 'duration']].values[0].tolist()
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    artist_data = df.loc[(df['artist_id'].notnull() & df['artist_name'].notnull()), 
-                         ['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 
-                          'artist_longitude']].values[0].tolist()
-    cur.execute(artist_table_insert, artist_data)
+    # insert song and artist records
+    with stage('song_write', len(song_df) + len(artist_df)) as counts:
+        counts['rows_out'] = (insert_rows(cur, song_table_insert, song_df)
+                              + insert_rows(cur, artist_table_insert, artist_df))
 
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, song_index=None):
     """Insert records from JSON log files into PostgreSQL tables.
-    
-    Read JSON file to pandas dataframe, clean and process data, 
+
+    Read JSON file to pandas dataframe, clean and process data,
     then load to user and songplay tables.
-    
+
     Parameters:
     cur (cursor object): connection cursor
-    filepath (string): filepath
-    
+    filepath (string or list): filepath, or list of filepaths read as one batch
+    song_index (SongIndex): song lookup, read from the database if omitted
+
     Returns: None
-    
+
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True) 
+    if song_index is None:
+        song_index = SongIndex.from_database(cur)
 
-    # filter by NextSong action
-    df = df.loc[df.page=='NextSong']
+    time_df, user_df, songplay_df = parse_log_batch(filepath, song_index)
 
-    # convert timestamp column to datetime
-    df['ts'] = pd.to_datetime(df['ts'], unit='ms')
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert non-null time data records
-    time_data = list((t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday))
-    column_labels = ('timestamp', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame.from_dict(dict(zip(column_labels,time_data)))
-    time_df = time_df.loc[time_df['timestamp'].notnull()]
+    # insert time, user and songplay records
+    with stage('log_write', len(time_df) + len(user_df) + len(songplay_df)) as counts:
+        create_partitions(cur, songplay_df['start_time'])
+        counts['rows_out'] = (insert_rows(cur, time_table_insert, time_df)
+                              + insert_rows(cur, user_table_insert, user_df)
+                              + insert_rows(cur, songplay_table_insert_tracked, songplay_df))
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
 
-    # load user table
-    # filter out rows with no user id, gender, level or timestamp
-    user_df = df.loc[(df['userId'].notnull() & df['gender'].notnull() 
-                      & df['level'].notnull() & df['ts'].notnull()), 
-                     ['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']]
+def partition_queries(partitions, start_times):
+    """Return statements creating the monthly songplays partitions missing for start times.
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-            
-        # create songplay uuid
-        name = (str(row.song) + str(row.ts) + str(row.userId),)
-        generate_uuid = ("""SELECT uuid_generate_v5(uuid_nil(), %s)""")
-        cur.execute(generate_uuid, name)
-        songplayid = cur.fetchone() 
-
-        # insert songplay record
-        songplay_data = (songplayid, row.ts, row.userId, row.level, songid, artistid, 
-                         row.sessionId, row.location, row.userAgent)
-        if row.ts is not None:
-            cur.execute(songplay_table_insert, songplay_data)
-
-
-def process_data(cur, conn, filepath, func):
-    """Process data files from directory using function."""
-    # get all files matching extension from directory
+    Parameters:
+    partitions (tuple): row of songplay_partitions_select, whether songplays
+        is partitioned and the names of its partitions
+    start_times (series): start times of songplays about to be loaded
+
+    Returns: list of queries, empty when songplays is not partitioned
+
+    """
+    partitioned, existing = partitions
+    if not partitioned or start_times.empty:
+        return []
+
+    queries = []
+    for month in sorted(start_times.dt.to_period('M').unique()):
+        name = 'songplays_y{}m{:02d}'.format(month.year, month.month)
+        if name not in existing:
+            queries.append(songplay_partition_create.format(name=name, start=month.start_time.date(),
+                                                            end=(month + 1).start_time.date()))
+    if queries:
+        queries.insert(0, songplay_partition_lock)
+    return queries
+
+
+def create_partitions(cur, start_times):
+    """Create monthly songplays partitions for start times, if songplays is partitioned."""
+    cur.execute(songplay_partitions_select)
+    for query in partition_queries(cur.fetchone(), start_times):
+        cur.execute(query)
+
+
+def insert_rows(cur, query, df):
+    """Execute insert query once per dataframe row and return rows written."""
+    written = 0
+    for row in df.values.tolist():
+        cur.execute(query, row)
+        written += cur.rowcount
+    return written
+
+
+def create_staging_tables(cur, conn):
+    """Create session-scoped staging tables for the bulk loaders."""
+    for query in staging_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def copy_dataframe(cur, df, table):
+    """Stream dataframe rows into a table with COPY FROM STDIN.
+
+    Dataframe columns must be named after the table columns. Missing
+    values are written as unquoted empty fields, which COPY loads as NULL.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    df (dataframe): rows to load
+    table (string): name of target table
+
+    Returns: None
+
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH CSV".format(table, ', '.join(df.columns)), buffer)
+
+
+def load_song_data(cur, song_df, artist_df):
+    """Stage song and artist records with COPY and upsert them set-based.
+
+    Returns: number of rows written
+    """
+    cur.execute(staging_truncate.format('song_staging, artist_staging'))
+    copy_dataframe(cur, song_df, 'song_staging')
+    copy_dataframe(cur, artist_df, 'artist_staging')
+
+    written = 0
+    for query in [song_table_upsert, artist_table_upsert]:
+        cur.execute(query)
+        written += cur.rowcount
+    return written
+
+
+def load_log_data(cur, time_df, user_df, songplay_df):
+    """Stage time, user and songplay records with COPY and upsert them set-based.
+
+    Dimensions are written before songplays so that the foreign keys resolve.
+
+    Returns: number of rows written
+    """
+    create_partitions(cur, songplay_df['start_time'])
+    cur.execute(staging_truncate.format('time_staging, user_staging, songplay_staging'))
+    copy_dataframe(cur, time_df, 'time_staging')
+    copy_dataframe(cur, user_df, 'user_staging')
+    copy_dataframe(cur, songplay_df, 'songplay_staging')
+
+    written = 0
+    for query in [time_table_upsert, user_table_upsert, songplay_table_upsert_tracked]:
+        cur.execute(query)
+        written += cur.rowcount
+    return written
+
+
+def copy_song_data(cur, song_df, artist_df):
+    """COPY deduplicated song and artist records straight into their tables.
+
+    Only for the initial load of empty tables created by create_tables.py
+    --bulk-load, which have no keys to check against yet.
+
+    Returns: number of rows written
+    """
+    copy_dataframe(cur, song_df, 'songs')
+    copy_dataframe(cur, artist_df, 'artists')
+    return len(song_df) + len(artist_df)
+
+
+def copy_log_data(cur, time_df, user_df, songplay_df):
+    """COPY deduplicated time, user and songplay records straight into their tables.
+
+    Only for the initial load of empty tables created by create_tables.py
+    --bulk-load, which have no keys to check against yet.
+
+    Returns: number of rows written
+    """
+    create_partitions(cur, songplay_df['start_time'])
+    copy_dataframe(cur, time_df, 'time')
+    copy_dataframe(cur, user_df, 'users')
+    copy_dataframe(cur, songplay_df, 'songplays')
+    return len(time_df) + len(user_df) + len(songplay_df)
+
+
+def process_song_file_bulk(cur, filepath, song_index=None):
+    """Bulk load JSON song file into postgresql tables.
+
+    Stage song and artist records with COPY, then upsert them into the
+    song and artist tables with one set-based statement per table.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    filepath (string or list): filepath, or list of filepaths read as one batch
+    song_index (SongIndex): optional song lookup to extend with the new songs
+
+    Returns: None
+
+    """
+    process_song_batch(cur, filepath, song_index)
+
+
+def process_log_file_bulk(cur, filepath, song_index=None):
+    """Bulk load JSON log file into postgresql tables.
+
+    Stage time, user and songplay records with COPY, then upsert them
+    with one set-based statement per table.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    filepath (string or list): filepath, or list of filepaths read as one batch
+    song_index (SongIndex): song lookup, read from the database if omitted
+
+    Returns: None
+
+    """
+    process_log_batch(cur, filepath, song_index)
+
+
+def parse_song_batch(filepaths, song_index=None):
+    """Read a batch of JSON song files and return song and artist dataframes.
+
+    Parameters:
+    filepaths (string or list): filepath, or list of filepaths
+    song_index (SongIndex): optional song lookup to extend with the new songs
+
+    Returns: song and artist dataframes
+
+    """
+    with stage('song_read', 1 if isinstance(filepaths, str) else len(filepaths)) as counts:
+        df = read_json_batch(filepaths)
+        counts['rows_out'] = len(df)
+
+    with stage('song_transform', len(df)) as counts:
+        song_df, artist_df = extract_song_data(df)
+        if song_index is not None:
+            song_index.add(song_df, artist_df)
+        counts['rows_out'] = len(song_df) + len(artist_df)
+
+    return song_df, artist_df
+
+
+def parse_log_batch(filepaths, song_index):
+    """Read a batch of JSON log files and return time, user and songplay dataframes.
+
+    Parameters:
+    filepaths (string or list): filepath, or list of filepaths
+    song_index (SongIndex): song lookup
+
+    Returns: time, user and songplay dataframes
+
+    """
+    with stage('log_read', 1 if isinstance(filepaths, str) else len(filepaths)) as counts:
+        df = read_json_batch(filepaths)
+        counts['rows_out'] = len(df)
+
+    with stage('log_transform', len(df)) as counts:
+        df = select_songplays(df)
+        time_df, user_df, songplay_df = extract_log_data(df, song_index)
+        counts['rows_out'] = len(time_df) + len(user_df) + len(songplay_df)
+
+    return time_df, user_df, songplay_df
+
+
+def process_song_batch(cur, filepaths, song_index=None, load=load_song_data):
+    """Bulk load a batch of JSON song files into postgresql tables.
+
+    Read all files into one dataframe so that each song and artist is
+    staged and upserted once per batch.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    filepaths (list): filepaths
+    song_index (SongIndex): optional song lookup to extend with the new songs
+    load (function): writer of song and artist dataframes
+
+    Returns: None
+
+    """
+    song_df, artist_df = parse_song_batch(filepaths, song_index)
+
+    with stage('song_write', len(song_df) + len(artist_df)) as counts:
+        counts['rows_out'] = load(cur, song_df, artist_df)
+
+
+def process_log_batch(cur, filepaths, song_index=None, load=load_log_data):
+    """Bulk load a batch of JSON log files into postgresql tables.
+
+    Read all files into one dataframe and deduplicate timestamps, users
+    and songplays across files in memory, so that each key is staged and
+    upserted once per batch.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    filepaths (list): filepaths
+    song_index (SongIndex): song lookup, read from the database if omitted
+    load (function): writer of time, user and songplay dataframes
+
+    Returns: None
+
+    """
+    if song_index is None:
+        song_index = SongIndex.from_database(cur)
+
+    time_df, user_df, songplay_df = parse_log_batch(filepaths, song_index)
+
+    with stage('log_write', len(time_df) + len(user_df) + len(songplay_df)) as counts:
+        counts['rows_out'] = load(cur, time_df, user_df, songplay_df)
+
+
+def get_files(filepath):
+    """Return absolute paths of all JSON files under directory."""
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
+    return all_files
+
+
+def hash_file(filepath):
+    """Return sha256 hex digest and number of JSON lines of a data file."""
+    with open(filepath, 'rb') as f:
+        return json_reader.digest(f.read())
+
+
+def get_new_files(cur, conn, all_files, force=False):
+    """Return manifest entries of files not yet loaded or changed since loading.
+
+    Files whose size and mtime match the manifest are skipped without being
+    read. Files that were touched but still hash the same only get their
+    manifest entry refreshed. Files not in the manifest are not read here;
+    their digest is taken from the bytes the loader reads, see manifest_entry.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    conn (connection object): database connection
+    all_files (list): filepaths
+    force (boolean): return every file regardless of the manifest
+
+    Returns: list of (file_path, file_size, mtime, content_hash, lines_read) tuples, hash and lines None for files
+        not in the manifest
+
+    """
+    cur.execute(manifest_select)
+    manifest = {row[0]: row[1:] for row in cur.fetchall()}
+
+    new_files = []
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        loaded = manifest.get(datafile)
+        if not force and loaded and loaded[0] == stat.st_size and loaded[1] == stat.st_mtime:
+            continue
+
+        if not loaded:
+            new_files.append((datafile, stat.st_size, stat.st_mtime, None, None))
+            continue
+
+        content_hash, num_lines = hash_file(datafile)
+        entry = (datafile, stat.st_size, stat.st_mtime, content_hash, num_lines)
+        if not force and loaded[2] == content_hash:
+            cur.execute(manifest_table_upsert, entry)
+            continue
+
+        new_files.append(entry)
+    conn.commit()
+
+    return new_files
+
+
+def check_manifest(cur, conn, all_files, force=False):
+    """Return manifest entries of new or changed files, timed as the manifest stage."""
+    with stage('manifest', len(all_files)) as counts:
+        new_files = get_new_files(cur, conn, all_files, force)
+        counts['rows_out'] = len(new_files)
+    return new_files
+
+
+def refresh_rollups(cur):
+    """Add the songplays inserted by the current transaction to the rollup tables."""
+    with stage('rollup') as counts:
+        counts['rows_out'] = 0
+        for query in rollup_refresh_queries:
+            cur.execute(query)
+            counts['rows_out'] += cur.rowcount
+
+
+def backfill_rollups(cur, conn):
+    """Rebuild the rollup tables from all songplays."""
+    with stage('rollup_backfill'):
+        for query in rollup_backfill_queries:
+            cur.execute(query)
+        conn.commit()
+
+
+def manifest_entry(entry):
+    """Return manifest entry of a loaded file with the digest of the bytes the loader read.
+
+    Files served from the input cache were not read, so they are hashed here.
+    """
+    datafile, file_size, mtime, content_hash, num_lines = entry
+    if content_hash is None:
+        content_hash, num_lines = json_reader.take_digest(datafile) or hash_file(datafile)
+    return datafile, file_size, mtime, content_hash, num_lines
+
+
+def commit_files(cur, conn, entries):
+    """Refresh the rollups, record loaded files in the manifest and commit them with their rows."""
+    refresh_rollups(cur)
+    with stage('commit', len(entries)) as counts:
+        for entry in entries:
+            cur.execute(manifest_table_upsert, manifest_entry(entry))
+        conn.commit()
+        counts['rows_out'] = len(entries)
+
+
+def process_data(cur, conn, filepath, func, force=False, batch_size=1):
+    """Process data files from directory using function.
+
+    Files are parsed and loaded in batches. Each batch is committed together
+    with its manifest entries, so a rerun skips unchanged files and resumes
+    after the last committed batch.
+    """
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    # skip files loaded by an earlier run
+    new_files = check_manifest(cur, conn, all_files, force)
+    num_files = len(new_files)
+    print('{} new or changed files'.format(num_files))
+
+    # iterate over batches of files and process
+    for i in range(0, num_files, batch_size):
+        batch = new_files[i:i + batch_size]
+        func(cur, [entry[0] for entry in batch])
+        commit_files(cur, conn, batch)
+        print('{}/{} files processed.'.format(i + len(batch), num_files))
+
+
+def process_data_batch(cur, conn, filepath, func, force=False):
+    """Process all new data files from directory as one batch using function.
+
+    Parameters:
+    cur (cursor object): connection cursor
+    conn (connection object): database connection
+    filepath (string): directory of JSON files
+    func (function): batch loader called with cursor and list of filepaths
+    force (boolean): reload files already recorded in the manifest
+
+    Returns: None
+
+    """
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    new_files = check_manifest(cur, conn, all_files, force)
+    num_files = len(new_files)
+    print('{} new or changed files'.format(num_files))
+
+    if new_files:
+        func(cur, [entry[0] for entry in new_files])
+        commit_files(cur, conn, new_files)
+    print('{}/{} files processed.'.format(num_files, num_files))
+
+
+def init_worker(dsn, func):
+    """Open the connection reused by a worker process for all its batches."""
+    conn = psycopg2.connect(dsn, cursor_factory=CountingCursor)
+    cur = conn.cursor()
+    create_staging_tables(cur, conn)
+    _worker.update(conn=conn, cur=cur, func=func)
+
+
+def process_batch(batch, max_retries=10):
+    """Process a batch of files in one transaction on the worker connection.
+
+    Workers upsert the same dimension keys concurrently. The upserts are
+    safe to race, but overlapping batches can deadlock; the losing batch
+    is rolled back and retried after a random backoff.
+
+    Parameters:
+    batch (list): manifest entries of files to load
+    max_retries (int): attempts after a deadlock or serialization failure
+
+    Returns: number of files processed, stage statistics and round trips
+        of the batch
+
+    """
+    conn, cur, func = _worker['conn'], _worker['cur'], _worker['func']
+    round_trips = CountingCursor.round_trips
+    for attempt in range(max_retries + 1):
+        # stages of rolled back attempts are recorded too, they took time
+        report = etl_metrics.start_report()
+        try:
+            func(cur, [entry[0] for entry in batch])
+            commit_files(cur, conn, batch)
+            return len(batch), report.stages, CountingCursor.round_trips - round_trips
+        except TransactionRollbackError:
+            conn.rollback()
+            if attempt == max_retries:
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def process_data_parallel(cur, conn, filepath, func, workers, batch_size, dsn=DSN, force=False):
+    """Process data files from directory in parallel worker processes.
+
+    New and changed files are split into batches that are committed one at
+    a time by a pool of worker processes, each with its own database
+    connection.
+
+    Parameters:
+    cur (cursor object): connection cursor used to read the manifest
+    conn (connection object): database connection
+    filepath (string): directory of JSON files
+    func (function): file loader called with cursor and list of filepaths
+    workers (int): number of worker processes
+    batch_size (int): files per transaction
+    dsn (string): connection string of sparkify database
+    force (boolean): reload files already recorded in the manifest
+
+    Returns: None
+
+    """
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    new_files = check_manifest(cur, conn, all_files, force)
+    num_files = len(new_files)
+    print('{} new or changed files'.format(num_files))
+
+    batches = [new_files[i:i + batch_size] for i in range(0, num_files, batch_size)]
+
+    processed = 0
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(dsn, func)) as pool:
+        for n, stages, round_trips in pool.imap_unordered(process_batch, batches):
+            processed += n
+            etl_metrics.merge_stages(stages)
+            # counted as statements of this process, the workers send them on its behalf
+            CountingCursor.round_trips += round_trips
+            print('{}/{} files processed.'.format(processed, num_files))
 
 
 def main():
     """Load song and log data into postgresql star schema."""
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description='Load song and log data into sparkifydb.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='stage rows with COPY and upsert with set-based statements')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--batch', action='store_true',
+                      help='load each directory as one deduplicated batch with COPY')
+    mode.add_argument('--async', dest='use_async', action='store_true',
+                      help='parse the next batches while an asyncpg writer loads the previous ones')
+    mode.add_argument('--backfill-rollups', action='store_true',
+                      help='rebuild the rollup tables from all songplays instead of loading data')
+    parser.add_argument('--force', action='store_true',
+                        help='reload all files, including those unchanged since the last run')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes loading files in parallel')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='files parsed and committed per transaction')
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help='parsed batches waiting for the async writer')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep Arrow IPC copies of parsed input files in DIR and memory-map them on later runs')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='size cap of the input cache in MB, least recently used files are evicted')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write timing and row counts of each stage to a JSON file')
+    parser.add_argument('--report-table', action='store_true',
+                        help='record timing and row counts of each stage in the etl_runs table')
+    args = parser.parse_args()
+
+    # --batch and --async write with their own statements, and only the per-file loaders run in workers
+    exclusive = [flag for flag, used in [('--batch', args.batch), ('--async', args.use_async),
+                                         ('--backfill-rollups', args.backfill_rollups)] if used]
+    if exclusive and args.bulk:
+        parser.error('--bulk cannot be combined with {}'.format(exclusive[0]))
+    if exclusive and args.workers > 1:
+        parser.error('--workers cannot be combined with {}'.format(exclusive[0]))
+
+    report = etl_metrics.start_report()
+    if args.cache_dir:
+        json_reader.use_cache(InputCache(args.cache_dir, args.cache_size * 2 ** 20))
+
+    conn = psycopg2.connect(DSN, cursor_factory=CountingCursor)
     cur = conn.cursor()
-    
-    # enable uuid extension
-    cur.execute("""CREATE EXTENSION "uuid-ossp";""")
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    # manifest, rollups and load times, for databases created before they existed
+    for query in [manifest_table_create, manifest_table_migrate, load_time_migrate] + rollup_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+    create_staging_tables(cur, conn)
+
+    if args.bulk:
+        song_func, log_func = process_song_file_bulk, process_log_file_bulk
+    else:
+        song_func, log_func = process_song_file, process_log_file
+
+    if args.backfill_rollups:
+        backfill_rollups(cur, conn)
+    elif args.batch:
+        song_index = SongIndex.from_database(cur)
+        process_data_batch(cur, conn, 'data/song_data', partial(process_song_batch, song_index=song_index),
+                           force=args.force)
+        process_data_batch(cur, conn, 'data/log_data', partial(process_log_batch, song_index=song_index),
+                           force=args.force)
+    elif args.use_async:
+        # imported here, etl_async builds on this module
+        from etl_async import process_data_async, song_writes, log_writes
+        song_index = SongIndex.from_database(cur)
+        process_data_async(cur, conn, 'data/song_data', partial(song_writes, song_index=song_index), 'song_write',
+                           force=args.force, batch_size=args.batch_size, queue_size=args.queue_size)
+        process_data_async(cur, conn, 'data/log_data', partial(log_writes, song_index=song_index), 'log_write',
+                           force=args.force, batch_size=args.batch_size, queue_size=args.queue_size)
+    elif args.workers > 1:
+        # workers load songs independently, so read the song lookup back once they finish
+        process_data_parallel(cur, conn, 'data/song_data', song_func, args.workers, args.batch_size,
+                              force=args.force)
+        song_index = SongIndex.from_database(cur)
+        process_data_parallel(cur, conn, 'data/log_data', partial(log_func, song_index=song_index),
+                              args.workers, args.batch_size, force=args.force)
+    else:
+        # song lookup shared by all files, extended as song files are loaded
+        song_index = SongIndex.from_database(cur)
+        process_data(cur, conn, filepath='data/song_data', func=partial(song_func, song_index=song_index),
+                     force=args.force, batch_size=args.batch_size)
+        process_data(cur, conn, filepath='data/log_data', func=partial(log_func, song_index=song_index),
+                     force=args.force, batch_size=args.batch_size)
+
+    report.finish()
+    if args.report:
+        report.write_json(args.report)
+    if args.report_table:
+        cur.execute(etl_run_table_create)
+        report.write_table(cur, conn)
+    for name, stats in report.stages.items():
+        print('{:<16} {:>10.3f}s {:>10} rows in {:>10} rows out {:>8} round trips'.format(
+            name, stats['seconds'], stats['rows_in'], stats['rows_out'], stats['round_trips']))
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
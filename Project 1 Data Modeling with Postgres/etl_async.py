@@ -0,0 +1,160 @@
+import re
+import asyncio
+import psycopg2.extensions
+from etl import DSN, get_files, check_manifest, manifest_entry, parse_song_batch, parse_log_batch, partition_queries
+from etl_metrics import stage, CountingCursor
+from sql_queries import (staging_table_queries, manifest_table_upsert, song_table_upsert, artist_table_upsert,
+                         time_table_upsert, user_table_upsert, songplay_table_upsert_tracked,
+                         songplay_partitions_select, rollup_refresh_queries, staging_truncate)
+
+# optional dependency, only needed by the async pipeline
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+def to_asyncpg(query):
+    """Return query with psycopg2 %s placeholders numbered as asyncpg $1, $2, ..."""
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda match: '${}'.format(next(counter)), query)
+
+
+def records(df):
+    """Return dataframe rows as lists of python values, with None for missing values."""
+    df = df.astype(object)
+    return df.where(df.notnull(), None).values.tolist()
+
+
+def song_writes(filepaths, song_index):
+    """Parse song files into (staging table, dataframe, upsert query) writes."""
+    song_df, artist_df = parse_song_batch(filepaths, song_index)
+    return [('song_staging', song_df, song_table_upsert),
+            ('artist_staging', artist_df, artist_table_upsert)]
+
+
+def log_writes(filepaths, song_index):
+    """Parse log files into (staging table, dataframe, upsert query) writes."""
+    time_df, user_df, songplay_df = parse_log_batch(filepaths, song_index)
+    return [('time_staging', time_df, time_table_upsert),
+            ('user_staging', user_df, user_table_upsert),
+            ('songplay_staging', songplay_df, songplay_table_upsert_tracked)]
+
+
+async def execute(conn, query, *args):
+    """Execute a statement on an asyncpg connection, counting it like a CountingCursor does."""
+    CountingCursor.round_trips += 1
+    return await conn.execute(query, *args)
+
+
+async def create_partitions(conn, start_times):
+    """Create monthly songplays partitions for start times, if songplays is partitioned."""
+    CountingCursor.round_trips += 1
+    partitions = await conn.fetchrow(songplay_partitions_select)
+    for query in partition_queries(tuple(partitions), start_times):
+        await execute(conn, query)
+
+
+async def produce(queue, batches, parse):
+    """Parse batches in a worker thread and queue them for the writer.
+
+    put() waits while the queue is full, so parsing never runs more than
+    the queue size ahead of the writer.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        for batch in batches:
+            writes = await loop.run_in_executor(None, parse, [entry[0] for entry in batch])
+            await queue.put((batch, writes))
+    finally:
+        await queue.put(None)
+
+
+async def consume(queue, conn, name, num_files):
+    """Write queued batches, each in one transaction with its manifest entries."""
+    manifest_upsert = to_asyncpg(manifest_table_upsert)
+    processed = 0
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+
+        batch, writes = item
+        with stage(name, sum(len(df) for table, df, query in writes)) as counts:
+            counts['rows_out'] = 0
+            async with conn.transaction():
+                await execute(conn, staging_truncate.format(', '.join(table for table, df, query in writes)))
+                for table, df, query in writes:
+                    if table == 'songplay_staging':
+                        await create_partitions(conn, df['start_time'])
+                    CountingCursor.round_trips += 1
+                    await conn.copy_records_to_table(table, records=records(df), columns=list(df.columns))
+                for table, df, query in writes:
+                    status = await execute(conn, query)
+                    counts['rows_out'] += int(status.split()[-1])
+                for query in rollup_refresh_queries:
+                    await execute(conn, query)
+                # pipelined by asyncpg, counted as one round trip
+                CountingCursor.round_trips += 1
+                await conn.executemany(manifest_upsert, [manifest_entry(entry) for entry in batch])
+
+        processed += len(batch)
+        print('{}/{} files processed.'.format(processed, num_files))
+
+
+async def run_pipeline(batches, parse, name, dsn, queue_size):
+    """Overlap parsing of batches with writing of earlier batches to postgresql."""
+    params = psycopg2.extensions.parse_dsn(dsn)
+    conn = await asyncpg.connect(host=params.get('host'), port=params.get('port'), user=params.get('user'),
+                                 password=params.get('password'), database=params.get('dbname'))
+    try:
+        for query in staging_table_queries:
+            await execute(conn, query)
+
+        queue = asyncio.Queue(maxsize=queue_size)
+        producer = asyncio.create_task(produce(queue, batches, parse))
+        try:
+            await consume(queue, conn, name, sum(len(batch) for batch in batches))
+        except BaseException:
+            producer.cancel()
+            raise
+        # raise parse errors
+        await producer
+    finally:
+        await conn.close()
+
+
+def process_data_async(cur, conn, filepath, parse, name, dsn=DSN, force=False, batch_size=50, queue_size=2):
+    """Process data files from directory with a parser thread and an async writer.
+
+    Parsed batches are handed to the writer through a bounded queue. The
+    parser blocks while the queue is full, so memory holds at most
+    queue_size + 2 batches and throughput follows the slower stage.
+
+    Parameters:
+    cur (cursor object): connection cursor used to read the manifest
+    conn (connection object): database connection
+    filepath (string): directory of JSON files
+    parse (function): called with list of filepaths, returns (staging table, dataframe, upsert query) writes
+    name (string): stage name of the writer in the run report
+    dsn (string): connection string of sparkify database
+    force (boolean): reload files already recorded in the manifest
+    batch_size (int): files per transaction
+    queue_size (int): parsed batches waiting for the writer
+
+    Returns: None
+
+    """
+    if asyncpg is None:
+        raise ImportError('the async pipeline requires asyncpg, pip install asyncpg')
+
+    all_files = get_files(filepath)
+    print('{} files found in {}'.format(len(all_files), filepath))
+
+    new_files = check_manifest(cur, conn, all_files, force)
+    num_files = len(new_files)
+    print('{} new or changed files'.format(num_files))
+
+    batches = [new_files[i:i + batch_size] for i in range(0, num_files, batch_size)]
+    if batches:
+        asyncio.run(run_pipeline(batches, parse, name, dsn, queue_size))
@@ -0,0 +1,125 @@
+import json
+import time
+import uuid
+import resource
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import psycopg2.extensions
+from sql_queries import etl_run_table_insert
+
+# report of the run in progress, stages are not recorded while it is None
+_report = None
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends to the server."""
+
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.round_trips += 1
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        CountingCursor.round_trips += 1
+        return super().copy_expert(sql, file, size)
+
+
+def peak_memory_mb():
+    """Return the high-water mark of the process resident set size in MB."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class RunReport:
+    """Wall time, row counts, round trips and peak memory of each ETL stage.
+
+    Stages with the same name are summed over all the files of a run.
+    """
+
+    def __init__(self):
+        self.run_id = str(uuid.uuid4())
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """Time a stage; the caller may set 'rows_out' on the yielded dict."""
+        counts = {'rows_in': rows_in, 'rows_out': None}
+        round_trips = CountingCursor.round_trips
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(name, {
+                'calls': 1,
+                'seconds': time.perf_counter() - start,
+                'rows_in': counts['rows_in'] or 0,
+                'rows_out': counts['rows_out'] or 0,
+                'round_trips': CountingCursor.round_trips - round_trips,
+                'peak_memory_mb': peak_memory_mb(),
+            })
+
+    def add(self, name, stats):
+        """Add stage statistics, e.g. those reported by a worker process."""
+        totals = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0,
+                                               'round_trips': 0, 'peak_memory_mb': 0.0})
+        for key, value in stats.items():
+            if key == 'peak_memory_mb':
+                totals[key] = max(totals[key], value)
+            else:
+                totals[key] += value
+
+    def merge(self, stages):
+        """Add the stages of another report."""
+        for name, stats in stages.items():
+            self.add(name, stats)
+
+    def finish(self):
+        """Mark the run as finished and return the report as a dictionary."""
+        self.finished_at = datetime.now()
+        return self.to_dict()
+
+    def to_dict(self):
+        """Return the report as a JSON serializable dictionary."""
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'stages': {name: dict(stats, seconds=round(stats['seconds'], 6))
+                       for name, stats in self.stages.items()},
+        }
+
+    def write_json(self, filepath):
+        """Write the report to a JSON file."""
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_table(self, cur, conn):
+        """Insert one etl_runs row per stage."""
+        for name, stats in self.stages.items():
+            cur.execute(etl_run_table_insert, (self.run_id, name, self.started_at, self.finished_at,
+                                               stats['calls'], stats['seconds'], stats['rows_in'],
+                                               stats['rows_out'], stats['round_trips'],
+                                               stats['peak_memory_mb']))
+        conn.commit()
+
+
+def start_report():
+    """Start recording stages into a new report and return it."""
+    global _report
+    _report = RunReport()
+    return _report
+
+
+def merge_stages(stages):
+    """Add stages recorded elsewhere, e.g. by a worker process, to the current report."""
+    if _report is not None:
+        _report.merge(stages)
+
+
+def stage(name, rows_in=None):
+    """Return context manager timing a stage of the current report, if any."""
+    if _report is None:
+        return nullcontext({'rows_in': rows_in, 'rows_out': None})
+    return _report.stage(name, rows_in)
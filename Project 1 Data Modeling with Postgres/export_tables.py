@@ -0,0 +1,257 @@
+import os
+import io
+import json
+import shutil
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from etl import DSN
+
+
+EXPORT_TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+
+# tables written to year=YYYY/month=MM directories by month of this column
+PARTITION_COLUMNS = {'songplays': 'start_time', 'time': 'start_time'}
+
+# incremental exports only write rows loaded after the last export, by this column set by the
+# loader; the other tables are dimensions updated in place and are exported in full every time
+WATERMARK_COLUMNS = {'songplays': 'loaded_at', 'time': 'loaded_at'}
+
+ARROW_TYPES = {
+    'uuid': pa.string(),
+    'text': pa.string(),
+    'integer': pa.int32(),
+    'bigint': pa.int64(),
+    'numeric': pa.float64(),
+    'double precision': pa.float64(),
+    'timestamp without time zone': pa.timestamp('us'),
+    'date': pa.date32(),
+    'boolean': pa.bool_(),
+}
+
+STATE_FILE = '_export_state.json'
+
+# load time before which every transaction has ended: the oldest open transaction, or the current
+# time if there is none. Rows carry the start time of their loader transaction, so rows loaded
+# before it are all committed. Open transactions of other roles are only seen by members of
+# pg_read_all_stats.
+LOAD_HORIZON_SELECT = ("SELECT least(clock_timestamp(), min(xact_start))::timestamp FROM pg_stat_activity "
+                       "WHERE pid <> pg_backend_pid()")
+
+
+def table_columns(cur, table):
+    """Return column names and arrow types of a table in column order."""
+    cur.execute("SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position", (table,))
+    return [(name, ARROW_TYPES.get(data_type, pa.string())) for name, data_type in cur.fetchall()]
+
+
+class ParquetSink:
+    """File object receiving COPY ... TO STDOUT CSV data and writing it as Parquet.
+
+    Data is buffered up to chunk_bytes, then the complete rows in the buffer
+    are parsed and appended to the Parquet file of their partition as one
+    row group, so memory stays bounded by the chunk size.
+    """
+
+    def __init__(self, directory, columns, export_id, partition_column=None, chunk_bytes=64 * 2 ** 20):
+        self.directory = directory
+        self.schema = pa.schema(columns)
+        self.export_id = export_id
+        self.partition_column = partition_column
+        self.chunk_bytes = chunk_bytes
+        self.rows = 0
+        self._buffer = bytearray()
+        self._writers = {}
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_bytes:
+            cut = self._row_boundary()
+            if cut:
+                self._write_rows(bytes(self._buffer[:cut]))
+                del self._buffer[:cut]
+
+    def close(self):
+        """Write the remaining rows and close all Parquet files."""
+        if self._buffer:
+            self._write_rows(bytes(self._buffer))
+            self._buffer = bytearray()
+        for writer in self._writers.values():
+            writer.close()
+
+    def _row_boundary(self):
+        """Return offset after the last complete row in the buffer, 0 if there is none.
+
+        A newline ends a row only outside of quotes, i.e. after an even
+        number of quote characters.
+        """
+        cut = self._buffer.rfind(b'\n')
+        while cut >= 0 and self._buffer.count(b'"', 0, cut) % 2:
+            cut = self._buffer.rfind(b'\n', 0, cut)
+        return cut + 1
+
+    def _write_rows(self, data):
+        """Parse CSV rows and append them to the Parquet files of their partitions."""
+        table = pa_csv.read_csv(
+            io.BytesIO(data),
+            read_options=pa_csv.ReadOptions(column_names=self.schema.names),
+            convert_options=pa_csv.ConvertOptions(column_types=self.schema, null_values=[''],
+                                                  strings_can_be_null=True, quoted_strings_can_be_null=False))
+        self.rows += table.num_rows
+
+        if self.partition_column is None:
+            self._writer('')
+            self._writers[''].write_table(table)
+            return
+
+        column = table[self.partition_column]
+        months = pc.add(pc.multiply(pc.year(column), 100), pc.month(column))
+        for month in pc.unique(months).to_pylist():
+            partition = os.path.join('year={}'.format(month // 100), 'month={:02d}'.format(month % 100))
+            self._writer(partition).write_table(table.filter(pc.equal(months, month)))
+
+    def _writer(self, partition):
+        """Return the Parquet writer of a partition directory, opened on first use."""
+        if partition not in self._writers:
+            directory = os.path.join(self.directory, partition)
+            os.makedirs(directory, exist_ok=True)
+            filepath = os.path.join(directory, 'part-{}.parquet'.format(self.export_id))
+            self._writers[partition] = pq.ParquetWriter(filepath, self.schema)
+        return self._writers[partition]
+
+
+def load_horizon(dsn):
+    """Return the load time before which all loaded rows are committed, in ISO format."""
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(LOAD_HORIZON_SELECT)
+        return cur.fetchone()[0].isoformat()
+    finally:
+        conn.close()
+
+
+def export_table(dsn, table, output_dir, export_id, watermark=None, horizon=None, incremental=False,
+                 chunk_bytes=64 * 2 ** 20):
+    """Stream one table into Parquet files with COPY ... TO STDOUT.
+
+    The table is read in one repeatable read snapshot taken after the
+    horizon was read. Tables with a watermark column are exported up to
+    the horizon, rows loaded later are left to the next export.
+    Incremental exports of these tables only write rows loaded since the
+    watermark of the last export; all other exports replace the table
+    directory.
+
+    Parameters:
+    dsn (string): connection string of sparkify database
+    table (string): table to export
+    output_dir (string): root directory of the export
+    export_id (string): name of the Parquet files written by this export
+    watermark (string): load time up to which the table was exported before
+    horizon (string): load time before which all loaded rows are committed
+    incremental (boolean): only export rows loaded after the watermark
+    chunk_bytes (int): CSV bytes parsed and written at a time
+
+    Returns: number of rows exported and the new watermark of the table
+
+    """
+    conn = psycopg2.connect(dsn)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = conn.cursor()
+    try:
+        columns = table_columns(cur, table)
+        query = 'SELECT {} FROM {}'.format(', '.join(name for name, _ in columns), table)
+
+        watermark_column = WATERMARK_COLUMNS.get(table)
+        new_watermark = None
+        if watermark_column:
+            new_watermark = horizon
+            if incremental and watermark:
+                query = cur.mogrify(query + ' WHERE {0} >= %s AND {0} < %s'.format(watermark_column),
+                                    (watermark, horizon)).decode()
+            else:
+                query = cur.mogrify(query + ' WHERE {} < %s'.format(watermark_column), (horizon,)).decode()
+
+        directory = os.path.join(output_dir, table)
+        if not (incremental and watermark_column and watermark):
+            shutil.rmtree(directory, ignore_errors=True)
+
+        sink = ParquetSink(directory, columns, export_id, PARTITION_COLUMNS.get(table), chunk_bytes)
+        cur.copy_expert('COPY ({}) TO STDOUT WITH CSV'.format(query), sink)
+        sink.close()
+    finally:
+        conn.close()
+
+    return sink.rows, new_watermark
+
+
+def export_tables(dsn, output_dir, tables=EXPORT_TABLES, incremental=False, workers=len(EXPORT_TABLES),
+                  chunk_bytes=64 * 2 ** 20):
+    """Export tables in parallel, each on its own connection.
+
+    Watermarks are load times kept in _export_state.json of the output
+    directory and only advance once every table has been exported.
+
+    Parameters:
+    dsn (string): connection string of sparkify database
+    output_dir (string): root directory of the export
+    tables (list): tables to export
+    incremental (boolean): only export rows after the last export's watermarks
+    workers (int): tables exported at the same time
+    chunk_bytes (int): CSV bytes parsed and written at a time
+
+    Returns: dictionary of rows exported per table
+
+    """
+    state_path = os.path.join(output_dir, STATE_FILE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    # keyed by table and column, watermarks of another column are not comparable
+    keys = {table: '{}.{}'.format(table, WATERMARK_COLUMNS[table]) for table in tables if table in WATERMARK_COLUMNS}
+
+    export_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    horizon = load_horizon(dsn)
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {table: executor.submit(export_table, dsn, table, output_dir, export_id,
+                                          state.get(keys.get(table)), horizon, incremental, chunk_bytes)
+                   for table in tables}
+        results = {table: future.result() for table, future in futures.items()}
+
+    for table, (rows, watermark) in results.items():
+        if watermark:
+            state[keys[table]] = watermark
+    with open(state_path, 'w') as f:
+        json.dump(state, f, indent=2)
+
+    return {table: rows for table, (rows, watermark) in results.items()}
+
+
+def main():
+    """Export the sparkifydb star schema to Parquet."""
+    parser = argparse.ArgumentParser(description='Export sparkifydb tables to Parquet files.')
+    parser.add_argument('--output', default='export', help='root directory of the export')
+    parser.add_argument('--tables', nargs='+', default=EXPORT_TABLES, choices=EXPORT_TABLES,
+                        help='tables to export')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export songplays and time rows loaded since the last export')
+    parser.add_argument('--workers', type=int, default=len(EXPORT_TABLES), help='tables exported in parallel')
+    parser.add_argument('--chunk-size', type=int, default=64, help='MB of rows parsed and written at a time')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    rows = export_tables(DSN, args.output, args.tables, args.incremental, args.workers, args.chunk_size * 2 ** 20)
+    for table, num_rows in rows.items():
+        print('{} rows exported from {}'.format(num_rows, table))
+
+
+if __name__ == "__main__":
+    main()
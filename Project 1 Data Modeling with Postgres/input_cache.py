@@ -0,0 +1,123 @@
+import os
+import hashlib
+import tempfile
+import pandas as pd
+from json_reader import read_files, join_records, parse_arrow
+from etl_metrics import stage
+
+# optional dependency, the cache is only used when pyarrow is installed
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:
+    pa = None
+
+
+def count_records(content):
+    """Return number of records in the contents of a line-delimited JSON file."""
+    return sum(1 for line in content.splitlines() if line.strip())
+
+
+class InputCache:
+    """Arrow IPC copies of raw JSON files, keyed by path, mtime and size.
+
+    A file is parsed once; later reads memory-map its columnar copy.
+    Changing a file changes its key, and the stale copy is evicted in
+    least recently used order once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        if pa is None:
+            raise ImportError('the input cache requires pyarrow, pip install pyarrow')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, filepath):
+        """Return cache file path of a raw file in its current version."""
+        stat = os.stat(filepath)
+        key = '{}:{}:{}'.format(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.arrow')
+
+    def get(self, cache_path):
+        """Return memory-mapped table of a cache file, None if it is not cached."""
+        try:
+            # the modification time of cache files orders them for eviction
+            os.utime(cache_path)
+            with pa.memory_map(cache_path) as source:
+                return ipc.open_file(source).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            # not cached, or evicted or truncated by another loader
+            return None
+
+    def put(self, cache_path, table):
+        """Write table to a cache file, atomically for concurrent loaders."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, cache_path)
+
+    def evict(self):
+        """Delete least recently used cache files until the cache fits in max_bytes.
+
+        The directory is scanned on every call, since parallel loaders share it.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.arrow'):
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except FileNotFoundError:
+                # evicted by another loader
+                pass
+
+        size = sum(entry[1] for entry in entries)
+        for mtime, file_size, cache_path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def read_batch(self, filepaths, threads=8):
+        """Return one dataframe with the records of a batch of JSON files.
+
+        Cached files are memory-mapped. The others are read and parsed
+        together in one pass as by read_json_batch, then split per file
+        and written to the cache.
+
+        Parameters:
+        filepaths (list): filepaths
+        threads (int): number of threads reading uncached files
+
+        Returns: dataframe with one row per JSON record
+
+        """
+        with stage('input_cache', len(filepaths)) as counts:
+            cache_paths = [self.path(filepath) for filepath in filepaths]
+            tables = [self.get(cache_path) for cache_path in cache_paths]
+            missing = [i for i, table in enumerate(tables) if table is None]
+            counts['rows_out'] = len(filepaths) - len(missing)
+
+        if missing:
+            contents = read_files([filepaths[i] for i in missing], threads)
+            buffer = join_records(contents)
+            parsed = parse_arrow(buffer) if buffer else pa.table({})
+
+            offset = 0
+            for i, content in zip(missing, contents):
+                num_records = count_records(content)
+                tables[i] = parsed.slice(offset, num_records)
+                offset += num_records
+                self.put(cache_paths[i], tables[i])
+            self.evict()
+
+        tables = [table for table in tables if table.num_rows]
+        if not tables:
+            return pd.DataFrame()
+        # files cached by different runs may infer different types, e.g. null and double
+        return pa.concat_tables(tables, promote_options='permissive').to_pandas()
@@ -0,0 +1,103 @@
+import io
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# optional faster parsers, used when installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+try:
+    from pyarrow import json as pa_json
+except ImportError:
+    pa_json = None
+
+# columnar cache of parsed files, see input_cache.py
+_cache = None
+
+# sha256 digest and JSON line count of files read since their digest was last taken
+_digests = {}
+
+
+def use_cache(cache):
+    """Read files through a columnar input cache, or parse them again if cache is None."""
+    global _cache
+    _cache = cache
+
+
+def read_bytes(filepath):
+    """Return the contents of a file as bytes and remember their digest for the manifest."""
+    with open(filepath, 'rb') as f:
+        content = f.read()
+    _digests[filepath] = digest(content)
+    return content
+
+
+def digest(content):
+    """Return sha256 hex digest and number of JSON lines of the contents of a file."""
+    return hashlib.sha256(content).hexdigest(), sum(1 for line in content.splitlines() if line.strip())
+
+
+def take_digest(filepath):
+    """Return digest of a file read since the last call for it, None if it was not read."""
+    return _digests.pop(filepath, None)
+
+
+def read_files(filepaths, threads=8):
+    """Return the contents of files as a list of bytes, read concurrently."""
+    if len(filepaths) > 1 and threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(read_bytes, filepaths))
+    return [read_bytes(f) for f in filepaths]
+
+
+def join_records(contents):
+    """Return contents of line-delimited JSON files joined into one buffer."""
+    return b'\n'.join(content.rstrip(b'\n') for content in contents if content.strip())
+
+
+def parse_arrow(buffer):
+    """Return arrow table of line-delimited JSON records, parsed in parallel blocks."""
+    read_options = pa_json.ReadOptions(use_threads=True)
+    return pa_json.read_json(io.BytesIO(buffer), read_options=read_options)
+
+
+def read_json_batch(filepaths, engine='auto', threads=8):
+    """Return one dataframe with the records of a batch of line-delimited JSON files.
+
+    The files are read concurrently and joined into a single buffer, which
+    is parsed in one pass instead of setting up pandas once per file. The
+    arrow engine parses the buffer in parallel blocks straight into column
+    arrays; the json engine parses line by line with orjson when installed.
+    With an input cache in use, the arrow engine memory-maps columnar
+    copies of files parsed by earlier runs.
+
+    Parameters:
+    filepaths (string or list): filepath, or list of filepaths
+    engine (string): 'arrow', 'json' or 'auto' to use arrow when installed
+    threads (int): number of threads reading files
+
+    Returns: dataframe with one row per JSON record
+
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+
+    if engine == 'auto':
+        engine = 'arrow' if pa_json is not None else 'json'
+
+    if engine == 'arrow' and _cache is not None:
+        return _cache.read_batch(filepaths, threads)
+
+    buffer = join_records(read_files(filepaths, threads))
+    if not buffer:
+        return pd.DataFrame()
+
+    if engine == 'arrow':
+        return parse_arrow(buffer).to_pandas()
+
+    return pd.DataFrame([loads(line) for line in buffer.splitlines() if line.strip()])
@@ -0,0 +1,101 @@
+import pandas as pd
+from sql_queries import song_index_select
+
+
+KEY_COLUMNS = ['title_key', 'artist_key', 'duration_key']
+
+
+def normalize_keys(title, artist, duration):
+    """Return dataframe of lookup keys for song title, artist name and duration.
+
+    Titles and names are stripped and lower-cased. Durations are rounded to
+    the 5 decimal places used by both the song files and the event logs.
+
+    Parameters:
+    title (series): song titles
+    artist (series): artist names
+    duration (series): song durations in seconds
+
+    Returns: dataframe with title_key, artist_key and duration_key columns
+
+    """
+    return pd.DataFrame({
+        'title_key': title.astype(object).str.strip().str.lower(),
+        'artist_key': artist.astype(object).str.strip().str.lower(),
+        'duration_key': pd.to_numeric(duration, errors='coerce').round(5),
+    }, columns=KEY_COLUMNS)
+
+
+class SongIndex:
+    """Hashed lookup of song_id and artist_id by (title, artist name, duration).
+
+    Replaces one song_select query per songplay with a single merge per
+    dataframe of events. The index is built once from the database and
+    extended in memory as song files are loaded.
+    """
+
+    def __init__(self):
+        empty = pd.Series([], dtype=object)
+        self._index = normalize_keys(empty, empty, empty.astype(float))
+        self._index['song_id'] = empty
+        self._index['artist_id'] = empty
+        self._pending = []
+
+    @classmethod
+    def from_database(cls, cur):
+        """Return index of all songs and artists in the database."""
+        cur.execute(song_index_select)
+        songs = pd.DataFrame(cur.fetchall(), columns=['song_id', 'title', 'artist_id', 'name', 'duration'])
+
+        index = cls()
+        index._append(songs)
+        return index
+
+    def add(self, song_df, artist_df):
+        """Add newly parsed song and artist records to the index.
+
+        Parameters:
+        song_df (dataframe): rows for the songs table
+        artist_df (dataframe): rows for the artists table
+
+        Returns: None
+
+        """
+        songs = song_df.merge(artist_df[['artist_id', 'name']].drop_duplicates('artist_id'),
+                              on='artist_id')
+        self._append(songs)
+
+    def resolve(self, title, artist, duration):
+        """Return song_id and artist_id for each event, None where no song matches.
+
+        Parameters:
+        title (series): song titles
+        artist (series): artist names
+        duration (series): song lengths in seconds
+
+        Returns: dataframe with song_id and artist_id columns aligned to title
+
+        """
+        keys = normalize_keys(title, artist, duration)
+        matched = keys.merge(self._frame(), how='left', on=KEY_COLUMNS)
+        matched.index = title.index
+        matched = matched[['song_id', 'artist_id']].astype(object)
+        return matched.where(matched.notnull(), None)
+
+    def __len__(self):
+        return len(self._frame())
+
+    def _append(self, songs):
+        """Queue songs with title, name and duration columns for indexing."""
+        keys = normalize_keys(songs['title'], songs['name'], songs['duration'])
+        keys['song_id'] = songs['song_id'].values
+        keys['artist_id'] = songs['artist_id'].values
+        self._pending.append(keys.dropna(subset=KEY_COLUMNS))
+
+    def _frame(self):
+        """Return the index with any pending songs merged in, first entry per key wins."""
+        if self._pending:
+            self._index = (pd.concat([self._index] + self._pending, ignore_index=True)
+                           .drop_duplicates(subset=KEY_COLUMNS, keep='first'))
+            self._pending = []
+        return self._index
@@ -5,10 +5,24 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
+etl_run_table_drop = "DROP TABLE IF EXISTS etl_runs"
+hourly_play_table_drop = "DROP TABLE IF EXISTS hourly_plays"
+user_day_table_drop = "DROP TABLE IF EXISTS user_days"
+daily_active_user_table_drop = "DROP TABLE IF EXISTS daily_active_users"
 
 # CREATE TABLES
 
-songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id uuid PRIMARY KEY, start_time timestamp NOT NULL REFERENCES time(start_time), user_id int NOT NULL REFERENCES users(user_id), level text, song_id text REFERENCES songs(song_id), artist_id text REFERENCES artists(artist_id), session_id int, location text, user_agent text)""")
+songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id uuid PRIMARY KEY, start_time timestamp NOT NULL REFERENCES time(start_time), user_id int NOT NULL REFERENCES users(user_id), level text, song_id text REFERENCES songs(song_id), artist_id text REFERENCES artists(artist_id), session_id int, location text, user_agent text, loaded_at timestamp NOT NULL DEFAULT now())""")
+
+# songplays split into monthly partitions by start_time, created by the loader as data arrives;
+# songplay ids are derived from ts, so (songplay_id, start_time) is as unique as songplay_id
+songplay_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays (songplay_id uuid NOT NULL, start_time timestamp NOT NULL REFERENCES time(start_time), user_id int NOT NULL REFERENCES users(user_id), level text, song_id text REFERENCES songs(song_id), artist_id text REFERENCES artists(artist_id), session_id int, location text, user_agent text, loaded_at timestamp NOT NULL DEFAULT now(), PRIMARY KEY (songplay_id, start_time)) PARTITION BY RANGE (start_time)""")
+
+songplay_partition_create = ("""CREATE TABLE IF NOT EXISTS {name} PARTITION OF songplays FOR VALUES FROM ('{start}') TO ('{end}')""")
+
+# serializes partition creation of concurrent loaders until commit
+songplay_partition_lock = ("""SELECT pg_advisory_xact_lock(hashtext('songplays partitions'))""")
 
 user_table_create = ("""CREATE TABLE IF NOT EXISTS users (user_id int PRIMARY KEY, first_name text, last_name text, gender text NOT NULL, level text NOT NULL, last_start_time timestamp NOT NULL)""")
 
@@ -17,14 +31,37 @@ song_table_create = ("""CREATE TABLE IF NOT EXISTS songs (song_id text PRIMARY K
 
 artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (artist_id text PRIMARY KEY, name text NOT NULL, location text, lattitude float8, longitude float8)""")
 
-time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time timestamp PRIMARY KEY, hour int NOT NULL, day int NOT NULL, week int NOT NULL, month int NOT NULL, year int NOT NULL, weekday int NOT NULL)""")
+time_table_create = ("""CREATE TABLE IF NOT EXISTS time (start_time timestamp PRIMARY KEY, hour int NOT NULL, day int NOT NULL, week int NOT NULL, month int NOT NULL, year int NOT NULL, weekday int NOT NULL, loaded_at timestamp NOT NULL DEFAULT now())""")
+
+# files loaded by etl.py, used to skip unchanged files on later runs
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS etl_manifest (file_path text PRIMARY KEY, file_size bigint NOT NULL, mtime float8 NOT NULL, content_hash text NOT NULL, lines_read int NOT NULL, loaded_at timestamp NOT NULL DEFAULT now())""")
+
+# manifests created before the column was renamed counted JSON lines as rows_loaded
+manifest_table_migrate = ("""DO $$ BEGIN IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'etl_manifest' AND column_name = 'rows_loaded') THEN ALTER TABLE etl_manifest RENAME COLUMN rows_loaded TO lines_read; END IF; END $$""")
+
+# songplays and time created before loaded_at was added, the incremental export watermark;
+# rows already loaded get the time of the migration
+load_time_migrate = ("""DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'songplays' AND column_name = 'loaded_at') THEN ALTER TABLE songplays ADD COLUMN loaded_at timestamp NOT NULL DEFAULT now(); END IF; IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'time' AND column_name = 'loaded_at') THEN ALTER TABLE time ADD COLUMN loaded_at timestamp NOT NULL DEFAULT now(); END IF; END $$""")
+
+# per-stage statistics of etl.py runs
+etl_run_table_create = ("""CREATE TABLE IF NOT EXISTS etl_runs (run_id uuid, stage text, started_at timestamp NOT NULL, finished_at timestamp, calls int NOT NULL, seconds float8 NOT NULL, rows_in bigint NOT NULL, rows_out bigint NOT NULL, round_trips bigint NOT NULL, peak_memory_mb float8 NOT NULL, PRIMARY KEY (run_id, stage))""")
+
+# ROLLUP TABLES
+# maintained by the loader from newly inserted songplays, rebuilt by etl.py --backfill-rollups
+
+hourly_play_table_create = ("""CREATE TABLE IF NOT EXISTS hourly_plays (hour timestamp, level text, plays bigint NOT NULL, PRIMARY KEY (hour, level))""")
+
+# set of users active on each day, so that daily active users can be counted incrementally
+user_day_table_create = ("""CREATE TABLE IF NOT EXISTS user_days (day date, user_id int, PRIMARY KEY (day, user_id))""")
+
+daily_active_user_table_create = ("""CREATE TABLE IF NOT EXISTS daily_active_users (day date PRIMARY KEY, active_users int NOT NULL)""")
 
 # INSERT RECORDS
 
-songplay_table_insert = ("""INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (songplay_id) DO NOTHING""")
+songplay_table_insert = ("""INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""")
 
-# update free/paid level with latest value
-user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level, last_start_time) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (user_id) DO UPDATE SET level = (CASE WHEN EXCLUDED.last_start_time > users.last_start_time THEN EXCLUDED.level ELSE users.level END)""")
+# update free/paid level with latest value, in any order of arrival
+user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level, last_start_time) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (user_id) DO UPDATE SET level = (CASE WHEN EXCLUDED.last_start_time > users.last_start_time THEN EXCLUDED.level ELSE users.level END), last_start_time = GREATEST(EXCLUDED.last_start_time, users.last_start_time)""")
 
 song_table_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (song_id) DO NOTHING""")
 
@@ -33,11 +70,105 @@ artist_table_insert = ("""INSERT INTO artists (artist_id, name, location, lattit
 
 time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (start_time) DO NOTHING""")
 
+manifest_table_upsert = ("""INSERT INTO etl_manifest (file_path, file_size, mtime, content_hash, lines_read) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (file_path) DO UPDATE SET file_size = EXCLUDED.file_size, mtime = EXCLUDED.mtime, content_hash = EXCLUDED.content_hash, lines_read = EXCLUDED.lines_read, loaded_at = now()""")
+
+etl_run_table_insert = ("""INSERT INTO etl_runs (run_id, stage, started_at, finished_at, calls, seconds, rows_in, rows_out, round_trips, peak_memory_mb) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""")
+
+# BULK LOAD STAGING
+# session-scoped staging tables filled with COPY FROM STDIN and emptied on commit
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplay_staging (songplay_id uuid, start_time timestamp, user_id int, level text, song_id text, artist_id text, session_id int, location text, user_agent text) ON COMMIT DELETE ROWS""")
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS user_staging (user_id int, first_name text, last_name text, gender text, level text, last_start_time timestamp) ON COMMIT DELETE ROWS""")
+
+song_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS song_staging (song_id text, title text, artist_id text, year int, duration numeric) ON COMMIT DELETE ROWS""")
+
+artist_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS artist_staging (artist_id text, name text, location text, lattitude float8, longitude float8) ON COMMIT DELETE ROWS""")
+
+# songplays inserted by the current transaction, aggregated into the rollups before commit
+new_songplays_create = ("""CREATE TEMP TABLE IF NOT EXISTS new_songplays (start_time timestamp, user_id int, level text) ON COMMIT DELETE ROWS""")
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging (start_time timestamp, hour int, day int, week int, month int, year int, weekday int) ON COMMIT DELETE ROWS""")
+
+# emptied before every load as well, so a transaction loading several batches upserts each row once
+staging_truncate = ("""TRUNCATE {}""")
+
+# UPSERT FROM STAGING
+# rows are inserted in key order so that concurrent loaders lock keys in the same order
+
+songplay_table_upsert = ("""INSERT INTO songplays (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) SELECT songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM songplay_staging ORDER BY songplay_id ON CONFLICT DO NOTHING""")
+
+# keep the latest level per user within the batch, then apply the same rule as user_table_insert
+user_table_upsert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level, last_start_time) SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level, last_start_time FROM user_staging ORDER BY user_id, last_start_time DESC ON CONFLICT (user_id) DO UPDATE SET level = (CASE WHEN EXCLUDED.last_start_time > users.last_start_time THEN EXCLUDED.level ELSE users.level END), last_start_time = GREATEST(EXCLUDED.last_start_time, users.last_start_time)""")
+
+song_table_upsert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) SELECT song_id, title, artist_id, year, duration FROM song_staging ORDER BY song_id ON CONFLICT (song_id) DO NOTHING""")
+
+artist_table_upsert = ("""INSERT INTO artists (artist_id, name, location, lattitude, longitude) SELECT artist_id, name, location, lattitude, longitude FROM artist_staging ORDER BY artist_id ON CONFLICT (artist_id) DO NOTHING""")
+
+time_table_upsert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) SELECT start_time, hour, day, week, month, year, weekday FROM time_staging ORDER BY start_time ON CONFLICT (start_time) DO NOTHING""")
+
+# songplay inserts that record the rows they insert in new_songplays
+new_songplays_capture = ("""WITH inserted AS ({} RETURNING start_time, user_id, level) INSERT INTO new_songplays (start_time, user_id, level) SELECT start_time, user_id, level FROM inserted""")
+songplay_table_insert_tracked = new_songplays_capture.format(songplay_table_insert)
+songplay_table_upsert_tracked = new_songplays_capture.format(songplay_table_upsert)
+
+# REFRESH ROLLUPS
+
+hourly_plays_refresh = ("""INSERT INTO hourly_plays (hour, level, plays) SELECT date_trunc('hour', start_time), level, count(*) FROM new_songplays GROUP BY 1, 2 ORDER BY 1, 2 ON CONFLICT (hour, level) DO UPDATE SET plays = hourly_plays.plays + EXCLUDED.plays""")
+
+# only (day, user) pairs not seen before add to the daily count
+daily_active_users_refresh = ("""WITH new_days AS (INSERT INTO user_days (day, user_id) SELECT DISTINCT start_time::date, user_id FROM new_songplays ORDER BY 1, 2 ON CONFLICT DO NOTHING RETURNING day) INSERT INTO daily_active_users (day, active_users) SELECT day, count(*) FROM new_days GROUP BY day ORDER BY day ON CONFLICT (day) DO UPDATE SET active_users = daily_active_users.active_users + EXCLUDED.active_users""")
+
+rollup_truncate = ("""TRUNCATE hourly_plays, user_days, daily_active_users""")
+
+hourly_plays_backfill = ("""INSERT INTO hourly_plays (hour, level, plays) SELECT date_trunc('hour', start_time), level, count(*) FROM songplays GROUP BY 1, 2""")
+
+user_days_backfill = ("""INSERT INTO user_days (day, user_id) SELECT DISTINCT start_time::date, user_id FROM songplays""")
+
+daily_active_users_backfill = ("""INSERT INTO daily_active_users (day, active_users) SELECT day, count(*) FROM user_days GROUP BY day""")
+
 # FIND SONGS
 
 song_select = ("""SELECT s.song_id, a.artist_id FROM songs s LEFT JOIN artists a ON s.artist_id = a.artist_id WHERE s.title = %s AND a.name = %s AND s.duration = %s""")
 
+manifest_select = ("""SELECT file_path, file_size, mtime, content_hash FROM etl_manifest""")
+
+# whether songplays is partitioned, and the names of its partitions
+songplay_partitions_select = ("""SELECT c.relkind = 'p', ARRAY(SELECT p.relname FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhrelid WHERE i.inhparent = c.oid) FROM pg_class c WHERE c.oid = 'songplays'::regclass""")
+
+# all songs with artist name for the in-memory song index
+song_index_select = ("""SELECT s.song_id, s.title, a.artist_id, a.name, s.duration FROM songs s JOIN artists a ON s.artist_id = a.artist_id""")
+
+# BULK LOAD SCHEMA
+# unlogged tables without keys, loaded once with COPY and then finalized
+
+songplay_table_create_unlogged = ("""CREATE UNLOGGED TABLE IF NOT EXISTS songplays (songplay_id uuid NOT NULL, start_time timestamp NOT NULL, user_id int NOT NULL, level text, song_id text, artist_id text, session_id int, location text, user_agent text, loaded_at timestamp NOT NULL DEFAULT now())""")
+
+user_table_create_unlogged = ("""CREATE UNLOGGED TABLE IF NOT EXISTS users (user_id int NOT NULL, first_name text, last_name text, gender text NOT NULL, level text NOT NULL, last_start_time timestamp NOT NULL)""")
+
+song_table_create_unlogged = ("""CREATE UNLOGGED TABLE IF NOT EXISTS songs (song_id text NOT NULL, title text NOT NULL, artist_id text NOT NULL, year int NOT NULL, duration numeric)""")
+
+artist_table_create_unlogged = ("""CREATE UNLOGGED TABLE IF NOT EXISTS artists (artist_id text NOT NULL, name text NOT NULL, location text, lattitude float8, longitude float8)""")
+
+time_table_create_unlogged = ("""CREATE UNLOGGED TABLE IF NOT EXISTS time (start_time timestamp NOT NULL, hour int NOT NULL, day int NOT NULL, week int NOT NULL, month int NOT NULL, year int NOT NULL, weekday int NOT NULL, loaded_at timestamp NOT NULL DEFAULT now())""")
+
+# keys and foreign keys named as in the regular schema, one ALTER per table
+user_table_constraints = ("""ALTER TABLE users ADD CONSTRAINT users_pkey PRIMARY KEY (user_id)""")
+song_table_constraints = ("""ALTER TABLE songs ADD CONSTRAINT songs_pkey PRIMARY KEY (song_id)""")
+artist_table_constraints = ("""ALTER TABLE artists ADD CONSTRAINT artists_pkey PRIMARY KEY (artist_id)""")
+time_table_constraints = ("""ALTER TABLE time ADD CONSTRAINT time_pkey PRIMARY KEY (start_time)""")
+songplay_table_constraints = ("""ALTER TABLE songplays ADD CONSTRAINT songplays_pkey PRIMARY KEY (songplay_id), ADD CONSTRAINT songplays_start_time_fkey FOREIGN KEY (start_time) REFERENCES time(start_time), ADD CONSTRAINT songplays_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(user_id), ADD CONSTRAINT songplays_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs(song_id), ADD CONSTRAINT songplays_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists(artist_id)""")
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+rollup_table_queries = [hourly_play_table_create, user_day_table_create, daily_active_user_table_create]
+rollup_refresh_queries = [hourly_plays_refresh, daily_active_users_refresh]
+rollup_backfill_queries = [rollup_truncate, hourly_plays_backfill, user_days_backfill, daily_active_users_backfill]
+create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, manifest_table_create, etl_run_table_create] + rollup_table_queries
+partitioned_create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create_partitioned, manifest_table_create, etl_run_table_create] + rollup_table_queries
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop, etl_run_table_drop, hourly_play_table_drop, user_day_table_drop, daily_active_user_table_drop]
+bulk_create_table_queries = [user_table_create_unlogged, song_table_create_unlogged, artist_table_create_unlogged, time_table_create_unlogged, songplay_table_create_unlogged, manifest_table_create, etl_run_table_create] + rollup_table_queries
+# referenced tables first: a logged table may not reference an unlogged one
+bulk_load_tables = ['users', 'songs', 'artists', 'time', 'songplays']
+constraint_queries = [user_table_constraints, song_table_constraints, artist_table_constraints, time_table_constraints, songplay_table_constraints]
+staging_table_queries = [songplay_staging_create, user_staging_create, song_staging_create, artist_staging_create, time_staging_create, new_songplays_create]
@@ -0,0 +1,89 @@
+import json
+import uuid
+import pandas as pd
+import pytest
+from etl import songplay_ids, select_songplays, parse_song_batch, parse_log_batch, partition_queries
+from sql_queries import songplay_partition_lock
+from song_index import SongIndex
+
+
+def event(ts, level, user_id='39', song='Setanta matins'):
+    return {'artist': 'Elena', 'auth': 'Logged In', 'firstName': 'Walter', 'gender': 'M', 'itemInSession': 0,
+            'lastName': 'Frye', 'length': 269.58322, 'level': level, 'location': 'San Francisco', 'method': 'PUT',
+            'page': 'NextSong', 'registration': 1540919166796.0, 'sessionId': 38, 'song': song, 'status': 200,
+            'ts': ts, 'userAgent': 'Mozilla', 'userId': user_id}
+
+
+def write_events(path, events):
+    path.write_text(''.join(json.dumps(e) + '\n' for e in events))
+    return str(path)
+
+
+def test_songplay_ids_are_uuid5_of_song_ts_and_user():
+    song = pd.Series(['Setanta matins'])
+    ts = pd.Series(pd.to_datetime([1541106106796], unit='ms'))
+    user_id = pd.Series([39])
+
+    expected = uuid.uuid5(uuid.UUID(int=0), 'Setanta matins2018-11-01 21:01:46.79600039')
+    assert songplay_ids(song, ts, user_id) == [str(expected)]
+
+
+
+def test_batch_keeps_the_level_of_each_users_latest_event(tmp_path):
+    # the later file is read first, and both files repeat a timestamp
+    later = write_events(tmp_path / 'later.json', [event(1541106106796, 'paid'), event(1541106100000, 'free')])
+    earlier = write_events(tmp_path / 'earlier.json', [event(1541000000000, 'free'),
+                                                       event(1541106100000, 'free', song='other')])
+
+    time_df, user_df, songplay_df = parse_log_batch([later, earlier], SongIndex())
+
+    assert user_df[['user_id', 'level']].values.tolist() == [[39, 'paid']]
+    assert user_df['last_start_time'].iloc[0] == pd.Timestamp(1541106106796, unit='ms')
+    assert len(time_df) == 3
+    assert len(songplay_df) == 4
+
+
+def test_songplay_ids_keep_user_ids_integral():
+    df = select_songplays(pd.DataFrame({'page': ['NextSong', 'NextSong'], 'ts': [1541106106796, 1541106106796],
+                                        'userId': ['39', ''], 'song': ['a', 'a']}))
+    ids = songplay_ids(df['song'], df['ts'], df['userId'])
+
+    assert ids[0] == str(uuid.uuid5(uuid.UUID(int=0), 'a2018-11-01 21:01:46.79600039'))
+    assert ids[0] != ids[1]
+
+
+def test_batches_without_records(tmp_path):
+    empty = write_events(tmp_path / 'empty.json', [])
+
+    song_df, artist_df = parse_song_batch([empty])
+    time_df, user_df, songplay_df = parse_log_batch([empty], SongIndex())
+
+    assert song_df.empty and artist_df.empty
+    assert time_df.empty and user_df.empty and songplay_df.empty
+
+
+@pytest.mark.parametrize('partitions, start_times', [
+    ((False, []), pd.Series(pd.to_datetime(['2018-11-05']))),
+    ((True, []), pd.Series([], dtype='datetime64[ns]')),
+])
+def test_partition_queries_empty_without_partitions_or_rows(partitions, start_times):
+    assert partition_queries(partitions, start_times) == []
+
+
+def test_partition_queries_create_missing_months_under_lock():
+    start_times = pd.Series(pd.to_datetime(['2018-12-31 23:59', '2018-11-05', '2019-01-01', '2018-11-30']))
+
+    queries = partition_queries((True, ['songplays_y2018m11']), start_times)
+
+    assert queries[0] == songplay_partition_lock
+    assert queries[1:] == [
+        "CREATE TABLE IF NOT EXISTS songplays_y2018m12 PARTITION OF songplays "
+        "FOR VALUES FROM ('2018-12-01') TO ('2019-01-01')",
+        "CREATE TABLE IF NOT EXISTS songplays_y2019m01 PARTITION OF songplays "
+        "FOR VALUES FROM ('2019-01-01') TO ('2019-02-01')",
+    ]
+
+
+def test_partition_queries_nothing_missing():
+    start_times = pd.Series(pd.to_datetime(['2018-11-05']))
+    assert partition_queries((True, ['songplays_y2018m11']), start_times) == []
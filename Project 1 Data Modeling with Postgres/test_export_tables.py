@@ -0,0 +1,85 @@
+import os
+import psycopg2
+import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
+import export_tables
+from etl import DSN
+from export_tables import ParquetSink, export_table
+
+COLUMNS = [('id', pa.int32()), ('note', pa.string()), ('start_time', pa.timestamp('us'))]
+
+
+def read_rows(directory):
+    return sorted(pq.read_table(directory).select(['id', 'note']).to_pylist(), key=lambda row: row['id'])
+
+
+def test_sink_cuts_chunks_only_after_complete_rows(tmp_path):
+    data = (b'1,"two\nlines",2018-11-01 10:00:00\n'
+            b'2,"quoted ""comma"", and\nnewline",2018-11-02 10:00:00\n'
+            b'3,,2018-11-03 10:00:00\n')
+    sink = ParquetSink(str(tmp_path), COLUMNS, 'a', chunk_bytes=8)
+    for i in range(0, len(data), 5):
+        sink.write(data[i:i + 5])
+    sink.close()
+
+    assert sink.rows == 3
+    assert read_rows(str(tmp_path)) == [{'id': 1, 'note': 'two\nlines'},
+                                        {'id': 2, 'note': 'quoted "comma", and\nnewline'},
+                                        {'id': 3, 'note': None}]
+    assert pq.ParquetFile(str(tmp_path / 'part-a.parquet')).num_row_groups > 1
+
+
+def test_sink_writes_rows_to_the_partition_of_their_month(tmp_path):
+    sink = ParquetSink(str(tmp_path), COLUMNS, 'a', partition_column='start_time')
+    sink.write(b'1,a,2018-11-30 23:59:59\n2,b,2018-12-01 00:00:00\n3,c,2018-11-01 00:00:00\n')
+    sink.close()
+
+    assert [row['id'] for row in read_rows(str(tmp_path / 'year=2018' / 'month=11'))] == [1, 3]
+    assert [row['id'] for row in read_rows(str(tmp_path / 'year=2018' / 'month=12'))] == [2]
+
+
+@pytest.fixture
+def loaded_table(monkeypatch):
+    """Table of sparkifydb with a load time watermark column, skipped without a database."""
+    try:
+        conn = psycopg2.connect(DSN)
+    except psycopg2.OperationalError:
+        pytest.skip('sparkifydb is not available')
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS export_test")
+    cur.execute("CREATE TABLE export_test (id int, note text, start_time timestamp, "
+                "loaded_at timestamp NOT NULL DEFAULT now())")
+    monkeypatch.setitem(export_tables.WATERMARK_COLUMNS, 'export_test', 'loaded_at')
+    yield cur
+    cur.execute("DROP TABLE export_test")
+    conn.close()
+
+
+def test_export_only_writes_rows_loaded_between_watermark_and_horizon(loaded_table, tmp_path):
+    loaded_table.execute("INSERT INTO export_test (id, start_time, loaded_at) VALUES "
+                         "(1, '2018-11-01', '2018-11-01'), (2, '2018-11-05', '2018-11-06'), "
+                         "(3, '2018-11-02', '2018-11-07')")
+
+    rows, watermark = export_table(DSN, 'export_test', str(tmp_path), 'a', horizon='2018-11-06')
+    assert (rows, watermark) == (1, '2018-11-06')
+
+    rows, watermark = export_table(DSN, 'export_test', str(tmp_path), 'b', watermark, '2018-11-07', True)
+    assert (rows, watermark) == (1, '2018-11-07')
+    assert [row['id'] for row in read_rows(str(tmp_path / 'export_test'))] == [1, 2]
+
+    # full exports replace the earlier files
+    assert export_table(DSN, 'export_test', str(tmp_path), 'c', horizon='2018-11-08')[0] == 3
+    assert sorted(os.listdir(str(tmp_path / 'export_test'))) == ['part-c.parquet']
+
+
+def test_incremental_export_picks_up_rows_loaded_after_the_last_export(loaded_table, tmp_path):
+    loaded_table.execute("INSERT INTO export_test (id, start_time) VALUES (1, '2018-11-30')")
+    assert export_tables.export_tables(DSN, str(tmp_path), ['export_test']) == {'export_test': 1}
+
+    # a late row of an earlier month, selected by its load time
+    loaded_table.execute("INSERT INTO export_test (id, start_time) VALUES (2, '2018-11-05')")
+    assert export_tables.export_tables(DSN, str(tmp_path), ['export_test'], incremental=True) == {'export_test': 1}
+    assert export_tables.export_tables(DSN, str(tmp_path), ['export_test'], incremental=True) == {'export_test': 0}
+    assert [row['id'] for row in read_rows(str(tmp_path / 'export_test'))] == [1, 2]
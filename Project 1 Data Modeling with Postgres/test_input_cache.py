@@ -0,0 +1,65 @@
+import os
+import pytest
+from input_cache import InputCache
+
+pa = pytest.importorskip('pyarrow')
+
+
+def write_file(path, records):
+    path.write_text(''.join('{{"song_id": "S{}"}}\n'.format(i) for i in records))
+    return str(path)
+
+
+def cache_files(cache):
+    return sorted(entry.name for entry in os.scandir(cache.directory) if entry.name.endswith('.arrow'))
+
+
+def test_read_batch_caches_each_file_and_reads_it_back(tmp_path):
+    cache = InputCache(str(tmp_path / 'cache'), 2 ** 20)
+    first = write_file(tmp_path / 'first.json', [1, 2])
+    second = write_file(tmp_path / 'second.json', [3])
+
+    assert cache.read_batch([first, second])['song_id'].tolist() == ['S1', 'S2', 'S3']
+    assert cache.get(cache.path(second)).column('song_id').to_pylist() == ['S3']
+
+
+def test_changed_files_get_a_new_key(tmp_path):
+    cache = InputCache(str(tmp_path / 'cache'), 2 ** 20)
+    first = write_file(tmp_path / 'first.json', [1])
+    cache.read_batch([first])
+    old_path = cache.path(first)
+
+    write_file(tmp_path / 'first.json', [1, 2])
+
+    assert cache.path(first) != old_path
+    assert cache.read_batch([first])['song_id'].tolist() == ['S1', 'S2']
+
+
+def test_evict_removes_least_recently_used_files(tmp_path):
+    cache = InputCache(str(tmp_path / 'cache'), 2 ** 20)
+    files = [write_file(tmp_path / '{}.json'.format(i), [i]) for i in range(3)]
+    cache.read_batch(files)
+    paths = [cache.path(f) for f in files]
+    for age, cache_path in zip([300, 100, 200], paths):
+        os.utime(cache_path, (1e9 - age, 1e9 - age))
+    size = os.path.getsize(paths[0])
+
+    # reading a file makes it the most recently used
+    cache.get(paths[0])
+    cache.max_bytes = 2 * size
+    cache.evict()
+
+    assert cache_files(cache) == sorted(os.path.basename(p) for p in [paths[0], paths[1]])
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache_files(cache) == []
+
+
+def test_batches_without_records(tmp_path):
+    cache = InputCache(str(tmp_path / 'cache'), 2 ** 20)
+    empty = tmp_path / 'empty.json'
+    empty.write_text('')
+
+    assert cache.read_batch([str(empty)]).empty
+    assert cache.read_batch([str(empty)]).empty
@@ -0,0 +1,56 @@
+import hashlib
+import pytest
+import json_reader
+from json_reader import read_json_batch, join_records, take_digest
+
+SONG = (b'{"num_songs": 1, "artist_id": "AR1", "artist_name": "Elena", "song_id": "S1", "title": "Song", '
+        b'"duration": 269.58322, "year": 0}\n')
+
+
+@pytest.fixture
+def song_files(tmp_path):
+    first = tmp_path / 'first.json'
+    first.write_bytes(SONG)
+    second = tmp_path / 'second.json'
+    second.write_bytes(SONG.replace(b'S1', b'S2').rstrip(b'\n'))
+    empty = tmp_path / 'empty.json'
+    empty.write_bytes(b'')
+    return [str(first), str(empty), str(second)]
+
+
+@pytest.mark.parametrize('engine', ['arrow', 'json'])
+def test_read_json_batch_returns_records_of_all_files(song_files, engine):
+    df = read_json_batch(song_files, engine=engine)
+
+    assert df['song_id'].tolist() == ['S1', 'S2']
+    assert df['duration'].tolist() == [269.58322, 269.58322]
+
+
+@pytest.mark.parametrize('engine', ['arrow', 'json'])
+def test_read_json_batch_without_records(tmp_path, engine):
+    empty = tmp_path / 'empty.json'
+    empty.write_bytes(b'\n')
+
+    assert read_json_batch(str(empty), engine=engine).empty
+
+
+def test_join_records_skips_empty_files():
+    assert join_records([b'{"a": 1}\n', b'', b'  \n', b'{"a": 2}']) == b'{"a": 1}\n{"a": 2}'
+
+
+def test_read_json_batch_remembers_digests_until_taken(song_files):
+    read_json_batch(song_files[:1], engine='json')
+
+    assert take_digest(song_files[0]) == (hashlib.sha256(SONG).hexdigest(), 1)
+    assert take_digest(song_files[0]) is None
+
+
+def test_read_json_batch_reads_through_the_cache_with_arrow(song_files, monkeypatch):
+    class Cache:
+        def read_batch(self, filepaths, threads):
+            return filepaths
+
+    monkeypatch.setattr(json_reader, '_cache', Cache())
+
+    assert read_json_batch(song_files, engine='arrow') == song_files
+    assert read_json_batch(song_files[:1], engine='json')['song_id'].tolist() == ['S1']
@@ -0,0 +1,48 @@
+import pandas as pd
+from song_index import SongIndex, normalize_keys
+
+
+def index_of(*songs):
+    index = SongIndex()
+    index.add(pd.DataFrame([song[:4] + (song[5],) for song in songs],
+                           columns=['song_id', 'title', 'artist_id', 'year', 'duration']),
+              pd.DataFrame([(song[2], song[4]) for song in songs], columns=['artist_id', 'name']))
+    return index
+
+
+def test_normalize_keys_strips_lowers_and_rounds():
+    keys = normalize_keys(pd.Series([' Setanta Matins ']), pd.Series(['Elena ']), pd.Series(['269.58322999']))
+
+    assert keys.iloc[0].tolist() == ['setanta matins', 'elena', 269.58323]
+
+
+def test_resolve_matches_title_artist_and_duration():
+    index = index_of(('SOZCTXZ12AB0182364', 'Setanta matins', 'AR5KOSW1187FB35FF4', 0, 'Elena', 269.58322))
+    events = pd.Series(['x', 'SETANTA MATINS', 'Setanta matins'], index=[10, 11, 12])
+
+    ids = index.resolve(events, pd.Series(['Elena', ' elena', 'Elena'], index=events.index),
+                        pd.Series([269.58322, 269.58322, 200.0], index=events.index))
+
+    assert ids.index.tolist() == [10, 11, 12]
+    assert ids.loc[11].tolist() == ['SOZCTXZ12AB0182364', 'AR5KOSW1187FB35FF4']
+    assert ids.loc[10].tolist() == [None, None]
+    assert ids.loc[12].tolist() == [None, None]
+
+
+def test_first_song_of_a_key_wins():
+    index = index_of(('S1', 'Song', 'A1', 0, 'Artist', 100.0))
+    index.add(pd.DataFrame([('S2', 'Song', 'A1', 0, 100.0)],
+                           columns=['song_id', 'title', 'artist_id', 'year', 'duration']),
+              pd.DataFrame([('A1', 'Artist')], columns=['artist_id', 'name']))
+
+    ids = index.resolve(pd.Series(['Song']), pd.Series(['Artist']), pd.Series([100.0]))
+
+    assert len(index) == 1
+    assert ids.iloc[0]['song_id'] == 'S1'
+
+
+def test_empty_index_resolves_nothing():
+    ids = SongIndex().resolve(pd.Series(['Song']), pd.Series(['Artist']), pd.Series([100.0]))
+
+    assert len(SongIndex()) == 0
+    assert ids.iloc[0].tolist() == [None, None]
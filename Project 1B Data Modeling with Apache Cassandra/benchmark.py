@@ -0,0 +1,328 @@
+import os
+import re
+import csv
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+import pandas as pd
+from cassandra.cluster import Cluster
+from cql_queries import create_table_queries, drop_table_queries
+import etl
+from event_data import get_event_files, write_event_datafile
+from stand_in import StandInSession
+
+
+RAW_HEADER = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+              'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userId']
+FIRST_NAMES = ['Kate', 'Walter', 'Kaylee', 'Jacob', 'Lily', 'Sylvie', 'Tegan', 'Sara', 'Ryan', 'Jayden']
+LAST_NAMES = ['Harrell', 'Frye', 'Summers', 'Klein', 'Koch', 'Cruz', 'Levine', 'Johnson', 'Smith', 'Lynch']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'Lansing-East Lansing, MI',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA']
+OTHER_PAGES = ['Home', 'Logout', 'Settings', 'About', 'Help']
+
+# loaders compared by the benchmark and what each of them runs
+LOAD_MODES = {
+    'notebook': "the notebook's original cells: one pass over the file per table, one string INSERT per row",
+    'concurrency-1': 'etl.load_tables with prepared statements and a single statement in flight',
+    'concurrent': 'etl.load_tables with prepared statements and up to --concurrency statements in flight',
+}
+
+
+def generate_events(data_dir, num_events, num_users, num_songs, num_days, start=datetime(2018, 11, 1)):
+    """Write one csv file per day in the layout of event_data.
+
+    Parameters:
+    data_dir (string): directory of the generated event files
+    num_events (int): number of events across all days
+    num_users (int): number of distinct users
+    num_songs (int): number of distinct songs
+    num_days (int): number of daily event files
+    start (datetime): date of the first event file
+
+    Returns: None
+
+    """
+    users = [{'userId': i + 1,
+              'firstName': random.choice(FIRST_NAMES),
+              'lastName': random.choice(LAST_NAMES),
+              'gender': random.choice('MF'),
+              'level': random.choice(['free', 'paid']),
+              'location': random.choice(LOCATIONS),
+              'registration': '{:.5E}'.format(1540000000000.0 + i)}
+             for i in range(num_users)]
+    songs = [('Song {}'.format(i), 'Artist {}'.format(i % max(1, num_songs // 2)), round(random.uniform(60, 600), 5))
+             for i in range(num_songs)]
+
+    os.makedirs(data_dir, exist_ok=True)
+    events_per_day = max(1, num_events // num_days)
+    session_id = 0
+    for day in range(num_days):
+        date = start + timedelta(days=day)
+        ts = date.timestamp() * 1000
+        with open(os.path.join(data_dir, date.strftime('%Y-%m-%d-events.csv')), 'w', encoding='utf8',
+                  newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(RAW_HEADER)
+            for i in range(events_per_day):
+                if i % 20 == 0:
+                    user = random.choice(users)
+                    session_id += 1
+                    item = 0
+                ts += random.randint(1, 120000)
+
+                if random.random() < 0.8:
+                    song, artist, length = random.choice(songs)
+                    page, method = 'NextSong', 'PUT'
+                else:
+                    song, artist, length = '', '', ''
+                    page, method = random.choice(OTHER_PAGES), 'GET'
+                writer.writerow([artist, 'Logged In', user['firstName'], user['gender'], item, user['lastName'],
+                                 length, user['level'], user['location'], method, page, user['registration'],
+                                 session_id, song, 200, '{:.5E}'.format(ts), user['userId']])
+                item += 1
+
+
+class TimedSession:
+    """Session wrapper recording the latency of every request by table."""
+
+    def __init__(self, session):
+        self.session = session
+        self.latencies = {}
+        self._tables = {}
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def prepare(self, query):
+        prepared = self.session.prepare(query)
+        self._tables[prepared.query_id] = re.search(r'INSERT INTO (\w+)', query).group(1)
+        return prepared
+
+    def execute_async(self, query, parameters=None, **kwargs):
+        if hasattr(query, 'prepared_statement'):
+            query_id = query.prepared_statement.query_id
+        elif hasattr(query, '_statements_and_parameters'):
+            query_id = query._statements_and_parameters[0][1]
+        else:
+            query_id = query.query_id
+        latencies = self.latencies.setdefault(self._tables[query_id], [])
+
+        start = time.perf_counter()
+        future = self.session.execute_async(query, parameters, **kwargs)
+        # registered before the callbacks of execute_concurrent, which clear them
+        future.add_callbacks(self._record, self._record, callback_args=(latencies, start),
+                             errback_args=(latencies, start))
+        return future
+
+    def _record(self, result, latencies, start):
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values in milliseconds, None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+
+def connect(hosts, latency, jitter):
+    """Return session of a cluster, or of the in-process stand-in if no hosts are given."""
+    if hosts:
+        cluster = Cluster(hosts)
+        return cluster.connect()
+    return StandInSession(latency, jitter)
+
+
+def consolidate(data_dir, output, workers):
+    """Consolidate generated event files and return the stage result."""
+    files = get_event_files(data_dir)
+    start = time.perf_counter()
+    rows = write_event_datafile(files, output, workers)
+    elapsed = time.perf_counter() - start
+    return {
+        'mode': 'consolidate',
+        'table': os.path.basename(output),
+        'rows': rows,
+        'statements': None,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed, 1),
+        'p50_ms': None,
+        'p95_ms': None,
+        'p99_ms': None,
+    }
+
+
+def read_lines(datafile):
+    """Yield the rows of a consolidated event csv file as lists of strings, skipping its header."""
+    with open(datafile, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        yield from csvreader
+
+
+def notebook_song_rows(datafile):
+    """Yield the parameters of the notebook's songs inserts."""
+    for line in read_lines(datafile):
+        yield int(line[8]), int(line[3]), line[0], line[9], float(line[5])
+
+
+def notebook_user_session_rows(datafile):
+    """Yield the parameters of the notebook's user_sessions inserts."""
+    for line in read_lines(datafile):
+        yield int(line[10]), int(line[8]), int(line[3]), line[0], line[9], line[1], line[4]
+
+
+def notebook_song_user_rows(datafile):
+    """Yield the parameters of the notebook's song_users inserts, deduplicated with pandas first."""
+    df = pd.read_csv(datafile, usecols=[1, 4, 9, 10])
+    df.drop_duplicates(inplace=True)
+    for ix, row in df.iterrows():
+        yield row['song'], row['userId'], row['firstName'], row['lastName']
+
+
+# table: (string INSERT of the notebook, generator of its parameters)
+NOTEBOOK_INSERTS = {
+    'songs': ("INSERT INTO songs (session_id, item_in_session, artist, song, length) VALUES (%s, %s, %s, %s, %s)",
+              notebook_song_rows),
+    'user_sessions': ("INSERT INTO user_sessions (user_id, session_id, item_in_session, artist, song, first_name, "
+                      "last_name) VALUES (%s, %s, %s, %s, %s, %s, %s)", notebook_user_session_rows),
+    'song_users': ("INSERT INTO song_users (song, user_id, first_name, last_name) VALUES (%s, %s, %s, %s)",
+                   notebook_song_user_rows),
+}
+
+
+def load_notebook(session, datafile):
+    """Load the query tables like the notebook did before etl.py, the baseline of the benchmark.
+
+    Each table reads the file once and sends one string INSERT per row
+    with session.execute, waiting for each before the next.
+
+    Parameters:
+    session (Session): session of a cluster or stand-in with the sparkify keyspace set
+    datafile (string): consolidated event csv file
+
+    Returns: list of dictionaries with rows, statements, seconds and rows_per_sec of each table, and dictionary
+        of request latencies by table
+
+    """
+    latencies = {}
+    start = time.perf_counter()
+    for table, (query, rows) in NOTEBOOK_INSERTS.items():
+        table_latencies = latencies.setdefault(table, [])
+        for params in rows(datafile):
+            request_start = time.perf_counter()
+            session.execute(query, params)
+            table_latencies.append(time.perf_counter() - request_start)
+    seconds = time.perf_counter() - start
+
+    # like load_tables, the seconds of every table are those of the whole load
+    return [{
+        'table': table,
+        'rows': len(table_latencies),
+        'statements': len(table_latencies),
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(len(table_latencies) / seconds, 1) if seconds else None,
+    } for table, table_latencies in latencies.items()], latencies
+
+
+def run_mode(session, datafile, mode, concurrency, batch_size):
+    """Recreate the query tables and load the consolidated file with one loader mode.
+
+    The notebook mode is the baseline the prepared loader is compared
+    with. Concurrency-1 mode runs the prepared loader with one statement
+    in flight, so its throughput is bounded by the latency like the
+    notebook's, but without formatting a string per row.
+
+    Parameters:
+    session (Session): session of a cluster or stand-in
+    datafile (string): consolidated event csv file
+    mode (string): loader mode in LOAD_MODES
+    concurrency (int): statements in flight in concurrent mode
+    batch_size (int): rows per unlogged partition batch in concurrent mode, 0 to disable
+
+    Returns: list of result dictionaries, one per table
+
+    """
+    for query in drop_table_queries + create_table_queries:
+        session.execute(query)
+
+    if mode == 'notebook':
+        stats, latencies = load_notebook(session, datafile)
+    else:
+        timed = TimedSession(session)
+        if mode == 'concurrency-1':
+            stats = etl.load_tables(timed, etl.read_event_datafile(datafile), concurrency=1)
+        else:
+            stats = etl.load_tables(timed, etl.read_event_datafile(datafile), concurrency=concurrency,
+                                    batch_size=batch_size)
+        latencies = timed.latencies
+
+    results = []
+    for table_stats in stats:
+        table_latencies = latencies.get(table_stats['table'], [])
+        results.append(dict(table_stats, mode=mode, p50_ms=percentile(table_latencies, 50),
+                            p95_ms=percentile(table_latencies, 95), p99_ms=percentile(table_latencies, 99)))
+    return results
+
+
+def print_results(results):
+    """Print benchmark results as a table."""
+    columns = ['mode', 'table', 'rows', 'statements', 'seconds', 'rows_per_sec', 'p50_ms', 'p95_ms', 'p99_ms']
+    print(' '.join('{:>20}'.format(c) for c in columns))
+    for result in results:
+        print(' '.join('{:>20}'.format(str(result[c])) for c in columns))
+    print()
+    for mode in LOAD_MODES:
+        if any(result['mode'] == mode for result in results):
+            print('{}: {}'.format(mode, LOAD_MODES[mode]))
+
+
+def main():
+    """Generate synthetic event data and benchmark consolidation and the Cassandra loader."""
+    parser = argparse.ArgumentParser(description='Benchmark the Cassandra loader on synthetic event data.')
+    parser.add_argument('--data-dir', default='bench_data', help='directory of the generated data')
+    parser.add_argument('--generate', action='store_true', help='generate new event files first')
+    parser.add_argument('--events', type=int, default=20000, help='number of events')
+    parser.add_argument('--users', type=int, default=100, help='number of users')
+    parser.add_argument('--songs', type=int, default=5000, help='number of songs')
+    parser.add_argument('--days', type=int, default=30, help='number of daily event files')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the generator')
+    parser.add_argument('--workers', type=int, default=1, help='processes consolidating event files')
+    parser.add_argument('--modes', nargs='+', default=list(LOAD_MODES), choices=list(LOAD_MODES),
+                        help='loader modes')
+    parser.add_argument('--concurrency', type=int, default=100, help='statements in flight in concurrent mode')
+    parser.add_argument('--batch-size', type=int, default=0, help='rows per partition batch in concurrent mode')
+    parser.add_argument('--hosts', nargs='+', help='contact points of a cluster, the stand-in is used without')
+    parser.add_argument('--latency', type=float, default=1.0, help='milliseconds per request of the stand-in')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='maximum random milliseconds added to the stand-in latency')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    event_dir = os.path.join(args.data_dir, 'event_data')
+    if args.generate:
+        random.seed(args.seed)
+        generate_events(event_dir, args.events, args.users, args.songs, args.days)
+
+    datafile = os.path.join(args.data_dir, 'event_datafile_new.csv')
+    results = [consolidate(event_dir, datafile, args.workers)]
+
+    session = connect(args.hosts, args.latency / 1000, args.jitter / 1000)
+    etl.create_tables(session)
+    for mode in args.modes:
+        results.extend(run_mode(session, datafile, mode, args.concurrency, args.batch_size))
+    session.shutdown()
+    if args.hosts:
+        session.cluster.shutdown()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# KEYSPACE
+
+keyspace_create = ("""CREATE KEYSPACE IF NOT EXISTS sparkify WITH REPLICATION = { 'class' : 'SimpleStrategy', 'replication_factor' : 1 }""")
+
+# DROP TABLES
+
+song_table_drop = "DROP TABLE IF EXISTS songs"
+user_session_table_drop = "DROP TABLE IF EXISTS user_sessions"
+song_user_table_drop = "DROP TABLE IF EXISTS song_users"
+
+# CREATE TABLES
+
+# query 1: artist, song and length by session_id and item_in_session
+song_table_create = ("""CREATE TABLE IF NOT EXISTS songs (session_id int, item_in_session int, artist text, song text, length double, PRIMARY KEY (session_id, item_in_session))""")
+
+# query 2: artist, song and user name by user_id and session_id, sorted by item_in_session
+user_session_table_create = ("""CREATE TABLE IF NOT EXISTS user_sessions (user_id int, session_id int, item_in_session int, artist text, song text, first_name text, last_name text, PRIMARY KEY ((user_id, session_id), item_in_session))""")
+
+# query 3: user names by song
+song_user_table_create = ("""CREATE TABLE IF NOT EXISTS song_users (song text, user_id int, first_name text, last_name text, PRIMARY KEY (song, user_id))""")
+
+# INSERT RECORDS
+# prepared once per session, partition key columns first
+
+song_table_insert = ("""INSERT INTO songs (session_id, item_in_session, artist, song, length) VALUES (?, ?, ?, ?, ?)""")
+
+user_session_table_insert = ("""INSERT INTO user_sessions (user_id, session_id, item_in_session, artist, song, first_name, last_name) VALUES (?, ?, ?, ?, ?, ?, ?)""")
+
+song_user_table_insert = ("""INSERT INTO song_users (song, user_id, first_name, last_name) VALUES (?, ?, ?, ?)""")
+
+# SELECT RECORDS
+# prepared once per session, restricted by the primary key of each table
+
+# query 1: artist, song and length of an item in a session
+song_select = ("""SELECT artist, song, length FROM songs WHERE session_id = ? AND item_in_session = ?""")
+
+# query 2: playlist of a user session, in item_in_session order
+user_session_select = ("""SELECT item_in_session, artist, song, first_name, last_name FROM user_sessions WHERE user_id = ? AND session_id = ?""")
+
+# query 3: users who listened to a song
+song_user_select = ("""SELECT user_id, first_name, last_name FROM song_users WHERE song = ?""")
+
+# QUERY LISTS
+
+create_table_queries = [song_table_create, user_session_table_create, song_user_table_create]
+drop_table_queries = [song_table_drop, user_session_table_drop, song_user_table_drop]
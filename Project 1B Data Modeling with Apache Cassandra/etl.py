@@ -0,0 +1,196 @@
+import csv
+import time
+import argparse
+from collections import namedtuple
+from operator import attrgetter
+from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import BatchStatement, BatchType
+from cql_queries import (keyspace_create, create_table_queries, song_table_insert, user_session_table_insert,
+                         song_user_table_insert)
+
+
+# typed fields of a row of event_datafile_new.csv, named after the table columns
+EVENT_FIELDS = [('artist', 0, str), ('first_name', 1, str), ('gender', 2, str), ('item_in_session', 3, int),
+                ('last_name', 4, str), ('length', 5, float), ('level', 6, str), ('location', 7, str),
+                ('session_id', 8, int), ('song', 9, str), ('user_id', 10, int)]
+
+Event = namedtuple('Event', [name for name, index, convert in EVENT_FIELDS])
+
+
+class QueryTable:
+    """Declarative mapping of events to the rows of a query table.
+
+    Parameters:
+    query (string): prepared insert statement
+    columns (list): event fields in the order of the insert parameters, partition key first
+    key_size (int): number of leading columns forming the partition key
+    """
+
+    def __init__(self, query, columns, key_size=1):
+        self.query = query
+        self.columns = columns
+        self.key_size = key_size
+        self.params = attrgetter(*columns)
+
+
+# query tables written from each event, new tables only need an entry here; inserts are upserts,
+# so a user playing a song again rewrites the same song_users row instead of adding one
+TABLES = {
+    'songs': QueryTable(song_table_insert, ['session_id', 'item_in_session', 'artist', 'song', 'length']),
+    'user_sessions': QueryTable(user_session_table_insert, ['user_id', 'session_id', 'item_in_session', 'artist',
+                                                            'song', 'first_name', 'last_name'], key_size=2),
+    'song_users': QueryTable(song_user_table_insert, ['song', 'user_id', 'first_name', 'last_name']),
+}
+
+
+def parse_event(line):
+    """Return typed event of a row of event_datafile_new.csv."""
+    return Event(*[convert(line[index]) for name, index, convert in EVENT_FIELDS])
+
+
+def read_event_datafile(filepath):
+    """Yield the events of event_datafile_new.csv, each row parsed once."""
+    with open(filepath, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader, None)
+        for line in csvreader:
+            yield parse_event(line)
+
+
+def make_batch(prepared, rows):
+    """Return unlogged batch inserting rows with a prepared statement."""
+    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+    for values in rows:
+        batch.add(prepared, values)
+    return batch
+
+
+class TableWriter:
+    """Turns events into insert statements for one query table.
+
+    With a batch size, rows wait until batch_size rows of their partition
+    arrived and go out as one unlogged batch, so the coordinator applies
+    each batch as a single mutation; all waiting rows are flushed once
+    max_pending rows wait.
+    """
+
+    def __init__(self, session, table, batch_size=None, max_pending=10000):
+        self.table = table
+        self.mapping = TABLES[table]
+        self.prepared = session.prepare(self.mapping.query)
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.rows = 0
+        self.statements = 0
+        self._pending = {}
+        self._num_pending = 0
+
+    def add(self, event):
+        """Return list of (statement, parameters) ready to execute for an event."""
+        values = self.mapping.params(event)
+        self.rows += 1
+
+        if not self.batch_size:
+            self.statements += 1
+            return [(self.prepared, values)]
+
+        key = values[:self.mapping.key_size]
+        rows = self._pending.setdefault(key, [])
+        rows.append(values)
+        self._num_pending += 1
+        if len(rows) >= self.batch_size:
+            self._num_pending -= len(rows)
+            return [self._batch(self._pending.pop(key))]
+        if self._num_pending >= self.max_pending:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Return batches of all waiting rows."""
+        statements = [self._batch(rows) for rows in self._pending.values()]
+        self._pending = {}
+        self._num_pending = 0
+        return statements
+
+    def _batch(self, rows):
+        self.statements += 1
+        return make_batch(self.prepared, rows), None
+
+
+def fan_out(events, writers):
+    """Yield the statements of every writer for each event, reading events once."""
+    for event in events:
+        for writer in writers:
+            yield from writer.add(event)
+    for writer in writers:
+        yield from writer.flush()
+
+
+def load_tables(session, events, tables=TABLES, concurrency=100, batch_size=None):
+    """Write events to query tables in a single pass with prepared inserts.
+
+    Each event is parsed once and fanned out to the writers of all tables.
+    Up to concurrency statements are in flight at once; results are
+    consumed as they complete, so memory does not grow with the file.
+
+    Parameters:
+    session (Session): cassandra session with the sparkify keyspace set
+    events (iterable): events of event_datafile_new.csv
+    tables (list): names of tables in TABLES
+    concurrency (int): maximum statements in flight
+    batch_size (int): rows per unlogged partition batch, None to insert rows one by one
+
+    Returns: list of dictionaries with rows, statements, seconds and rows_per_sec of each table
+
+    """
+    writers = [TableWriter(session, table, batch_size) for table in tables]
+
+    start = time.perf_counter()
+    for success, result in execute_concurrent(session, fan_out(events, writers), concurrency=concurrency,
+                                              raise_on_first_error=True, results_generator=True):
+        pass
+    seconds = time.perf_counter() - start
+
+    return [{
+        'table': writer.table,
+        'rows': writer.rows,
+        'statements': writer.statements,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(writer.rows / seconds, 1) if seconds else None,
+    } for writer in writers]
+
+
+def create_tables(session):
+    """Create the sparkify keyspace and query tables and set the keyspace."""
+    session.execute(keyspace_create)
+    session.set_keyspace('sparkify')
+    for query in create_table_queries:
+        session.execute(query)
+
+
+def main():
+    """Load event_datafile_new.csv into the Cassandra query tables."""
+    parser = argparse.ArgumentParser(description='Load event_datafile_new.csv into the sparkify keyspace.')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='contact points of the cluster')
+    parser.add_argument('--file', default='event_datafile_new.csv', help='consolidated event csv file')
+    parser.add_argument('--tables', nargs='+', default=list(TABLES), choices=list(TABLES), help='tables to load')
+    parser.add_argument('--concurrency', type=int, default=100, help='maximum statements in flight')
+    parser.add_argument('--batch-size', type=int, default=0,
+                        help='group up to this many rows per partition into unlogged batches, 0 to disable')
+    args = parser.parse_args()
+
+    cluster = Cluster(args.hosts)
+    session = cluster.connect()
+    create_tables(session)
+
+    for stats in load_tables(session, read_event_datafile(args.file), args.tables, args.concurrency,
+                             args.batch_size):
+        print('{table}: {rows} rows in {statements} statements, {seconds}s, {rows_per_sec} rows/sec'.format(**stats))
+
+    session.shutdown()
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import csv
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+# columns of event_datafile_new.csv and their positions in the raw event files
+HEADER = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+          'level', 'location', 'sessionId', 'song', 'userId']
+COLUMNS = [0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16]
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_MINIMAL, skipinitialspace=True)
+
+
+def get_event_files(filepath):
+    """Return sorted list of csv files in the event data directory."""
+    return sorted(glob.glob(os.path.join(filepath, '*.csv')))
+
+
+def read_event_file(filepath):
+    """Yield the data rows of a raw event csv file, skipping its header."""
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        for line in csvreader:
+            yield line
+
+
+def project_rows(rows):
+    """Yield the event_datafile_new.csv columns of rows that have an artist, i.e. song plays."""
+    for row in rows:
+        if row[0] == '':
+            continue
+        yield [row[i] for i in COLUMNS]
+
+
+def project_file(filepath):
+    """Return the projected rows of one event file, run by worker processes."""
+    return list(project_rows(read_event_file(filepath)))
+
+
+def iter_event_rows(file_path_list, workers=1):
+    """Yield projected song play rows of event files in file order.
+
+    Files are streamed one row at a time. With several workers, files are
+    parsed in worker processes and at most two files per worker are held
+    in memory at once, however many files there are.
+
+    Parameters:
+    file_path_list (list): raw event csv files
+    workers (int): number of processes reading files
+
+    Returns: generator of rows
+
+    """
+    if workers <= 1:
+        for filepath in file_path_list:
+            yield from project_rows(read_event_file(filepath))
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = []
+        for filepath in file_path_list:
+            pending.append(executor.submit(project_file, filepath))
+            if len(pending) >= 2 * workers:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def write_event_datafile(file_path_list, output='event_datafile_new.csv', workers=1):
+    """Consolidate raw event files into the csv file loaded into the Cassandra tables.
+
+    Parameters:
+    file_path_list (list): raw event csv files
+    output (string): path of the consolidated csv file
+    workers (int): number of processes reading files
+
+    Returns: number of rows written, excluding the header
+
+    """
+    num_rows = 0
+    with open(output, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(HEADER)
+        for row in iter_event_rows(file_path_list, workers):
+            writer.writerow(row)
+            num_rows += 1
+    return num_rows
+
+
+if __name__ == "__main__":
+    print('{} rows written'.format(write_event_datafile(get_event_files('event_data'))))
@@ -0,0 +1,189 @@
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from cassandra.cluster import Cluster
+from cql_queries import song_select, user_session_select, song_user_select
+import etl
+
+# statements of the service's queries
+QUERIES = {
+    'song': song_select,
+    'playlist': user_session_select,
+    'listeners': song_user_select,
+}
+
+MISSING = object()
+
+
+class TTLCache:
+    """Least recently used cache whose entries expire ttl seconds after they were put.
+
+    Parameters:
+    max_entries (int): entries kept before the least recently used one is evicted
+    ttl (float): seconds an entry is served, which bounds how stale cached rows can be
+    """
+
+    def __init__(self, max_entries=1024, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value of key, MISSING if it is not cached or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self):
+        """Return dictionary of entries, hits, misses, expired and evicted entries and hit rate."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'hit_rate': round(self.hits / requests, 3) if requests else None,
+            }
+
+
+class QueryService:
+    """Prepared, paged and cached reads of the three query tables.
+
+    Rows are streamed from the cluster fetch_size rows per page, so a
+    partition of any size is never held in memory at once. Results of up
+    to max_cached_rows rows are cached by key; larger partitions, such
+    as the listeners of a popular song, are streamed on every call.
+
+    Parameters:
+    session (Session): cassandra session with the sparkify keyspace set
+    fetch_size (int): rows per page requested from the cluster
+    cache_size (int): keys cached per query
+    cache_ttl (float): seconds a cached result is served
+    max_cached_rows (int): largest result that is cached
+    """
+
+    def __init__(self, session, fetch_size=1000, cache_size=1024, cache_ttl=60.0, max_cached_rows=1000):
+        self.session = session
+        self.max_cached_rows = max_cached_rows
+        self.prepared = {}
+        self.caches = {}
+        for name, query in QUERIES.items():
+            prepared = session.prepare(query)
+            prepared.fetch_size = fetch_size
+            self.prepared[name] = prepared
+            self.caches[name] = TTLCache(cache_size, cache_ttl)
+
+    def song(self, session_id, item_in_session):
+        """Return artist, song and length of an item in a session, None if there is none."""
+        # the result is read to the end, so that it is cached
+        rows = list(self.stream('song', (session_id, item_in_session)))
+        return rows[0] if rows else None
+
+    def playlist(self, user_id, session_id):
+        """Yield item_in_session, artist, song and user name of the plays of a user session in order."""
+        return self.stream('playlist', (user_id, session_id))
+
+    def listeners(self, song):
+        """Yield user_id and name of the users who listened to a song."""
+        return self.stream('listeners', (song,))
+
+    def stream(self, name, params):
+        """Yield the rows of a query, from the cache if they are cached.
+
+        Rows are yielded as their pages arrive. A result is cached once it
+        has been read to the end and has at most max_cached_rows rows.
+
+        Parameters:
+        name (string): query in QUERIES
+        params (tuple): values of the primary key columns the query restricts
+
+        Returns: generator of rows
+
+        """
+        cache = self.caches[name]
+        rows = cache.get(params)
+        if rows is not MISSING:
+            yield from rows
+            return
+
+        rows = []
+        for row in self.session.execute(self.prepared[name], params):
+            if rows is not None:
+                rows.append(row)
+                if len(rows) > self.max_cached_rows:
+                    rows = None
+            yield row
+        if rows is not None:
+            cache.put(params, tuple(rows))
+
+    def stats(self):
+        """Return cache statistics of each query."""
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+
+def main():
+    """Run the notebook queries through the query service and print cache hit rates."""
+    parser = argparse.ArgumentParser(description='Query the sparkify tables through the cached query service.')
+    parser.add_argument('--hosts', nargs='+',
+                        help='contact points of a loaded cluster, without them event_datafile_new.csv is '
+                             'loaded into the in-process stand-in first')
+    parser.add_argument('--file', default='event_datafile_new.csv', help='consolidated event csv file')
+    parser.add_argument('--fetch-size', type=int, default=1000, help='rows per page')
+    parser.add_argument('--cache-size', type=int, default=1024, help='keys cached per query')
+    parser.add_argument('--cache-ttl', type=float, default=60.0, help='seconds a cached result is served')
+    parser.add_argument('--repeat', type=int, default=3, help='times each query is run')
+    args = parser.parse_args()
+
+    if args.hosts:
+        cluster = Cluster(args.hosts)
+        session = cluster.connect('sparkify')
+    else:
+        # imported here, the stand-in is only needed without a cluster
+        from stand_in import StandInSession
+        session = StandInSession()
+        etl.create_tables(session)
+        etl.load_tables(session, etl.read_event_datafile(args.file))
+
+    service = QueryService(session, args.fetch_size, args.cache_size, args.cache_ttl)
+    for i in range(args.repeat):
+        print(service.song(338, 4))
+        for row in service.playlist(10, 182):
+            print(row)
+        for row in service.listeners('All Hands Against His Own'):
+            print(row)
+
+    for name, stats in service.stats().items():
+        print('{}: {hits} hits, {misses} misses, hit rate {hit_rate}'.format(name, **stats))
+
+    session.shutdown()
+    if args.hosts:
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
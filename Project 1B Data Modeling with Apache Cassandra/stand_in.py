@@ -0,0 +1,337 @@
+import re
+import time
+import logging
+import heapq
+import random
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from cassandra import cqltypes
+from cassandra.cluster import ResultSet, QueryExhausted
+from cassandra.encoder import Encoder
+from cassandra.protocol import ColumnMetadata
+from cassandra.query import PreparedStatement, BoundStatement, BatchStatement, FETCH_SIZE_UNSET, bind_params
+
+CQL_TYPES = {
+    'int': cqltypes.Int32Type,
+    'bigint': cqltypes.LongType,
+    'double': cqltypes.DoubleType,
+    'float': cqltypes.FloatType,
+    'boolean': cqltypes.BooleanType,
+    'text': cqltypes.UTF8Type,
+}
+
+PROTOCOL_VERSION = 4
+
+
+def parse_table(query):
+    """Return name, column types and primary key columns of a CREATE TABLE statement.
+
+    Parameters:
+    query (string): CREATE TABLE statement with a PRIMARY KEY clause
+
+    Returns: table name, dictionary of column types, list of partition key then clustering columns
+    and number of partition key columns
+
+    """
+    name, body = re.match(r'CREATE TABLE (?:IF NOT EXISTS )?(\w+) \((.*)\)$', query.strip(), re.S).groups()
+    columns, key = re.match(r'(.*), PRIMARY KEY \((.*)\)$', ' '.join(body.split()), re.S).groups()
+    types = dict(column.split() for column in columns.split(', '))
+    partition = re.match(r'\((.*?)\)', key)
+    if partition:
+        partition_key = partition.group(1).split(', ')
+        clustering = key[partition.end():].lstrip(', ')
+    else:
+        partition_key, _, clustering = [part.strip() for part in key.partition(',')]
+        partition_key = [partition_key]
+    primary_key = partition_key + [column for column in clustering.split(', ') if column]
+    return name, {column: CQL_TYPES[cql_type] for column, cql_type in types.items()}, primary_key, len(partition_key)
+
+
+class StandInFuture:
+    """Result of a request to the stand-in, the part of ResponseFuture that execute_concurrent and ResultSet use."""
+
+    _col_names = None
+    _col_types = None
+    _continuous_paging_session = None
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._paging_state = None
+        self._fetch_page = None
+
+    @property
+    def has_more_pages(self):
+        return self._paging_state is not None
+
+    def start_fetching_next_page(self):
+        if self._paging_state is None:
+            raise QueryExhausted()
+        with self._lock:
+            self._done.clear()
+            self._result = None
+        self._fetch_page(self, self._paging_state)
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None,
+                      errback_args=(), errback_kwargs=None):
+        with self._lock:
+            self._callbacks.append((callback, callback_args, callback_kwargs or {},
+                                    errback, errback_args, errback_kwargs or {}))
+            done = self._done.is_set()
+        if done:
+            # like responses of a real node, callbacks run on the loop thread
+            self._loop.call_later(0, self._run_callbacks)
+
+    def clear_callbacks(self):
+        with self._lock:
+            self._callbacks = []
+
+    def result(self):
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return ResultSet(self, self._result)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, args, kwargs, errback, errback_args, errback_kwargs in callbacks:
+            if self._exception is None:
+                callback(self._result, *args, **kwargs)
+            else:
+                errback(self._exception, *errback_args, **errback_kwargs)
+
+
+class EventLoop:
+    """Single thread completing requests once their latency has passed, like the driver's event loop."""
+
+    def __init__(self):
+        self._queue = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='stand-in-loop', daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, fn, *args):
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._queue, (time.perf_counter() + delay, self._counter, fn, args))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._queue or self._queue[0][0] > time.perf_counter()):
+                    self._condition.wait(self._queue[0][0] - time.perf_counter() if self._queue else None)
+                if not self._running:
+                    return
+                due, counter, fn, args = heapq.heappop(self._queue)
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('error in stand-in callback')
+
+
+class StandInSession:
+    """In-process stand-in for the cassandra.cluster.Session calls the loaders make.
+
+    Prepared statements are bound and serialized by the driver as for a
+    real node. Each request completes on a single loop thread after
+    latency seconds plus up to jitter seconds, and its rows are then
+    deserialized and stored in memory by partition and clustering key, so
+    later writes to the same key overwrite earlier ones like inserts in
+    Cassandra. Simple INSERT strings with %s parameters, as the notebook
+    runs them, are formatted into CQL client side like the driver does and
+    stored like prepared inserts. SELECTs by partition key return rows in
+    clustering order, one page of the statement's fetch_size per request.
+    Any number of requests may be in flight at once.
+
+    Parameters:
+    latency (float): seconds every request takes
+    jitter (float): maximum random seconds added to the latency
+    """
+
+    def __init__(self, latency=0.001, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.keyspace = None
+        self.keyspaces = set()
+        self.tables = {}
+        self.requests = 0
+        self.default_fetch_size = 5000
+        self._prepared = {}
+        self._encoder = Encoder()
+        self._loop = EventLoop()
+        self._executor = ThreadPoolExecutor(2)
+
+    def execute(self, query, parameters=None, **kwargs):
+        """Run schema statements directly, everything else like execute_async and wait for it."""
+        if isinstance(query, str):
+            statement = ' '.join(query.split())
+            if statement.startswith('CREATE KEYSPACE'):
+                self.keyspaces.add(re.search(r'(?:IF NOT EXISTS )?(\w+) WITH', statement).group(1))
+                return []
+            if statement.startswith('CREATE TABLE'):
+                name, types, primary_key, partition_size = parse_table(statement)
+                self.tables.setdefault(name, {'types': types, 'primary_key': primary_key,
+                                              'partition_size': partition_size, 'partitions': {}})
+                return []
+            if statement.startswith('DROP TABLE'):
+                self.tables.pop(statement.split()[-1], None)
+                return []
+        return self.execute_async(query, parameters, **kwargs).result()
+
+    def execute_async(self, query, parameters=None, timeout=None, execution_profile=None, **kwargs):
+        """Return future of a prepared, bound or batch statement, or a simple INSERT, completing after the latency."""
+        if isinstance(query, PreparedStatement):
+            query = query.bind(parameters or ())
+        if isinstance(query, str):
+            writes = [self._simple_insert(query, parameters)]
+        elif isinstance(query, BoundStatement):
+            writes = [(query.prepared_statement.query_id, query.values)]
+        elif isinstance(query, BatchStatement):
+            if not all(is_prepared for is_prepared, query_id, values in query._statements_and_parameters):
+                raise ValueError('batches run by the stand-in may only hold prepared statements')
+            writes = [(query_id, values) for is_prepared, query_id, values in query._statements_and_parameters]
+        else:
+            raise TypeError('the stand-in only runs prepared, bound and batch statements and simple INSERTs, '
+                            'not {}'.format(type(query).__name__))
+
+        future = StandInFuture(self._loop)
+        query_id, values = writes[0]
+        if self._prepared[query_id][0] == 'select':
+            fetch_size = self.default_fetch_size if query.fetch_size is FETCH_SIZE_UNSET else query.fetch_size
+            future._fetch_page = lambda future, paging_state: self._request(
+                self._read, future, query_id, values, fetch_size, paging_state)
+            future._fetch_page(future, None)
+        else:
+            self._request(self._write, future, writes)
+        return future
+
+    def _request(self, fn, *args):
+        """Run fn on the loop thread once the latency of a request has passed."""
+        self.requests += 1
+        self._loop.call_later(self.latency + random.uniform(0, self.jitter), fn, *args)
+
+    def prepare(self, query):
+        """Return prepared statement of an INSERT into, or a SELECT by key from, a table created in this session.
+
+        SELECTs must restrict the whole partition key and optionally a
+        prefix of the clustering columns, all with = ?.
+        """
+        statement = ' '.join(query.split())
+        insert = re.match(r'INSERT INTO (\w+) \((.*?)\) VALUES', statement)
+        if insert:
+            table, columns = insert.groups()
+            columns = bind_columns = columns.split(', ')
+        else:
+            columns, table, where = re.match(r'SELECT (.*?) FROM (\w+) WHERE (.*)$', statement).groups()
+            columns = columns.split(', ')
+            bind_columns = re.findall(r'(\w+) = \?', where)
+
+        schema = self.tables[table]
+        column_metadata = [ColumnMetadata(self.keyspace, table, column, schema['types'][column])
+                           for column in bind_columns]
+        routing_key_indexes = [bind_columns.index(column)
+                               for column in schema['primary_key'][:schema['partition_size']]]
+        query_id = hashlib.md5(query.encode()).digest()
+        if insert:
+            self._prepared[query_id] = ('insert', table, columns)
+        else:
+            self._prepared[query_id] = ('select', table, bind_columns, columns, namedtuple('Row', columns))
+        return PreparedStatement(column_metadata, query_id, routing_key_indexes, query, self.keyspace,
+                                 PROTOCOL_VERSION, None, None)
+
+    def _simple_insert(self, query, parameters):
+        """Return the query id and serialized values of a simple INSERT with %s parameters.
+
+        The statement is formatted with its parameters like the driver
+        formats simple statements, then stored like a prepared insert.
+        """
+        statement = ' '.join(query.split())
+        insert = re.match(r'INSERT INTO (\w+) \((.*?)\) VALUES', statement)
+        if not insert:
+            raise TypeError('the stand-in only runs simple INSERTs, prepare other statements')
+        bind_params(statement, parameters or (), self._encoder)
+
+        table, columns = insert.group(1), insert.group(2).split(', ')
+        schema = self.tables[table]
+        query_id = hashlib.md5(statement.encode()).digest()
+        self._prepared.setdefault(query_id, ('insert', table, columns))
+        return query_id, [schema['types'][column].serialize(value, PROTOCOL_VERSION)
+                          for column, value in zip(columns, parameters)]
+
+    def set_keyspace(self, keyspace):
+        self.keyspace = keyspace
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def count(self, table):
+        """Return number of rows stored in a table."""
+        return sum(len(partition) for partition in self.tables[table]['partitions'].values())
+
+    def shutdown(self):
+        self._loop.stop()
+        self._executor.shutdown()
+
+    def _decode(self, schema, columns, values):
+        """Return dictionary of deserialized values of columns."""
+        return {column: schema['types'][column].deserialize(value, PROTOCOL_VERSION)
+                for column, value in zip(columns, values)}
+
+    def _write(self, future, writes):
+        """Store the rows of a request and complete its future, run on the loop thread."""
+        try:
+            for query_id, values in writes:
+                kind, table, columns = self._prepared[query_id]
+                schema = self.tables[table]
+                row = self._decode(schema, columns, values)
+                partition_key = tuple(row[column] for column in schema['primary_key'][:schema['partition_size']])
+                clustering_key = tuple(row[column] for column in schema['primary_key'][schema['partition_size']:])
+                partition = schema['partitions'].setdefault(partition_key, {})
+                partition.setdefault(clustering_key, {}).update(row)
+        except Exception as e:
+            future._finish(exception=e)
+            return
+        future._finish([])
+
+    def _read(self, future, query_id, values, fetch_size, paging_state):
+        """Complete future with the page of rows after the clustering key paging_state, run on the loop thread."""
+        try:
+            kind, table, bind_columns, columns, row_type = self._prepared[query_id]
+            schema = self.tables[table]
+            key = self._decode(schema, bind_columns, values)
+            partition_size = schema['partition_size']
+            partition = schema['partitions'].get(tuple(key[c] for c in schema['primary_key'][:partition_size]), {})
+            prefix = tuple(key[c] for c in schema['primary_key'][partition_size:] if c in key)
+
+            clustering_keys = [k for k in sorted(partition)
+                               if k[:len(prefix)] == prefix and (paging_state is None or k > paging_state)]
+            page = clustering_keys[:fetch_size] if fetch_size else clustering_keys
+            rows = [row_type(*[partition[k].get(column) for column in columns]) for k in page]
+        except Exception as e:
+            future._finish(exception=e)
+            return
+        future._paging_state = page[-1] if len(clustering_keys) > len(page) else None
+        future._finish(rows)
@@ -0,0 +1,75 @@
+import pytest
+from cassandra.query import BatchStatement
+from etl import Event, TableWriter, create_tables, load_tables, parse_event
+from stand_in import StandInSession
+
+
+def event(session_id, item_in_session, user_id=10, song='Song'):
+    return Event('Artist', 'Sylvie', 'F', item_in_session, 'Cruz', 99.16, 'free', 'Washington, DC', session_id,
+                 song, user_id)
+
+
+@pytest.fixture
+def session():
+    session = StandInSession(latency=0)
+    create_tables(session)
+    yield session
+    session.shutdown()
+
+
+def batch_rows(statement):
+    assert isinstance(statement, BatchStatement)
+    return len(statement._statements_and_parameters)
+
+
+def test_parse_event_converts_fields():
+    line = ['Artist', 'Sylvie', 'F', '3', 'Cruz', '99.16', 'free', 'Washington, DC', '182', 'Song', '10']
+
+    assert parse_event(line) == event(182, 3)
+
+
+def test_writer_without_batch_size_inserts_rows_one_by_one(session):
+    writer = TableWriter(session, 'songs')
+
+    statements = writer.add(event(1, 0))
+
+    assert statements == [(writer.prepared, (1, 0, 'Artist', 'Song', 99.16))]
+    assert writer.flush() == []
+
+
+def test_writer_batches_rows_of_one_partition(session):
+    writer = TableWriter(session, 'user_sessions', batch_size=2)
+
+    assert writer.add(event(1, 0)) == []
+    # another partition of the (user_id, session_id) key
+    assert writer.add(event(1, 1, user_id=11)) == []
+    assert writer.add(event(2, 0)) == []
+    statements = writer.add(event(1, 1))
+
+    assert [batch_rows(statement) for statement, params in statements] == [2]
+    assert sorted(batch_rows(statement) for statement, params in writer.flush()) == [1, 1]
+    assert (writer.rows, writer.statements) == (4, 3)
+    assert writer.flush() == []
+
+
+def test_writer_flushes_all_partitions_at_max_pending(session):
+    writer = TableWriter(session, 'songs', batch_size=10, max_pending=3)
+
+    assert writer.add(event(1, 0)) == []
+    assert writer.add(event(2, 0)) == []
+    statements = writer.add(event(1, 1))
+
+    assert sorted(batch_rows(statement) for statement, params in statements) == [1, 2]
+    assert writer.flush() == []
+
+
+@pytest.mark.parametrize('batch_size, statements', [(None, 4), (2, 2)])
+def test_load_tables_writes_every_table_in_one_pass(session, batch_size, statements):
+    events = iter([event(1, 0), event(1, 1), event(2, 0, song='Other'), event(2, 0, song='Other')])
+
+    stats = load_tables(session, events, tables=['songs', 'song_users'], concurrency=2, batch_size=batch_size)
+
+    assert [(s['table'], s['rows']) for s in stats] == [('songs', 4), ('song_users', 4)]
+    assert stats[0]['statements'] == statements
+    assert session.count('songs') == 3
+    assert session.count('song_users') == 2
@@ -0,0 +1,58 @@
+import csv
+import pytest
+from event_data import HEADER, get_event_files, project_rows, write_event_datafile
+
+RAW_HEADER = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+              'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userId']
+
+
+def raw_event(artist, session_id, item, song='Song'):
+    return [artist, 'Logged In', 'Sylvie', 'F', str(item), 'Cruz', '99.16036', 'free', 'Washington, DC', 'PUT',
+            'NextSong', '1.54027E+12', str(session_id), song, '200', '1.54111E+12', '10']
+
+
+def read_csv(filepath):
+    with open(filepath, encoding='utf8', newline='') as f:
+        return list(csv.reader(f))
+
+
+@pytest.fixture
+def event_files(tmp_path):
+    files = []
+    for day, rows in [('2018-11-02', [raw_event('A, "quoted"', 2, 0), raw_event('', 2, 1)]),
+                      ('2018-11-01', [raw_event('B', 1, 0), raw_event('C', 1, 1, song='Line\nbreak')])]:
+        filepath = tmp_path / '{}-events.csv'.format(day)
+        with open(filepath, 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(RAW_HEADER)
+            writer.writerows(rows)
+        files.append(str(filepath))
+    return files
+
+
+def test_project_rows_keep_song_plays_and_table_columns():
+    rows = list(project_rows([raw_event('', 1, 0), raw_event('B', 1, 1)]))
+
+    assert rows == [['B', 'Sylvie', 'F', '1', 'Cruz', '99.16036', 'free', 'Washington, DC', '1', 'Song', '10']]
+    assert len(rows[0]) == len(HEADER)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_write_event_datafile_keeps_file_order(event_files, tmp_path, workers):
+    output = str(tmp_path / 'out.csv')
+
+    assert write_event_datafile(event_files, output, workers) == 3
+    rows = read_csv(output)
+    assert rows[0] == HEADER
+    assert [(row[0], row[9]) for row in rows[1:]] == [('A, "quoted"', 'Song'), ('B', 'Song'), ('C', 'Line\nbreak')]
+
+
+def test_event_files_are_sorted(event_files, tmp_path):
+    assert get_event_files(str(tmp_path)) == sorted(event_files)
+
+
+def test_committed_datafile_holds_the_rows_of_event_data(tmp_path):
+    output = str(tmp_path / 'out.csv')
+    write_event_datafile(get_event_files('event_data'), output)
+
+    assert sorted(read_csv(output)) == sorted(read_csv('event_datafile_new.csv'))
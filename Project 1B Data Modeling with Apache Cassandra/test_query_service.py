@@ -0,0 +1,116 @@
+import pytest
+import etl
+import query_service
+from query_service import TTLCache, QueryService, MISSING
+from stand_in import StandInSession
+
+
+class Clock:
+    """Stand-in of time.monotonic that only moves when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hits_and_misses():
+    cache = TTLCache(max_entries=2, ttl=60)
+
+    assert cache.get('a') is MISSING
+    cache.put('a', [1])
+    assert cache.get('a') == [1]
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1, 'expired': 0, 'evicted': 0, 'hit_rate': 0.5}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evicted'] == 1
+
+
+def test_cache_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(query_service.time, 'monotonic', clock)
+    cache = TTLCache(max_entries=2, ttl=10)
+    cache.put('a', 1)
+
+    clock.now = 9.9
+    assert cache.get('a') == 1
+    clock.now = 10.1
+    assert cache.get('a') is MISSING
+    assert cache.stats()['expired'] == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_cache_put_refreshes_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(query_service.time, 'monotonic', clock)
+    cache = TTLCache(max_entries=2, ttl=10)
+    cache.put('a', 1)
+    clock.now = 8
+    cache.put('a', 2)
+
+    clock.now = 15
+    assert cache.get('a') == 2
+
+
+def test_cache_stats_without_requests():
+    assert TTLCache().stats()['hit_rate'] is None
+
+
+@pytest.fixture
+def session():
+    session = StandInSession(latency=0)
+    etl.create_tables(session)
+    yield session
+    session.shutdown()
+
+
+def load_events(session, events):
+    etl.load_tables(session, iter(events))
+
+
+def test_playlist_streams_every_row_in_pages(session):
+    load_events(session, [etl.Event('Artist', 'Sylvie', 'F', item, 'Cruz', 99.0, 'free', 'DC', 182,
+                                    'Song {}'.format(item), 10) for item in range(25)])
+    service = QueryService(session, fetch_size=4)
+    requests = session.requests
+
+    rows = list(service.playlist(10, 182))
+
+    assert [row.item_in_session for row in rows] == list(range(25))
+    # 7 pages of at most 4 rows
+    assert session.requests - requests == 7
+
+
+def test_repeated_keys_are_served_from_the_cache(session):
+    load_events(session, [etl.Event('Artist', 'Sylvie', 'F', 4, 'Cruz', 99.0, 'free', 'DC', 338, 'Song', 10)])
+    service = QueryService(session)
+    requests = session.requests
+
+    assert service.song(338, 4).song == 'Song'
+    assert service.song(338, 4).song == 'Song'
+    assert service.song(338, 5) is None
+
+    assert session.requests - requests == 2
+    stats = service.stats()['song']
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 2, 0.333)
+
+
+def test_large_results_are_streamed_without_caching(session):
+    load_events(session, [etl.Event('Artist', 'User', 'F', 0, 'Name', 99.0, 'free', 'DC', user_id, 'Hit', user_id)
+                          for user_id in range(5)])
+    service = QueryService(session, fetch_size=2, max_cached_rows=3)
+
+    assert len(list(service.listeners('Hit'))) == 5
+    assert len(list(service.listeners('Hit'))) == 5
+    assert service.stats()['listeners']['entries'] == 0
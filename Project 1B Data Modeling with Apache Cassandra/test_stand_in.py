@@ -0,0 +1,61 @@
+import pytest
+from cassandra.query import BatchStatement, SimpleStatement
+import benchmark
+from etl import create_tables
+from stand_in import StandInSession, parse_table
+from cql_queries import song_user_table_create, song_table_insert, song_select
+
+
+@pytest.fixture
+def session():
+    session = StandInSession(latency=0)
+    create_tables(session)
+    yield session
+    session.shutdown()
+
+
+def test_parse_table_reads_composite_partition_keys():
+    name, types, primary_key, partition_size = parse_table(song_user_table_create)
+
+    assert (name, primary_key, partition_size) == ('song_users', ['song', 'user_id'], 1)
+    name, types, primary_key, partition_size = parse_table(
+        "CREATE TABLE t (a int, b int, c text, PRIMARY KEY ((a, b), c))")
+    assert (primary_key, partition_size) == (['a', 'b', 'c'], 2)
+
+
+def test_inserts_overwrite_rows_of_the_same_key(session):
+    prepared = session.prepare(song_table_insert)
+    session.execute(prepared, (1, 0, 'A', 'Song', 1.5))
+    session.execute(prepared, (1, 0, 'B', 'Song', 1.5))
+    session.execute(benchmark.NOTEBOOK_INSERTS['songs'][0], (1, 1, "It's", 'Other', 2.0))
+
+    assert session.count('songs') == 2
+    assert [tuple(row) for row in session.execute(session.prepare(song_select), (1, 0))] == [('B', 'Song', 1.5)]
+    assert [tuple(row) for row in session.execute(session.prepare(song_select), (1, 1))] == [("It's", 'Other', 2.0)]
+
+
+def test_unsupported_statements_are_rejected(session):
+    with pytest.raises(TypeError):
+        session.execute_async(SimpleStatement("INSERT INTO songs (session_id) VALUES (%s)"), (1,))
+    with pytest.raises(TypeError):
+        session.execute_async("SELECT * FROM songs WHERE session_id = %s", (1,))
+
+    batch = BatchStatement()
+    batch.add("INSERT INTO songs (session_id, item_in_session) VALUES (%s, %s)", (1, 0))
+    with pytest.raises(ValueError):
+        session.execute_async(batch)
+
+
+def test_benchmark_modes_load_the_same_rows(session, tmp_path):
+    benchmark.random.seed(1)
+    benchmark.generate_events(str(tmp_path / 'event_data'), 400, 5, 30, 2)
+    datafile = str(tmp_path / 'event_datafile_new.csv')
+    benchmark.consolidate(str(tmp_path / 'event_data'), datafile, 1)
+
+    counts = {}
+    for mode in benchmark.LOAD_MODES:
+        results = benchmark.run_mode(session, datafile, mode, 10, 5)
+        assert {result['mode'] for result in results} == {mode}
+        counts[mode] = {table: session.count(table) for table in ['songs', 'user_sessions', 'song_users']}
+
+    assert counts['notebook'] == counts['concurrency-1'] == counts['concurrent']
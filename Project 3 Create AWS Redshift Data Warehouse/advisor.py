@@ -0,0 +1,545 @@
+import re
+import json
+import zlib
+import struct
+import argparse
+import configparser
+from collections import Counter
+from datetime import date
+import psycopg2
+import sql_queries
+from sql_queries import recorded_queries_select, analyze_compression
+
+# star schema table: (variable of its create statement, variable of the insert filling it from staging)
+STAR_TABLES = {
+    'songplays': ('songplay_table_create', 'songplay_table_insert'),
+    'users': ('user_table_create', 'user_table_insert'),
+    'songs': ('song_table_create', 'song_table_insert'),
+    'artists': ('artist_table_create', 'artist_table_insert'),
+    'time': ('time_table_create', 'time_table_insert'),
+}
+
+# bytes per value of the fixed width types, text takes its length plus a 4 byte header
+TYPE_WIDTHS = {'int': 4, 'bigint': 8, 'float8': 8, 'numeric': 8, 'timestamp': 8}
+STRUCT_FORMATS = {'int': '<i', 'bigint': '<q', 'float8': '<d', 'numeric': '<q', 'timestamp': '<q'}
+AZ64_TYPES = {'int', 'bigint', 'numeric', 'timestamp'}
+
+# weights of the ways a query uses a column when choosing sort keys, joins count
+# since tables sorted and distributed on their join columns can be merge joined
+SORT_KEY_WEIGHTS = {'range': 3, 'equal': 2, 'join': 2, 'group': 1}
+
+SQL_WORDS = {'on', 'where', 'group', 'order', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'join', 'limit',
+             'using', 'having', 'natural'}
+
+
+def parse_create(query):
+    """Return table name, columns and keys of a CREATE TABLE statement of sql_queries.
+
+    Parameters:
+    query (string): CREATE TABLE statement
+
+    Returns: name, list of (column, type, constraints), dictionary of its diststyle, distkey and sortkey
+
+    """
+    name = re.search(r'CREATE TABLE IF NOT EXISTS (\w+)', query).group(1)
+    body = query[query.index('(') + 1:query.rindex(')')]
+    columns = []
+    keys = {'diststyle': 'ALL' if 'diststyle ALL' in query else 'EVEN', 'distkey': None, 'sortkey': None}
+    for definition in body.split(','):
+        words = definition.split()
+        if 'distkey' in words:
+            keys['diststyle'], keys['distkey'] = 'KEY', words[0]
+        if 'sortkey' in words:
+            keys['sortkey'] = words[0]
+        constraints = ' '.join(word for word in words[2:] if word not in ('sortkey', 'distkey'))
+        columns.append((words[0], words[1], constraints))
+    return name, columns, keys
+
+
+def sample_table(cur, insert_query, sample_rows):
+    """Return row count and a random sample of the rows an insert statement selects from the staging tables."""
+    select = insert_query[insert_query.index('SELECT'):]
+    cur.execute('SELECT COUNT(*) FROM ({}) star'.format(select))
+    count = cur.fetchone()[0]
+    cur.execute('SELECT * FROM ({}) star ORDER BY RANDOM() LIMIT %s'.format(select), (sample_rows,))
+    return count, cur.fetchall()
+
+
+def value_width(value, data_type):
+    """Return bytes of a value stored without compression."""
+    if data_type in TYPE_WIDTHS:
+        return TYPE_WIDTHS[data_type]
+    return 4 + (len(str(value).encode('utf8')) if value is not None else 0)
+
+
+def pack(values, data_type):
+    """Return values serialized the way a block stores them, nulls as zeros."""
+    if data_type not in STRUCT_FORMATS:
+        return b'\0'.join(str(value).encode('utf8') for value in values if value is not None)
+    packer = struct.Struct(STRUCT_FORMATS[data_type])
+    if data_type == 'timestamp':
+        values = [int(value.timestamp() * 1e6) if value is not None else 0 for value in values]
+    elif data_type == 'float8':
+        values = [float(value) if value is not None else 0.0 for value in values]
+    else:
+        values = [int(value) if value is not None else 0 for value in values]
+    return b''.join(packer.pack(value) for value in values)
+
+
+def encoded_size(values, data_type, encoding):
+    """Estimate bytes of values, in sort key order, stored with a compression encoding.
+
+    bytedict and runlength are computed from their layout. zlib stands in
+    for the byte-oriented encodings: level 1 for lzo and level 9 for zstd
+    and az64; az64 usually compresses sorted numbers and timestamps
+    further, so its estimate is conservative.
+    """
+    if encoding == 'raw':
+        return sum(value_width(value, data_type) for value in values)
+    if encoding == 'bytedict':
+        return len(values) + sum(value_width(value, data_type) for value in set(values))
+    if encoding == 'runlength':
+        runs = 1 + sum(a != b for a, b in zip(values, values[1:]))
+        return runs * (1 + encoded_size(values, data_type, 'raw') / max(1, len(values)))
+    return len(zlib.compress(pack(values, data_type), 1 if encoding == 'lzo' else 9))
+
+
+def default_encoding(data_type, is_sortkey):
+    """Return encoding Redshift assigns to a column created without ENCODE."""
+    if is_sortkey:
+        return 'raw'
+    return 'az64' if data_type in AZ64_TYPES else 'lzo'
+
+
+def column_values(columns, rows, sortkey):
+    """Return the values of each column of sample rows, in the order of a sort key."""
+    names = [name for name, data_type, constraints in columns]
+    if sortkey in names:
+        position = names.index(sortkey)
+        rows = sorted(rows, key=lambda row: (row[position] is None, row[position]))
+    values = []
+    for i, (name, data_type, constraints) in enumerate(columns):
+        if 'IDENTITY' in constraints:
+            # generated on insert, so counted as sequential numbers
+            values.append(list(range(1, len(rows) + 1)))
+        else:
+            values.append([row[i] for row in rows])
+    return values
+
+
+def suggest_encodings(columns, rows, sortkey, current_sortkey, analyzed=None):
+    """Suggest the compression encoding of each column from a sample of its rows.
+
+    Every encoding the column type allows is estimated on the sample in
+    sort key order and the smallest is chosen. The sort key stays raw, as
+    a sort key compressed much more than the other columns makes range
+    restricted scans read more of their blocks. Each column is also
+    estimated with the encoding Redshift gives it in the current DDL, in
+    the order of the current sort key; a column keeps that encoding when
+    the suggestion would not be smaller. Columns ANALYZE COMPRESSION
+    reported on take its encoding and reduction instead of the estimate.
+
+    Parameters:
+    columns (list): (column, type, constraints) of the table
+    rows (list): sample rows of the table, in column order
+    sortkey (string): suggested sort key column, None if the table has none
+    current_sortkey (string): sort key column of the current DDL
+    analyzed (dict): column mapped to (encoding, estimated reduction in percent) of ANALYZE COMPRESSION
+
+    Returns: list of dictionaries with column, type, encoding, its source and bytes per row raw,
+        by default and encoded
+
+    """
+    n = max(1, len(rows))
+    analyzed = analyzed or {}
+    current_values = column_values(columns, rows, current_sortkey)
+
+    suggestions = []
+    for (name, data_type, constraints), values, current in zip(columns, column_values(columns, rows, sortkey),
+                                                               current_values):
+        sizes = {'raw': encoded_size(values, data_type, 'raw')}
+        candidates = ['az64'] if data_type in AZ64_TYPES else ['zstd', 'lzo']
+        if len(set(values)) < 256:
+            candidates.append('bytedict')
+        candidates.append('runlength')
+        for encoding in candidates:
+            sizes[encoding] = encoded_size(values, data_type, encoding)
+        current_encoding = default_encoding(data_type, name == current_sortkey)
+        default_size = encoded_size(current, data_type, current_encoding)
+
+        if name in analyzed:
+            encoding, reduction = analyzed[name]
+            size, source = default_size * (1 - reduction / 100), 'analyze'
+        else:
+            encoding = 'raw' if name == sortkey else min(candidates, key=sizes.get)
+            size, source = sizes[encoding], 'estimate'
+        if size >= default_size:
+            # in the suggested sort order, which may compress it differently than the current one
+            encoding, source = current_encoding, 'current'
+            size = sizes.get(encoding) or encoded_size(values, data_type, encoding)
+        suggestions.append({
+            'column': name,
+            'type': data_type,
+            'encoding': encoding,
+            'source': source,
+            'raw_bytes': round(sizes['raw'] / n, 2),
+            'default_bytes': round(default_size / n, 2),
+            'encoded_bytes': round(size / n, 2),
+        })
+    return suggestions
+
+
+def split_queries(text):
+    """Return the statements of a file of SQL queries, without comments."""
+    text = re.sub(r'--[^\n]*', '', text)
+    return [query.strip() for query in text.split(';') if query.strip()]
+
+
+def analyze_query(query, table_columns):
+    """Return how a query uses the columns of the star schema.
+
+    Joins are equalities between columns of two tables, filters are
+    comparisons in the WHERE clause, and grouped columns appear in GROUP
+    BY or ORDER BY. Columns are resolved through the aliases of the FROM
+    and JOIN clauses, or by name if only one table of the query has them.
+
+    Parameters:
+    query (string): SELECT statement
+    table_columns (dict): table name mapped to its column names
+
+    Returns: dictionary of joins, filters, grouped columns and columns read per table
+
+    """
+    query = re.sub(r"'[^']*'", "''", query)
+    aliases = {}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', query, re.I):
+        if table in table_columns:
+            aliases[table] = table
+            if alias and alias.lower() not in SQL_WORDS:
+                aliases[alias] = table
+
+    def resolve(qualifier, column):
+        if qualifier:
+            table = aliases.get(qualifier)
+            return table if table and column in table_columns[table] else None
+        tables = {table for table in aliases.values() if column in table_columns[table]}
+        return tables.pop() if len(tables) == 1 else None
+
+    joins = []
+    for match in re.finditer(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', query):
+        left, right = resolve(*match.group(1, 2)), resolve(*match.group(3, 4))
+        if left and right and left != right:
+            joins.append((left, match.group(2), right, match.group(4)))
+    unjoined = re.sub(r'\b\w+\.\w+\s*=\s*\w+\.\w+', '', query)
+
+    filters = []
+    where = re.search(r'\bWHERE\b(.*?)(?=\bGROUP BY\b|\bORDER BY\b|\bHAVING\b|\bLIMIT\b|$)', unjoined, re.I | re.S)
+    if where:
+        for qualifier, column, operator in re.findall(r'\b(?:(\w+)\.)?(\w+)\s*(BETWEEN|[<>!=]=?|<>|IN\b|LIKE\b)',
+                                                      where.group(1), re.I):
+            table = resolve(qualifier, column)
+            if table:
+                kind = 'range' if operator.upper() == 'BETWEEN' or operator in ('<', '>', '<=', '>=') else 'equal'
+                filters.append((table, column, kind))
+
+    grouped = []
+    for clause in re.findall(r'\b(?:GROUP|ORDER) BY\b(.*?)(?=\bORDER BY\b|\bHAVING\b|\bLIMIT\b|$)', query,
+                             re.I | re.S):
+        for qualifier, column in re.findall(r'\b(?:(\w+)\.)?(\w+)\b', clause):
+            table = resolve(qualifier, column)
+            if table:
+                grouped.append((table, column))
+
+    columns = {table: set() for table in aliases.values()}
+    for qualifier, column in re.findall(r'\b(?:(\w+)\.)?(\w+)\b', query):
+        table = resolve(qualifier, column)
+        if table:
+            columns[table].add(column)
+    for qualifier in re.findall(r'(?:\b(\w+)\.|SELECT\s+)\*', query, re.I):
+        for table in ([aliases[qualifier]] if qualifier in aliases else set(aliases.values())):
+            columns[table].update(table_columns[table])
+
+    return {'joins': joins, 'filters': filters, 'grouped': grouped, 'columns': columns}
+
+
+def suggest_keys(tables, patterns, all_threshold):
+    """Suggest the distribution and sort key of each table from the recorded query patterns.
+
+    Joins are weighted by how often they run times the rows of their
+    smaller table, which is what the cluster moves between nodes if the
+    join is not co-located. Joins with a table of at most all_threshold
+    rows are co-located by copying that table to every node (ALL). For
+    the other joins, from the heaviest down, both tables are distributed
+    on their join columns unless one of them already has another distkey.
+    Tables without a distkey are distributed EVEN. The sort key is the column the queries
+    filter, group or join on most, range filters counting most since zone
+    maps let them skip blocks; tables no query uses keep their sort key.
+
+    Parameters:
+    tables (dict): table name mapped to dictionary with rows, columns and current keys
+    patterns (list): query patterns returned by analyze_query
+    all_threshold (int): largest table distributed ALL
+
+    Returns: dictionary of table name mapped to dictionary of diststyle, distkey and sortkey
+
+    """
+    joins = Counter()
+    uses = Counter()
+    for pattern in patterns:
+        for left, left_column, right, right_column in pattern['joins']:
+            joins[tuple(sorted([(left, left_column), (right, right_column)]))] += 1
+            uses[left, left_column, 'join'] += 1
+            uses[right, right_column, 'join'] += 1
+        for table, column, kind in pattern['filters']:
+            uses[table, column, kind] += 1
+        for table, column in pattern['grouped']:
+            uses[table, column, 'group'] += 1
+
+    def cost(join):
+        (left, left_column), (right, right_column) = join
+        return joins[join] * min(tables[left]['rows'], tables[right]['rows'])
+
+    distkeys = {}
+    joined = set()
+    for join in sorted(joins, key=cost, reverse=True):
+        joined.update(table for table, column in join)
+        if min(tables[table]['rows'] for table, column in join) <= all_threshold:
+            continue
+        if all(distkeys.get(table, column) == column for table, column in join):
+            distkeys.update(join)
+
+    keys = {}
+    for table, info in tables.items():
+        if table in distkeys:
+            diststyle = 'KEY'
+        elif table in joined and info['rows'] <= all_threshold:
+            diststyle = 'ALL'
+        else:
+            diststyle = 'EVEN'
+
+        scores = Counter()
+        for (used_table, column, kind), count in uses.items():
+            if used_table == table:
+                scores[column] += SORT_KEY_WEIGHTS[kind] * count
+        sortkey = max(scores, key=lambda column: (scores[column], column)) if scores else info['keys']['sortkey']
+        keys[table] = {'diststyle': diststyle, 'distkey': distkeys.get(table), 'sortkey': sortkey}
+    return keys
+
+
+def co_located(join, keys):
+    """Return True if a join runs without moving rows between nodes."""
+    (left, left_column), (right, right_column) = join
+    if keys[left]['diststyle'] == 'ALL' or keys[right]['diststyle'] == 'ALL':
+        return True
+    return keys[left]['distkey'] == left_column and keys[right]['distkey'] == right_column
+
+
+def scan_estimates(tables, patterns):
+    """Estimate bytes each query scans with the default and the suggested encodings.
+
+    Only the columns a query reads are scanned, so its bytes are the rows
+    times the encoded bytes per row of those columns.
+
+    Returns: list of dictionaries with default and advised bytes and joins co-located before and after
+
+    """
+    estimates = []
+    for pattern in patterns:
+        default_bytes = advised_bytes = 0
+        for table, columns in pattern['columns'].items():
+            for suggestion in tables[table]['encodings']:
+                if suggestion['column'] in columns:
+                    default_bytes += tables[table]['rows'] * suggestion['default_bytes']
+                    advised_bytes += tables[table]['rows'] * suggestion['encoded_bytes']
+        joins = [tuple(sorted([(left, left_column), (right, right_column)]))
+                 for left, left_column, right, right_column in pattern['joins']]
+        estimates.append({
+            'default_bytes': round(default_bytes),
+            'advised_bytes': round(advised_bytes),
+            'joins': len(joins),
+            'co_located_before': sum(co_located(join, {table: info['keys'] for table, info in tables.items()})
+                                     for join in joins),
+            'co_located_after': sum(co_located(join, {table: info['advised'] for table, info in tables.items()})
+                                    for join in joins),
+        })
+    return estimates
+
+
+def compression_analysis(cur, table):
+    """Return column mapped to (encoding, estimated reduction in percent) of ANALYZE COMPRESSION of a table.
+
+    Returns an empty dictionary if the database cannot analyze the table,
+    e.g. a Postgres stand-in or a cluster where the table is not loaded.
+    """
+    conn = cur.connection
+    conn.rollback()
+    conn.autocommit = True
+    try:
+        cur.execute(analyze_compression.format(table))
+        return {column: (encoding, float(reduction)) for name, column, encoding, reduction in cur.fetchall()}
+    except psycopg2.Error:
+        return {}
+    finally:
+        conn.autocommit = False
+
+
+def advise(cur, queries, sample_rows=10000, all_threshold=1000000):
+    """Sample the star schema tables from staging and suggest encodings and keys for the recorded queries.
+
+    A table keeps its current sort key when the suggested encodings in
+    the order of the suggested one would not make it smaller.
+
+    Parameters:
+    cur (psycopg2.cursor): cursor of a database with loaded staging tables
+    queries (list): recorded SELECT statements against the star schema
+    sample_rows (int): rows sampled per table
+    all_threshold (int): largest table distributed ALL
+
+    Returns: dictionary of per-table suggestions and per-query scan estimates
+
+    """
+    tables = {}
+    for table, (create_variable, insert_variable) in STAR_TABLES.items():
+        name, columns, keys = parse_create(getattr(sql_queries, create_variable))
+        rows, sample = sample_table(cur, getattr(sql_queries, insert_variable), sample_rows)
+        if 'IDENTITY' in columns[0][2]:
+            # the identity column is not part of the insert
+            sample = [(None,) + row for row in sample]
+        tables[table] = {'rows': rows, 'columns': columns, 'keys': keys, 'sample': sample}
+
+    table_columns = {table: [column[0] for column in info['columns']] for table, info in tables.items()}
+    patterns = [analyze_query(query, table_columns) for query in queries]
+    advised = suggest_keys(tables, patterns, all_threshold)
+
+    for table, info in tables.items():
+        analyzed = compression_analysis(cur, table)
+        sample = info.pop('sample')
+        encodings = suggest_encodings(info['columns'], sample, advised[table]['sortkey'], info['keys']['sortkey'],
+                                      analyzed)
+        if sum(suggestion['encoded_bytes'] for suggestion in encodings) >= \
+                sum(suggestion['default_bytes'] for suggestion in encodings):
+            advised[table]['sortkey'] = info['keys']['sortkey']
+            encodings = suggest_encodings(info['columns'], sample, info['keys']['sortkey'], info['keys']['sortkey'],
+                                          analyzed)
+        info['advised'] = advised[table]
+        info['encodings'] = encodings
+        for size in ['raw_bytes', 'default_bytes', 'encoded_bytes']:
+            info[size.replace('_bytes', '_table_bytes')] = round(
+                info['rows'] * sum(suggestion[size] for suggestion in info['encodings']))
+    return {'tables': tables, 'queries': scan_estimates(tables, patterns)}
+
+
+def create_statement(table, columns, encodings, keys):
+    """Return CREATE TABLE statement of a table with column encodings and distribution and sort keys."""
+    definitions = []
+    for (name, data_type, constraints), suggestion in zip(columns, encodings):
+        # ENCODE goes after the type and IDENTITY, before the column constraints
+        if constraints.startswith('IDENTITY'):
+            data_type, constraints = data_type + ' IDENTITY', constraints[len('IDENTITY'):].strip()
+        definitions.append(' '.join(filter(None, [name, data_type, 'ENCODE', suggestion['encoding'], constraints])))
+    attributes = 'DISTSTYLE {}'.format(keys['diststyle'])
+    if keys['distkey']:
+        attributes += ' DISTKEY ({})'.format(keys['distkey'])
+    if keys['sortkey']:
+        attributes += ' SORTKEY ({})'.format(keys['sortkey'])
+    return 'CREATE TABLE IF NOT EXISTS {} (\n    {})\n    {};'.format(table, ', \n    '.join(definitions), attributes)
+
+
+def summary(advice):
+    """Return lines summarizing the suggested keys and the estimated storage and scan savings."""
+    def change(before, after):
+        return '{:+.1%}'.format(after / before - 1) if before else 'n/a'
+
+    lines = []
+    for table, info in advice['tables'].items():
+        keys = info['advised']
+        lines.append('{}: {} rows, DISTSTYLE {}{}, SORTKEY {}, {} bytes raw, {} by default, {} advised ({})'.format(
+            table, info['rows'], keys['diststyle'], ' ({})'.format(keys['distkey']) if keys['distkey'] else '',
+            keys['sortkey'], info['raw_table_bytes'], info['default_table_bytes'], info['encoded_table_bytes'],
+            change(info['default_table_bytes'], info['encoded_table_bytes'])))
+    for i, estimate in enumerate(advice['queries'], 1):
+        lines.append('query {}: {} bytes scanned by default, {} advised ({}), '
+                     '{}/{} joins co-located before, {}/{} after'.format(
+                         i, estimate['default_bytes'], estimate['advised_bytes'],
+                         change(estimate['default_bytes'], estimate['advised_bytes']),
+                         estimate['co_located_before'], estimate['joins'],
+                         estimate['co_located_after'], estimate['joins']))
+    return lines
+
+
+def write_variant(advice, source, output):
+    """Write a copy of sql_queries.py with the star schema tables created with the suggested encodings and keys.
+
+    Parameters:
+    advice (dict): suggestions returned by advise
+    source (string): path of sql_queries.py
+    output (string): path of the generated module
+
+    Returns: None
+
+    """
+    with open(source) as f:
+        text = f.read()
+    for table, (create_variable, insert_variable) in STAR_TABLES.items():
+        info = advice['tables'][table]
+        statement = create_statement(table, info['columns'], info['encodings'], info['advised'])
+        text = re.sub(r'^{} = \(""".*?"""\)'.format(create_variable),
+                      lambda match: '{} = ("""{}\n""")'.format(create_variable, statement), text, flags=re.M | re.S)
+
+    header = ['# Generated by advisor.py from {} on {}, rerun it rather than editing this file.'.format(
+        source, date.today().isoformat()),
+              '# Estimated bytes with the default encodings of the original DDL and the advised ones:']
+    header.extend('#   ' + line for line in summary(advice))
+    with open(output, 'w') as f:
+        f.write('\n'.join(header) + '\n\n' + text)
+
+
+def recorded_queries(cur, conn, limit):
+    """Return the most recent SELECT statements of users logged in stl_query, none if the database has no log."""
+    try:
+        cur.execute(recorded_queries_select, (limit,))
+        return [query for query, in cur.fetchall()]
+    except psycopg2.Error:
+        conn.rollback()
+        return []
+
+
+def main():
+    """Suggest column encodings and distribution and sort keys and write them as a variant of sql_queries.py."""
+    parser = argparse.ArgumentParser(description='Suggest column encodings and dist and sort keys of the star schema.')
+    parser.add_argument('--dsn', help='connection string of a Postgres stand-in with loaded staging tables, '
+                                      'the cluster of dwh.cfg by default')
+    parser.add_argument('--queries', default='analyst_queries.sql', help='file of recorded SELECT statements')
+    parser.add_argument('--recorded', type=int, default=100,
+                        help='also read this many recent user queries from stl_query, if the database logs them')
+    parser.add_argument('--sample-rows', type=int, default=10000, help='rows sampled per table')
+    parser.add_argument('--all-threshold', type=int, default=1000000, help='largest joined table distributed ALL')
+    parser.add_argument('--output', default='sql_queries_advised.py', help='generated variant of sql_queries.py')
+    parser.add_argument('--report', help='write the suggestions and estimates to this JSON file')
+    args = parser.parse_args()
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+        conn.set_client_encoding('UTF8')
+    else:
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    cur = conn.cursor()
+
+    with open(args.queries) as f:
+        queries = split_queries(f.read())
+    queries.extend(recorded_queries(cur, conn, args.recorded))
+    advice = advise(cur, queries, args.sample_rows, args.all_threshold)
+    conn.close()
+
+    write_variant(advice, 'sql_queries.py', args.output)
+    for line in summary(advice):
+        print(line)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(advice, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
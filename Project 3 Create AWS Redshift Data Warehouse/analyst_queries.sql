@@ -0,0 +1,50 @@
+-- typical analyst queries, read by advisor.py as the recorded query patterns of the star schema
+
+-- most played songs of a month
+SELECT s.title, a.name, COUNT(*) AS plays
+FROM songplays sp
+JOIN songs s ON sp.song_id = s.song_id
+JOIN artists a ON sp.artist_id = a.artist_id
+WHERE sp.start_time BETWEEN '2018-11-01' AND '2018-11-30'
+GROUP BY s.title, a.name
+ORDER BY plays DESC
+LIMIT 10;
+
+-- plays of paid users by hour of the day
+SELECT t.hour, COUNT(*) AS plays
+FROM songplays sp
+JOIN time t ON sp.start_time = t.start_time
+JOIN users u ON sp.user_id = u.user_id
+WHERE u.level = 'paid'
+GROUP BY t.hour
+ORDER BY t.hour;
+
+-- daily active users of the last weeks
+SELECT t.year, t.week, t.weekday, COUNT(DISTINCT sp.user_id) AS active_users
+FROM songplays sp
+JOIN time t ON sp.start_time = t.start_time
+WHERE t.year = 2018 AND t.week >= 45
+GROUP BY t.year, t.week, t.weekday;
+
+-- plays by artist location
+SELECT a.location, COUNT(*) AS plays
+FROM songplays sp
+JOIN artists a ON sp.artist_id = a.artist_id
+GROUP BY a.location
+ORDER BY plays DESC;
+
+-- songs of an artist
+SELECT s.title, s.year, s.duration
+FROM songs s
+JOIN artists a ON s.artist_id = a.artist_id
+WHERE a.name = 'Elena';
+
+-- test query of the README, joining all five tables
+SELECT u.first_name, u.last_name, s.title, a.name, t.weekday, sp.location
+FROM songplays sp
+JOIN users u ON sp.user_id = u.user_id
+JOIN songs s ON sp.song_id = s.song_id
+JOIN artists a ON sp.artist_id = a.artist_id
+JOIN time t ON sp.start_time = t.start_time
+WHERE sp.start_time >= '2018-11-15'
+ORDER BY sp.start_time;
@@ -1,32 +1,40 @@
+import argparse
+import importlib
 import configparser
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, queries=drop_table_queries):
     """Run drop table queries."""
-    for query in drop_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """Run create table queries."""
-    for query in create_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
 def main():
     """Create database and tables."""
+    parser = argparse.ArgumentParser(description='Create the staging and analytical tables.')
+    parser.add_argument('--queries', default='sql_queries',
+                        help='module of the table statements, such as sql_queries_advised written by advisor.py')
+    args = parser.parse_args()
+    queries = importlib.import_module(args.queries)
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
     cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    drop_tables(cur, conn, queries.drop_table_queries)
+    create_tables(cur, conn, queries.create_table_queries)
 
     conn.close()
 
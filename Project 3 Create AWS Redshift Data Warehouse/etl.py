@@ -1,13 +1,45 @@
+import argparse
 import configparser
+from datetime import datetime
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from psycopg2.extras import execute_values
+from sql_queries import (copy_queries, insert_table_queries, truncate_staging_queries, merge_drop_queries,
+                         merge_table_queries, user_last_event_truncate, loaded_files_select,
+                         loaded_files_insert, songplays_any_select, staged_events_count_select)
+import staging
+import task_runner
 
 
 def load_staging_tables(cur, conn):
-    """Stage data from S3 into tables in Redshift."""
-    for query in copy_table_queries:
+    """Stage data from S3 into tables in Redshift.
+
+    Returns: list of (staging table, url, size) of the files read by the COPYs
+
+    """
+    files = []
+    for table, query in copy_queries.items():
         cur.execute(query)
+        files.extend((table, url, size) for url, size in staging.scanned_files(cur))
         conn.commit()
+    return files
+
+
+def run_load_tasks(dsn, workers, trace_path=None):
+    """Stage and transform with task_runner, running independent statements in parallel.
+
+    Parameters:
+    dsn (string): connection string of the cluster
+    workers (int): statements run at the same time
+    trace_path (string): JSON file the timing trace is written to, if given
+
+    Returns: list of (staging table, url, size) of the files read by the COPYs
+
+    """
+    trace = task_runner.run_tasks(dsn, task_runner.LOAD_TASKS, workers)
+    task_runner.print_trace(trace)
+    if trace_path:
+        task_runner.write_trace(trace, trace_path)
+    return [(entry['task'], url, size) for entry in trace for url, size in entry['files']]
 
 
 def insert_tables(cur, conn):
@@ -17,19 +49,132 @@ def insert_tables(cur, conn):
         conn.commit()
 
 
+def truncate_staging_tables(cur, conn):
+    """Empty the staging tables, so they only hold the data of the next load."""
+    for query in truncate_staging_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def truncate_user_last_events(cur, conn):
+    """Empty user_last_events, so a full load rebuilds it instead of adding a row per user and load."""
+    cur.execute(user_last_event_truncate)
+    conn.commit()
+
+
+def loaded_files(cur):
+    """Return set of (staging table, url) of the files of earlier loads."""
+    cur.execute(loaded_files_select)
+    return set(cur.fetchall())
+
+
+def record_loaded_files(cur, files):
+    """Add files to loaded_files in the current transaction.
+
+    Parameters:
+    cur (psycopg2.cursor): cursor of the cluster
+    files (list): (staging table, url, size) of the loaded files
+
+    Returns: None
+
+    """
+    loaded_at = datetime.now()
+    execute_values(cur, loaded_files_insert, [(table, url, size, loaded_at) for table, url, size in files])
+
+
+def merge_tables(cur, conn, files):
+    """Merge the staged files of an incremental load into the analytical tables.
+
+    The staging tables only hold files missing from loaded_files, so
+    every staged event is merged, including late files of earlier days.
+    Users, songs, artists, time and song keys are upserted by deleting
+    and re-inserting the keys of the staged rows; songplays are appended.
+    All tables and loaded_files change in one transaction, so a failed
+    load leaves the warehouse as it was and is simply run again.
+
+    Parameters:
+    cur (psycopg2.cursor): cursor of the cluster
+    conn (psycopg2.connection): connection to the cluster
+    files (list): (staging table, url, size) of the staged files
+
+    Returns: number of events merged
+
+    """
+    cur.execute(staged_events_count_select)
+    num_events = cur.fetchone()[0]
+
+    for query in merge_drop_queries:
+        cur.execute(query)
+    for query in merge_table_queries:
+        cur.execute(query)
+    record_loaded_files(cur, files)
+    conn.commit()
+    return num_events
+
+
 def main():
     """Load staging tables from S3 then transform into analytical tables."""
+    parser = argparse.ArgumentParser(description='Load the sparkify data warehouse from S3.')
+    parser.add_argument('--manifest', action='store_true',
+                        help='stage through COPY manifests balanced over the slices of the cluster')
+    parser.add_argument('--incremental', action='store_true',
+                        help='stage only input files not loaded before and merge them into the analytical tables')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run independent COPYs and inserts in parallel on this many connections')
+    parser.add_argument('--trace', help='write the timing trace of a parallel load to this JSON file')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    if args.workers > 1 and (args.manifest or args.incremental):
+        parser.error('--workers only runs full loads, it cannot be combined with --manifest or --incremental')
+
+    manifest_prefix = config.get('STAGING', 'MANIFEST_PREFIX').strip("'")
+    if (args.manifest or args.incremental) and not manifest_prefix:
+        parser.error('set MANIFEST_PREFIX in dwh.cfg to stage through manifests')
+
+    dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+
+    if not args.incremental:
+        truncate_user_last_events(cur, conn)
+
+    loaded = set()
+    if args.incremental:
+        loaded = loaded_files(cur)
+        cur.execute(songplays_any_select)
+        if not loaded and cur.fetchone():
+            conn.close()
+            parser.error('songplays holds data but loaded_files is empty, so the files of earlier loads are '
+                         'unknown; recreate the tables with create_tables.py and run a full load first')
+        truncate_staging_tables(cur, conn)
+
+    if args.workers > 1:
+        files = run_load_tasks(dsn, args.workers, args.trace)
+    # incremental loads stage the files missing from loaded_files through a manifest
+    elif args.manifest or args.incremental:
+        s3 = staging.s3_client()
+        slices = staging.slice_count(cur, conn, config.getint('STAGING', 'SLICES'))
+        results = staging.stage_tables(cur, conn, s3, staging.RedshiftLoader(cur), manifest_prefix, slices, loaded)
+        staging.print_results(results)
+        files = [(result['table'], url, size) for result in results for url, size in result['objects']]
+    else:
+        files = load_staging_tables(cur, conn)
+
+    if args.incremental:
+        num_events = merge_tables(cur, conn, files)
+        print('{} new events from {} new files merged'.format(num_events, len(files)))
+    else:
+        # parallel loads ran the inserts as tasks
+        if args.workers == 1:
+            insert_tables(cur, conn)
+        record_loaded_files(cur, files)
+        conn.commit()
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -14,11 +14,15 @@ REGION = config.get('GEO', 'REGION')
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
+staging_plays_table_drop = "DROP TABLE IF EXISTS staging_plays"
+song_key_table_drop = "DROP TABLE IF EXISTS song_keys"
+user_last_event_table_drop = "DROP TABLE IF EXISTS user_last_events"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+loaded_file_table_drop = "DROP TABLE IF EXISTS loaded_files"
 
 # CREATE TABLES
 
@@ -56,6 +60,32 @@ staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs (
     year int)
 """)
 
+# plays and songs are distributed on their song match key, so songplays joins them on each slice
+staging_plays_table_create = ("""CREATE TABLE IF NOT EXISTS staging_plays (
+    song_key char(32) distkey, 
+    ts timestamp, 
+    userId int, 
+    level text, 
+    sessionId int, 
+    location text, 
+    userAgent text)
+""")
+
+# kept across incremental loads like the dimensions, since plays are matched against all songs loaded so far
+song_key_table_create = ("""CREATE TABLE IF NOT EXISTS song_keys (
+    song_key char(32) distkey, 
+    song_id text NOT NULL, 
+    artist_id text NOT NULL)
+""")
+
+# time of the latest event of each user, kept across incremental loads so that a late file
+# of earlier days does not replace a user's level with an older one
+user_last_event_table_create = ("""CREATE TABLE IF NOT EXISTS user_last_events (
+    user_id int PRIMARY KEY sortkey, 
+    ts timestamp NOT NULL)
+    diststyle ALL;
+""")
+
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (
     songplay_id int IDENTITY PRIMARY KEY, 
     start_time timestamp NOT NULL REFERENCES time(start_time) sortkey, 
@@ -104,6 +134,14 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
     weekday int NOT NULL)
 """)
 
+# input files of every load, incremental loads only stage the files that are not listed here
+loaded_file_table_create = ("""CREATE TABLE IF NOT EXISTS loaded_files (
+    staging_table text NOT NULL, 
+    url varchar(1024) NOT NULL, 
+    bytes bigint NOT NULL, 
+    loaded_at timestamp NOT NULL)
+""")
+
 # STAGING TABLES
 
 staging_events_copy = ("""COPY staging_events FROM {} iam_role {} region {} FORMAT AS JSON {} timeformat 'epochmillisecs';
@@ -112,14 +150,67 @@ staging_events_copy = ("""COPY staging_events FROM {} iam_role {} region {} FORM
 staging_songs_copy = ("""COPY staging_songs FROM {} iam_role {} region {} FORMAT AS JSON 'auto';
 """).format(SONG_DATA, ARN, REGION)
 
+# MANIFEST STAGING
+# {{}} is replaced by the url of a manifest of the files to load, written by staging.py;
+# compression encodings and statistics are left to the table design and ANALYZE
+
+staging_events_copy_manifest = ("""COPY staging_events FROM '{{}}' iam_role {} region {} MANIFEST FORMAT AS JSON {} timeformat 'epochmillisecs' COMPUPDATE OFF STATUPDATE OFF;
+""").format(ARN, REGION, LOG_JSONPATH)
+
+staging_songs_copy_manifest = ("""COPY staging_songs FROM '{{}}' iam_role {} region {} MANIFEST FORMAT AS JSON 'auto' COMPUPDATE OFF STATUPDATE OFF;
+""").format(ARN, REGION)
+
+slice_count_select = ("""SELECT COUNT(*) FROM stv_slices""")
+
+# files read by the last COPY of this session, loadtime in microseconds
+file_scan_select = ("""SELECT slice, TRIM(name), lines, bytes, loadtime FROM stl_file_scan WHERE query = pg_last_copy_id() ORDER BY slice, name""")
+
+# most recent queries of users, read by advisor.py as the recorded query patterns
+recorded_queries_select = ("""SELECT TRIM(querytxt) FROM stl_query WHERE userid > 1 AND querytxt ILIKE 'select%%' ORDER BY starttime DESC LIMIT %s""")
+
+# encodings Redshift suggests for the loaded rows of a table and the estimated reduction from the
+# current encoding in percent, one row per column; cannot run in a transaction block
+analyze_compression = ("""ANALYZE COMPRESSION {}""")
+
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+staging_plays_truncate = "TRUNCATE staging_plays"
+
+# full loads rebuild user_last_events from all staged events
+user_last_event_truncate = "TRUNCATE user_last_events"
+
+# SONG MATCH KEYS
+# plays are matched to songs by title, artist name and duration rather than title alone; the
+# key is the MD5 of the lower-cased, trimmed title and artist name and the duration in milliseconds
+
+SONG_KEY = ("""MD5(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})) || '|' || CAST(CAST(ROUND({duration} * 1000) AS bigint) AS varchar))""")
+
+staging_plays_insert = ("""INSERT INTO staging_plays (song_key, ts, userId, level, sessionId, location, userAgent)
+                           SELECT {}, se.ts, se.userId, se.level, se.sessionId, se.location, se.userAgent
+                           FROM staging_events se
+                           WHERE se.page = 'NextSong'
+""").format(SONG_KEY.format(title='se.song', artist='se.artist', duration='se.length'))
+
+song_key_insert = ("""INSERT INTO song_keys (song_key, song_id, artist_id)
+                      SELECT DISTINCT {}, ss.song_id, ss.artist_id
+                      FROM staging_songs ss
+                      WHERE ss.song_id IS NOT NULL AND ss.artist_id IS NOT NULL
+""").format(SONG_KEY.format(title='ss.title', artist='ss.artist_name', duration='ss.duration'))
+
+user_last_event_insert = ("""INSERT INTO user_last_events (user_id, ts)
+                             SELECT se.userId, MAX(se.ts)
+                             FROM staging_events se
+                             WHERE se.userId IS NOT NULL
+                             GROUP BY se.userId
+""")
+
 # FINAL TABLES
 
 songplay_table_insert = ("""INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
-                            SELECT DISTINCT se.ts, se.userId, se.level, ss.song_id, ss.artist_id, se.sessionId, se.location, se.userAgent
-                            FROM staging_events se 
-                            INNER JOIN staging_songs ss 
-                                ON se.song = ss.title
-                            WHERE se.page = 'NextSong'
+                            SELECT DISTINCT sp.ts, sp.userId, sp.level, sk.song_id, sk.artist_id, sp.sessionId, sp.location, sp.userAgent
+                            FROM staging_plays sp 
+                            INNER JOIN song_keys sk 
+                                ON sp.song_key = sk.song_key
 """)
 
 user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level)
@@ -156,9 +247,93 @@ time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, ye
                         WHERE se.page = 'NextSong'
 """)
 
+# INCREMENTAL MERGE
+# the staging tables only hold the files of this load; dimensions are upserted by deleting and
+# re-inserting the keys of the staged rows, so the merge never compares against whole tables
+
+loaded_files_select = ("""SELECT staging_table, url FROM loaded_files""")
+
+loaded_files_insert = ("""INSERT INTO loaded_files (staging_table, url, bytes, loaded_at) VALUES %s""")
+
+songplays_any_select = ("""SELECT 1 FROM songplays LIMIT 1""")
+
+staged_events_count_select = ("""SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong'""")
+
+# latest row of each staged user, unless an earlier load saw a later event of the user, e.g.
+# when a log file arrives late
+new_users_create = ("""CREATE TEMP TABLE new_users AS
+                       SELECT latest.user_id, latest.first_name, latest.last_name, latest.gender, latest.level,
+                              latest.ts
+                       FROM (SELECT se.userId AS user_id, se.firstName AS first_name, se.lastName AS last_name,
+                                    se.gender, se.level, se.ts,
+                                    ROW_NUMBER() OVER (PARTITION BY se.userId ORDER BY se.ts DESC) AS position
+                             FROM staging_events se
+                             WHERE se.userId IS NOT NULL) latest
+                       LEFT JOIN (SELECT user_id, MAX(ts) AS ts FROM user_last_events GROUP BY user_id) le
+                           ON le.user_id = latest.user_id
+                       WHERE latest.position = 1 AND (le.ts IS NULL OR le.ts < latest.ts)
+""")
+
+user_merge_delete = ("""DELETE FROM users USING new_users WHERE users.user_id = new_users.user_id""")
+
+user_merge_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level)
+                        SELECT user_id, first_name, last_name, gender, level FROM new_users
+""")
+
+user_last_event_merge_delete = ("""DELETE FROM user_last_events USING new_users WHERE user_last_events.user_id = new_users.user_id""")
+
+user_last_event_merge_insert = ("""INSERT INTO user_last_events (user_id, ts) SELECT user_id, ts FROM new_users""")
+
+new_songs_create = ("""CREATE TEMP TABLE new_songs AS
+                       SELECT DISTINCT ss.song_id, ss.title, ss.artist_id, ss.year, CAST(ss.duration AS numeric) AS duration
+                       FROM staging_songs ss
+""")
+
+song_merge_delete = ("""DELETE FROM songs USING new_songs WHERE songs.song_id = new_songs.song_id""")
+
+song_merge_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration)
+                        SELECT song_id, title, artist_id, year, duration FROM new_songs
+""")
+
+new_artists_create = ("""CREATE TEMP TABLE new_artists AS
+                         SELECT DISTINCT ss.artist_id, 
+                                         ss.artist_name AS name, 
+                                         CASE WHEN ss.artist_location IS NULL THEN 'N/A' ELSE ss.artist_location END AS location, 
+                                         CASE WHEN ss.artist_latitude IS NULL THEN 0.0 ELSE ss.artist_latitude END AS lattitude, 
+                                         CASE WHEN ss.artist_longitude IS NULL THEN 0.0 ELSE ss.artist_longitude END AS longitude
+                         FROM staging_songs ss
+                         WHERE ss.artist_id IS NOT NULL
+""")
+
+artist_merge_delete = ("""DELETE FROM artists USING new_artists WHERE artists.artist_id = new_artists.artist_id""")
+
+artist_merge_insert = ("""INSERT INTO artists (artist_id, name, location, lattitude, longitude)
+                          SELECT artist_id, name, location, lattitude, longitude FROM new_artists
+""")
+
+# a late file may hold start times loaded before, time_table_insert then re-inserts them
+time_merge_delete = ("""DELETE FROM time USING staging_events se WHERE time.start_time = se.ts AND se.page = 'NextSong'""")
+
+# song_keys holds the songs of earlier loads as well, since plays are matched against all of them
+song_key_merge_delete = ("""DELETE FROM song_keys USING staging_songs ss WHERE song_keys.song_id = ss.song_id""")
+
+new_users_drop = "DROP TABLE IF EXISTS new_users"
+new_songs_drop = "DROP TABLE IF EXISTS new_songs"
+new_artists_drop = "DROP TABLE IF EXISTS new_artists"
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, staging_plays_table_create, song_key_table_create, user_last_event_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, loaded_file_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, staging_plays_table_drop, song_key_table_drop, user_last_event_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, loaded_file_table_drop]
+copy_queries = {'staging_events': staging_events_copy, 'staging_songs': staging_songs_copy}
+copy_table_queries = list(copy_queries.values())
+insert_table_queries = [staging_plays_insert, song_key_insert, songplay_table_insert, user_table_insert, user_last_event_insert, song_table_insert, artist_table_insert, time_table_insert]
+truncate_staging_queries = [staging_events_truncate, staging_songs_truncate, staging_plays_truncate]
+merge_drop_queries = [new_users_drop, new_songs_drop, new_artists_drop]
+merge_table_queries = [new_users_create, user_merge_delete, user_merge_insert,
+                       user_last_event_merge_delete, user_last_event_merge_insert,
+                       new_songs_create, song_merge_delete, song_merge_insert,
+                       new_artists_create, artist_merge_delete, artist_merge_insert,
+                       time_merge_delete, time_table_insert, staging_plays_insert,
+                       song_key_merge_delete, song_key_insert, songplay_table_insert]
+copy_manifest_queries = {'staging_events': staging_events_copy_manifest, 'staging_songs': staging_songs_copy_manifest}
@@ -0,0 +1,352 @@
+import json
+import time
+import heapq
+import argparse
+import itertools
+import configparser
+from datetime import datetime, timedelta
+import psycopg2
+from psycopg2.extras import execute_values
+from sql_queries import (LOG_DATA, SONG_DATA, LOG_JSONPATH, REGION, copy_manifest_queries, slice_count_select,
+                         file_scan_select, staging_events_table_drop, staging_songs_table_drop,
+                         staging_plays_table_drop, song_key_table_drop, staging_events_table_create,
+                         staging_songs_table_create, staging_plays_table_create, song_key_table_create,
+                         staging_plays_insert, song_key_insert)
+
+# optional dependency, only needed to stage from Amazon S3
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+# staging table: (S3 prefix of its input files, JSON format of its COPY)
+STAGING_TABLES = {
+    'staging_events': (LOG_DATA.strip("'"), LOG_JSONPATH.strip("'")),
+    'staging_songs': (SONG_DATA.strip("'"), 'auto'),
+}
+
+
+def parse_s3_url(url):
+    """Return bucket and key of an s3:// url."""
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def s3_client():
+    """Return boto3 S3 client in the region of the cluster."""
+    if boto3 is None:
+        raise ImportError('staging from S3 requires boto3, pip install boto3')
+    return boto3.client('s3', region_name=REGION.strip("'"))
+
+
+def list_objects(s3, url):
+    """Return list of (url, size) of the non-empty objects under an S3 prefix, page by page."""
+    bucket, prefix = parse_s3_url(url)
+    objects = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        objects.extend(('s3://{}/{}'.format(bucket, obj['Key']), obj['Size'])
+                       for obj in response.get('Contents', []) if obj['Size'] > 0)
+        if not response.get('IsTruncated'):
+            return objects
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def balance_files(objects, slices):
+    """Assign files to slices so that every slice loads about the same number of bytes.
+
+    Files are taken largest first and given to the slice with the fewest
+    bytes so far.
+
+    Parameters:
+    objects (list): (url, size) of the files to load
+    slices (int): number of slices of the cluster
+
+    Returns: list of lists of (url, size), one per slice
+
+    """
+    loads = [(0, i) for i in range(slices)]
+    assignment = [[] for i in range(slices)]
+    for url, size in sorted(objects, key=lambda obj: (-obj[1], obj[0])):
+        load, i = heapq.heappop(loads)
+        assignment[i].append((url, size))
+        heapq.heappush(loads, (load + size, i))
+    return assignment
+
+
+def build_manifest(assignment):
+    """Return COPY manifest of files assigned to slices.
+
+    Files are listed in rounds of one file per slice, largest round first,
+    so the number of files in flight matches the slice count and files
+    loaded side by side have similar sizes.
+    """
+    entries = []
+    for files in itertools.zip_longest(*assignment):
+        entries.extend({'url': url, 'mandatory': True, 'meta': {'content_length': size}}
+                       for url, size in filter(None, files))
+    return {'entries': entries}
+
+
+def write_manifest(s3, manifest, url):
+    """Upload a manifest to S3."""
+    bucket, key = parse_s3_url(url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest, indent=2).encode())
+
+
+def slice_count(cur, conn, default):
+    """Return number of slices of the cluster, default if the database does not report them."""
+    try:
+        cur.execute(slice_count_select)
+        return cur.fetchone()[0]
+    except psycopg2.Error:
+        conn.rollback()
+        return default
+
+
+def scanned_files(cur):
+    """Return list of (url, size) of the files read by the last COPY of the session, from stl_file_scan."""
+    cur.execute(file_scan_select)
+    sizes = {}
+    for slice_, name, lines, size, loadtime in cur.fetchall():
+        sizes[name] = sizes.get(name, 0) + size
+    return list(sizes.items())
+
+
+class RedshiftLoader:
+    """Runs manifest COPYs on Redshift and reads their per-file stats from stl_file_scan."""
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def copy(self, table, manifest_url, manifest, planned_slices):
+        """Load the files of a manifest into a staging table and return their stats.
+
+        Redshift hands the entries of a manifest to slices as they become
+        free, so the stats report the slice that actually scanned each
+        file; planned_slices is not used.
+        """
+        self.cur.execute(copy_manifest_queries[table].format(manifest_url))
+        self.cur.execute(file_scan_select)
+        return [{'slice': slice_, 'file': name, 'lines': lines, 'bytes': size, 'seconds': loadtime / 1e6}
+                for slice_, name, lines, size, loadtime in self.cur.fetchall()]
+
+
+class LocalLoader:
+    """Emulates manifest COPYs of JSON files into a Postgres stand-in of the cluster.
+
+    Files are read from the (local) S3 client one by one and mapped to
+    the columns of the table by their jsonpaths file or, for 'auto', by
+    key name, with epoch milliseconds converted to timestamps, so the
+    staging step can be run and timed without a cluster.
+    """
+
+    def __init__(self, cur, s3):
+        self.cur = cur
+        self.s3 = s3
+
+    def create_tables(self):
+        """Recreate the staging and song match key tables.
+
+        Primary keys are left out since Redshift does not enforce them,
+        and distkeys since Postgres does not know them.
+        """
+        for query in [staging_events_table_drop, staging_songs_table_drop, staging_plays_table_drop,
+                      song_key_table_drop]:
+            self.cur.execute(query)
+        for query in [staging_events_table_create, staging_songs_table_create, staging_plays_table_create,
+                      song_key_table_create]:
+            self.cur.execute(query.replace(' PRIMARY KEY', '').replace(' distkey', ''))
+
+    def insert_plays(self):
+        """Fill staging_plays and song_keys from the staged data, as the inserts of etl.py do on Redshift."""
+        for query in [staging_plays_insert, song_key_insert]:
+            self.cur.execute(query)
+
+    def copy(self, table, manifest_url, manifest, planned_slices):
+        """Load the files of a manifest into a staging table and return their stats.
+
+        Files are loaded one after the other; the stats report the slice
+        balance_files planned for each file, taken from planned_slices.
+        """
+        self.cur.execute("SELECT column_name, data_type FROM information_schema.columns "
+                         "WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position",
+                         (table,))
+        columns = self.cur.fetchall()
+        json_format = STAGING_TABLES[table][1]
+        if json_format == 'auto':
+            paths = [name for name, data_type in columns]
+        else:
+            bucket, key = parse_s3_url(json_format)
+            jsonpaths = json.load(self.s3.get_object(Bucket=bucket, Key=key)['Body'])
+            paths = [path[len("$['"):-len("']")] for path in jsonpaths['jsonpaths']]
+
+        query = 'INSERT INTO {} ({}) VALUES %s'.format(table, ', '.join(name for name, data_type in columns))
+        stats = []
+        for entry in manifest['entries']:
+            start = time.perf_counter()
+            bucket, key = parse_s3_url(entry['url'])
+            body = self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+            rows = [self.convert(record, paths, columns) for record in self.records(body)]
+            execute_values(self.cur, query, rows)
+            stats.append({'slice': planned_slices[entry['url']], 'file': entry['url'], 'lines': len(rows), 'bytes': len(body),
+                          'seconds': time.perf_counter() - start})
+        return stats
+
+    @staticmethod
+    def records(body):
+        """Yield the JSON objects of a file, one or more per line."""
+        decoder = json.JSONDecoder()
+        text = body.decode('utf8')
+        position = 0
+        while True:
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position == len(text):
+                return
+            record, position = decoder.raw_decode(text, position)
+            yield record
+
+    @staticmethod
+    def convert(record, paths, columns):
+        """Return row of column values of a JSON record."""
+        row = []
+        for path, (name, data_type) in zip(paths, columns):
+            value = record.get(path)
+            if value == '' and data_type != 'text':
+                value = None
+            elif value is not None and data_type.startswith('timestamp'):
+                value = datetime(1970, 1, 1) + timedelta(milliseconds=value)
+            elif value is not None and data_type == 'text':
+                value = str(value)
+            row.append(value)
+        return row
+
+
+def stage_tables(cur, conn, s3, loader, manifest_prefix, slices, loaded=()):
+    """List, balance and COPY the input files of each staging table through a manifest.
+
+    Parameters:
+    cur (psycopg2.cursor): cursor of the cluster
+    conn (psycopg2.connection): connection to the cluster
+    s3 (S3.Client): boto3 S3 client or LocalS3
+    loader (RedshiftLoader): loader running the COPYs, or a LocalLoader
+    manifest_prefix (string): s3:// prefix the manifests are written to
+    slices (int): number of slices of the cluster
+    loaded (set): (staging table, url) of files loaded before, which are skipped
+
+    Returns: list of dictionaries with files, bytes, skew, planned skew, seconds, (url, size) of
+        the staged objects and per-file stats of each table
+
+
+    """
+    results = []
+    for table, (data_url, json_format) in STAGING_TABLES.items():
+        objects = [(url, size) for url, size in list_objects(s3, data_url) if (table, url) not in loaded]
+        if not objects:
+            results.append({'table': table, 'manifest': None, 'files': 0, 'bytes': 0, 'slices': slices,
+                            'skew': None, 'planned_skew': None, 'seconds': 0.0, 'objects': [], 'file_stats': []})
+            continue
+
+        assignment = balance_files(objects, slices)
+        manifest = build_manifest(assignment)
+        manifest_url = '{}/{}.manifest'.format(manifest_prefix.rstrip('/'), table)
+        write_manifest(s3, manifest, manifest_url)
+
+        planned_slices = {url: i for i, files_ in enumerate(assignment) for url, size in files_}
+        start = time.perf_counter()
+        files = loader.copy(table, manifest_url, manifest, planned_slices)
+        conn.commit()
+        seconds = time.perf_counter() - start
+
+        planned_loads = [sum(size for url, size in files_) for files_ in assignment]
+        loads = {}
+        for stats in files:
+            loads[stats['slice']] = loads.get(stats['slice'], 0) + stats['bytes']
+        mean_load = sum(planned_loads) / slices
+        results.append({
+            'table': table,
+            'manifest': manifest_url,
+            'files': len(objects),
+            'bytes': sum(planned_loads),
+            'slices': slices,
+            # bytes of the busiest slice relative to an even split, as loaded and as planned; None without
+            # file scan stats, e.g. when stl_file_scan has no rows for the COPY
+            'skew': round(max(loads.values()) / mean_load, 3) if loads and mean_load else None,
+            'planned_skew': round(max(planned_loads) / mean_load, 3) if mean_load else None,
+            'seconds': round(seconds, 3),
+            'objects': objects,
+            'file_stats': files,
+        })
+    return results
+
+
+def print_results(results):
+    """Print the summary of each staging table and the load of each slice."""
+    for result in results:
+        print('{table}: {files} files, {bytes} bytes in {seconds}s, slice skew {skew} '
+              '(planned {planned_skew})'.format(**result))
+        by_slice = {}
+        for stats in result['file_stats']:
+            totals = by_slice.setdefault(stats['slice'], [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += stats['lines']
+            totals[2] += stats['bytes']
+            totals[3] += stats['seconds']
+        for slice_, (files, lines, size, seconds) in sorted(by_slice.items()):
+            print('  slice {}: {} files, {} lines, {} bytes, {:.3f}s'.format(slice_, files, lines, size, seconds))
+
+
+def main():
+    """Stage the song and log data through balanced COPY manifests."""
+    parser = argparse.ArgumentParser(description='Stage S3 data into Redshift through balanced COPY manifests.')
+    parser.add_argument('--local', metavar='DIR',
+                        help='read buckets from subdirectories of DIR and load into staging tables '
+                             'of a Postgres stand-in')
+    parser.add_argument('--dsn', default='host=127.0.0.1 dbname=studentdb user=student password=student',
+                        help='connection string of the Postgres stand-in')
+    parser.add_argument('--manifest-prefix', help='s3:// prefix the manifests are written to, '
+                                                  'MANIFEST_PREFIX of dwh.cfg by default')
+    parser.add_argument('--report', help='write per-file load stats to this JSON file')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    manifest_prefix = args.manifest_prefix or config.get('STAGING', 'MANIFEST_PREFIX').strip("'")
+    if not manifest_prefix:
+        parser.error('set MANIFEST_PREFIX in dwh.cfg or pass --manifest-prefix')
+    default_slices = config.getint('STAGING', 'SLICES')
+
+    if args.local:
+        conn = psycopg2.connect(args.dsn)
+        conn.set_client_encoding('UTF8')
+        # imported here, the stand-in is only needed without AWS
+        from stand_in import LocalS3
+        s3 = LocalS3(args.local)
+    else:
+        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        s3 = s3_client()
+    cur = conn.cursor()
+
+    slices = slice_count(cur, conn, default_slices)
+    if args.local:
+        loader = LocalLoader(cur, s3)
+        loader.create_tables()
+    else:
+        loader = RedshiftLoader(cur)
+    results = stage_tables(cur, conn, s3, loader, manifest_prefix, slices)
+    if args.local:
+        # read by the songplays insert, which advisor.py samples
+        loader.insert_plays()
+        conn.commit()
+    conn.close()
+
+    print_results(results)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
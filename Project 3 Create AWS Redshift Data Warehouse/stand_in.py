@@ -0,0 +1,49 @@
+import io
+import os
+
+
+class LocalS3:
+    """Stand-in for the boto3 S3 client calls of the staging step, backed by a local directory.
+
+    Each subdirectory of root is a bucket, and keys are paths relative to it,
+    so s3://udacity-dend/log_data/2018/11/a.json is root/udacity-dend/log_data/2018/11/a.json.
+
+    Parameters:
+    root (string): directory holding one subdirectory per bucket
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        """Return one page of the objects under a prefix in key order, like S3."""
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_dir).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = keys[start:start + MaxKeys]
+        response = {
+            'KeyCount': len(page),
+            'Contents': [{'Key': key, 'Size': os.path.getsize(os.path.join(bucket_dir, key))} for key in page],
+            'IsTruncated': start + MaxKeys < len(keys),
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_object(self, Bucket, Key):
+        with open(os.path.join(self.root, Bucket, Key), 'rb') as f:
+            return {'Body': io.BytesIO(f.read())}
+
+    def put_object(self, Bucket, Key, Body):
+        path = os.path.join(self.root, Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.encode())
+        return {}
@@ -0,0 +1,140 @@
+import re
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from psycopg2.pool import ThreadedConnectionPool
+from sql_queries import copy_table_queries, insert_table_queries
+import staging
+
+
+def load_tasks(copy_queries=copy_table_queries, insert_queries=insert_table_queries):
+    """Return the tasks of a full load, one per statement, named after the table it writes.
+
+    A statement depends on the tasks writing the tables it reads in its
+    FROM and JOIN clauses, so the tasks follow the statements of etl.py.
+
+    Parameters:
+    copy_queries (list): COPY statements of the staging tables
+    insert_queries (list): INSERT ... SELECT statements
+
+    Returns: dictionary of task name mapped to its statement and the names of the tasks it depends on
+
+    """
+    writes = {}
+    for query in copy_queries + insert_queries:
+        writes[re.match(r'\s*(?:COPY|INSERT INTO)\s+(\w+)', query).group(1)] = query
+
+    tasks = {}
+    for table, query in writes.items():
+        reads = re.findall(r'\b(?:FROM|JOIN)\s+(\w+)', query) if query.lstrip().startswith('INSERT') else []
+        tasks[table] = (query, sorted(set(reads) & set(writes) - {table}))
+    return tasks
+
+
+# task: (statement, tasks that must have finished before it starts)
+LOAD_TASKS = load_tasks()
+
+
+def check_tasks(tasks):
+    """Raise ValueError if a task depends on an unknown task or the dependencies form a cycle."""
+    for name, (query, dependencies) in tasks.items():
+        unknown = set(dependencies) - set(tasks)
+        if unknown:
+            raise ValueError('{} depends on unknown tasks {}'.format(name, sorted(unknown)))
+
+    done = set()
+    while len(done) < len(tasks):
+        ready = [name for name, (query, dependencies) in tasks.items()
+                 if name not in done and set(dependencies) <= done]
+        if not ready:
+            raise ValueError('dependency cycle between {}'.format(sorted(set(tasks) - done)))
+        done.update(ready)
+
+
+def run_task(pool, name, query, start):
+    """Run one statement in its own transaction on a pooled connection and return its trace entry.
+
+    stl_file_scan only tells the session that ran a COPY which query it
+    was, so COPY tasks read the files they loaded on the same connection.
+    """
+    conn = pool.getconn()
+    try:
+        begin = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(query)
+            rows = cur.rowcount
+            files = staging.scanned_files(cur) if query.lstrip().startswith('COPY') else []
+        conn.commit()
+        end = time.perf_counter()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+    return {
+        'task': name,
+        'thread': threading.current_thread().name,
+        'start': round(begin - start, 6),
+        'seconds': round(end - begin, 6),
+        'rows': rows,
+        'files': files,
+    }
+
+
+def run_tasks(dsn, tasks=LOAD_TASKS, workers=4):
+    """Run statements as soon as the tasks they depend on have finished.
+
+    Independent statements run in parallel, each on a connection of a
+    pool of at most workers connections; on Redshift, workers should not
+    exceed the slots of the WLM queue. After a failure no new tasks are
+    started, the running ones finish, and the error is raised.
+
+    Parameters:
+    dsn (string): connection string of the cluster
+    tasks (dict): task name mapped to its statement and the names of the tasks it depends on
+    workers (int): statements run at the same time
+
+    Returns: list of trace entries with thread, start and seconds relative to the start of the run, rows,
+    and (url, size) of the files COPY tasks loaded
+
+    """
+    check_tasks(tasks)
+    pool = ThreadedConnectionPool(1, workers, dsn)
+    trace = []
+    done = set()
+    running = {}
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(workers, thread_name_prefix='load') as executor:
+            while len(done) < len(tasks):
+                for name, (query, dependencies) in tasks.items():
+                    if name not in done and name not in running.values() and set(dependencies) <= done:
+                        running[executor.submit(run_task, pool, name, query, start)] = name
+
+                finished, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    trace.append(future.result())
+                    done.add(name)
+    finally:
+        pool.closeall()
+    return trace
+
+
+def write_trace(trace, filepath):
+    """Write a trace in the Trace Event Format, which chrome://tracing and Perfetto display as a timeline."""
+    events = [{'name': entry['task'], 'ph': 'X', 'pid': 0, 'tid': entry['thread'],
+               'ts': entry['start'] * 1e6, 'dur': entry['seconds'] * 1e6, 'args': {'rows': entry['rows']}}
+              for entry in trace]
+    with open(filepath, 'w') as f:
+        json.dump({'traceEvents': events}, f, indent=2)
+
+
+def print_trace(trace):
+    """Print the trace entries in start order."""
+    for entry in sorted(trace, key=lambda entry: entry['start']):
+        print('{task:>15} {thread:>8} start {start:9.3f}s {seconds:9.3f}s {rows:>10} rows'.format(**entry))
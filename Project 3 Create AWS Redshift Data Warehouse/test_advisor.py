@@ -0,0 +1,86 @@
+import sql_queries
+from advisor import STAR_TABLES, analyze_query, parse_create, suggest_encodings, suggest_keys
+
+TABLE_COLUMNS = {}
+KEYS = {}
+for table, (create_variable, insert_variable) in STAR_TABLES.items():
+    name, columns, keys = parse_create(getattr(sql_queries, create_variable))
+    TABLE_COLUMNS[name] = [column[0] for column in columns]
+    KEYS[name] = keys
+
+
+def test_parse_create_reads_keys():
+    assert KEYS['songplays'] == {'diststyle': 'KEY', 'distkey': 'artist_id', 'sortkey': 'start_time'}
+    assert KEYS['users'] == {'diststyle': 'ALL', 'distkey': None, 'sortkey': 'user_id'}
+
+
+def test_analyze_query_resolves_aliases():
+    pattern = analyze_query("""SELECT s.title, a.name, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN songs s ON sp.song_id = s.song_id
+        JOIN artists a ON sp.artist_id = a.artist_id
+        WHERE sp.start_time BETWEEN '2018-11-01' AND '2018-11-30' AND a.name = 'x'
+        GROUP BY s.title, a.name""", TABLE_COLUMNS)
+
+    assert pattern['joins'] == [('songplays', 'song_id', 'songs', 'song_id'),
+                                ('songplays', 'artist_id', 'artists', 'artist_id')]
+    assert pattern['filters'] == [('songplays', 'start_time', 'range'), ('artists', 'name', 'equal')]
+    assert pattern['grouped'] == [('songs', 'title'), ('artists', 'name')]
+    assert pattern['columns']['songplays'] == {'song_id', 'artist_id', 'start_time'}
+
+
+def test_analyze_query_resolves_unqualified_columns_of_one_table():
+    pattern = analyze_query("SELECT hour FROM time WHERE year = 2018", TABLE_COLUMNS)
+
+    assert pattern['filters'] == [('time', 'year', 'equal')]
+    assert pattern['columns'] == {'time': {'hour', 'year'}}
+
+
+def tables(rows):
+    return {table: {'rows': rows.get(table, 10), 'columns': [], 'keys': KEYS[table]} for table in KEYS}
+
+
+def test_suggest_keys_copies_small_joined_tables_to_every_node():
+    patterns = [analyze_query("SELECT COUNT(*) FROM songplays sp JOIN users u ON sp.user_id = u.user_id "
+                              "WHERE sp.start_time > '2018-11-01'", TABLE_COLUMNS)]
+
+    keys = suggest_keys(tables({'songplays': 10 ** 7, 'users': 100}), patterns, all_threshold=1000)
+
+    assert keys['users'] == {'diststyle': 'ALL', 'distkey': None, 'sortkey': 'user_id'}
+    assert keys['songplays'] == {'diststyle': 'EVEN', 'distkey': None, 'sortkey': 'start_time'}
+    assert keys['time']['sortkey'] == 'start_time'
+
+
+def test_suggest_keys_distributes_large_joins_on_their_columns():
+    patterns = [analyze_query("SELECT COUNT(*) FROM songplays sp JOIN time t ON sp.start_time = t.start_time",
+                              TABLE_COLUMNS)] * 2 + \
+               [analyze_query("SELECT COUNT(*) FROM songplays sp JOIN artists a ON sp.artist_id = a.artist_id",
+                              TABLE_COLUMNS)]
+
+    keys = suggest_keys(tables({'songplays': 10 ** 7, 'time': 10 ** 6, 'artists': 10 ** 6}), patterns,
+                        all_threshold=1000)
+
+    assert keys['songplays']['distkey'] == 'start_time'
+    assert keys['time'] == {'diststyle': 'KEY', 'distkey': 'start_time', 'sortkey': 'start_time'}
+    assert keys['artists']['diststyle'] == 'EVEN'
+
+
+def test_suggest_encodings_keep_the_current_encoding_when_not_smaller():
+    columns = [('user_id', 'int', 'PRIMARY KEY'), ('level', 'text', 'NOT NULL')]
+    rows = [(i, 'free') for i in range(100)]
+
+    encodings = suggest_encodings(columns, rows, 'user_id', 'user_id', {'level': ('bytedict', -10)})
+
+    assert (encodings[0]['encoding'], encodings[0]['source']) == ('raw', 'current')
+    assert (encodings[1]['encoding'], encodings[1]['source']) == ('lzo', 'current')
+    assert encodings[1]['encoded_bytes'] == encodings[1]['default_bytes']
+
+
+def test_suggest_encodings_take_analyze_compression_reductions():
+    columns = [('user_id', 'int', 'PRIMARY KEY'), ('level', 'text', 'NOT NULL')]
+    rows = [(i, 'free') for i in range(100)]
+
+    encodings = suggest_encodings(columns, rows, 'user_id', 'user_id', {'level': ('runlength', 50)})
+
+    assert (encodings[1]['encoding'], encodings[1]['source']) == ('runlength', 'analyze')
+    assert encodings[1]['encoded_bytes'] == round(encodings[1]['default_bytes'] / 2, 2)
@@ -0,0 +1,103 @@
+import json
+from staging import balance_files, build_manifest, parse_s3_url, stage_tables, LocalLoader
+
+
+def test_balance_files_largest_first_to_least_loaded_slice():
+    objects = [('s3://b/a', 10), ('s3://b/b', 7), ('s3://b/c', 5), ('s3://b/d', 3), ('s3://b/e', 2)]
+
+    assignment = balance_files(objects, 2)
+
+    assert assignment == [[('s3://b/a', 10), ('s3://b/d', 3)],
+                          [('s3://b/b', 7), ('s3://b/c', 5), ('s3://b/e', 2)]]
+    assert sorted(sum(size for url, size in files) for files in assignment) == [13, 14]
+
+
+def test_balance_files_more_slices_than_files():
+    assignment = balance_files([('s3://b/a', 1)], 3)
+    assert assignment == [[('s3://b/a', 1)], [], []]
+
+
+def test_build_manifest_lists_files_in_rounds():
+    assignment = [[('s3://b/a', 10), ('s3://b/d', 3)], [('s3://b/b', 7), ('s3://b/c', 5), ('s3://b/e', 2)]]
+
+    manifest = build_manifest(assignment)
+
+    assert [entry['url'] for entry in manifest['entries']] == ['s3://b/a', 's3://b/b', 's3://b/d', 's3://b/c',
+                                                               's3://b/e']
+    assert manifest['entries'][0] == {'url': 's3://b/a', 'mandatory': True, 'meta': {'content_length': 10}}
+
+
+def test_parse_s3_url():
+    assert parse_s3_url('s3://udacity-dend/log_data/2018') == ('udacity-dend', 'log_data/2018')
+
+
+class FakeS3:
+    """In-memory S3 client with the calls staging.py makes."""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def list_objects_v2(self, Bucket, Prefix, **kwargs):
+        return {'Contents': [{'Key': key, 'Size': len(body)} for (bucket, key), body in sorted(self.objects.items())
+                             if bucket == Bucket and key.startswith(Prefix)]}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Bucket, Key] = Body
+
+
+class FakeLoader:
+    """Loader that reports every file of a manifest as scanned by slice 0."""
+
+    def copy(self, table, manifest_url, manifest, planned_slices):
+        return [{'slice': 0, 'file': entry['url'], 'lines': 1, 'bytes': entry['meta']['content_length'],
+                 'seconds': 0.0} for entry in manifest['entries']]
+
+
+class NoStatsLoader:
+    """Loader of a cluster that recorded no file scans."""
+
+    def copy(self, table, manifest_url, manifest, planned_slices):
+        return []
+
+
+class FakeConnection:
+    def commit(self):
+        pass
+
+
+def test_stage_tables_skips_loaded_files_and_measures_skew_from_scans():
+    s3 = FakeS3({('udacity-dend', 'log_data/2018/11/a.json'): b'{}\n' * 4,
+                 ('udacity-dend', 'log_data/2018/11/b.json'): b'{}\n' * 4,
+                 ('udacity-dend', 'song_data/A/a.json'): b'{}'})
+    loaded = {('staging_songs', 's3://udacity-dend/song_data/A/a.json')}
+
+    events, songs = stage_tables(None, FakeConnection(), s3, FakeLoader(), 's3://work/manifests', 2, loaded)
+
+    assert events['objects'] == [('s3://udacity-dend/log_data/2018/11/a.json', 12),
+                                 ('s3://udacity-dend/log_data/2018/11/b.json', 12)]
+    assert events['planned_skew'] == 1.0
+    assert events['skew'] == 2.0
+    manifest = json.loads(s3.objects['work', 'manifests/staging_events.manifest'])
+    assert len(manifest['entries']) == 2
+    assert songs['files'] == 0 and songs['manifest'] is None
+
+
+def test_stage_tables_without_file_scan_stats():
+    s3 = FakeS3({('udacity-dend', 'log_data/2018/11/a.json'): b'{}\n'})
+
+    events, songs = stage_tables(None, FakeConnection(), s3, NoStatsLoader(), 's3://work/manifests', 2)
+
+    assert (events['files'], events['skew'], events['planned_skew']) == (1, None, 2.0)
+
+
+def test_local_loader_converts_records():
+    columns = [('artist', 'text'), ('length', 'float8'), ('ts', 'timestamp'), ('userId', 'int')]
+    records = list(LocalLoader.records(b'{"artist": "A", "length": 1.5, "ts": 1541106106796, "userId": ""}\n'
+                                       b'{"artist": null, "ts": 0, "userId": 7} {"artist": 5}'))
+
+    rows = [LocalLoader.convert(record, ['artist', 'length', 'ts', 'userId'], columns) for record in records]
+
+    assert str(rows[0][2]) == '2018-11-01 21:01:46.796000'
+    assert rows[0][3] is None
+    assert rows[1] == [None, None, rows[1][2], 7]
+    assert rows[2][0] == '5'
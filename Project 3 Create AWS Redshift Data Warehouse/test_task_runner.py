@@ -0,0 +1,79 @@
+import pytest
+import etl
+import task_runner
+from task_runner import LOAD_TASKS, check_tasks, load_tasks
+
+
+def test_load_tasks_follow_the_tables_statements_read():
+    assert LOAD_TASKS['staging_events'][1] == []
+    assert LOAD_TASKS['staging_plays'][1] == ['staging_events']
+    assert LOAD_TASKS['songplays'][1] == ['song_keys', 'staging_plays']
+    assert LOAD_TASKS['users'][1] == ['staging_events']
+    check_tasks(LOAD_TASKS)
+
+
+def test_load_tasks_ignore_tables_no_statement_writes():
+    tasks = load_tasks(["COPY staging FROM 's3://b/k'"],
+                       ["INSERT INTO facts SELECT * FROM staging JOIN lookup ON staging.id = lookup.id"])
+
+    assert tasks['facts'][1] == ['staging']
+
+
+def test_check_tasks_rejects_unknown_dependencies():
+    with pytest.raises(ValueError, match='unknown'):
+        check_tasks({'a': ('SELECT 1', ['b'])})
+
+
+def test_check_tasks_rejects_cycles():
+    with pytest.raises(ValueError, match='cycle'):
+        check_tasks({'a': ('SELECT 1', ['b']), 'b': ('SELECT 1', ['a']), 'c': ('SELECT 1', [])})
+
+
+class FakeCursor:
+    rowcount = 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        self.query = query
+
+
+class FakePool:
+    """Pool of one connection whose cursor runs no statements."""
+
+    def getconn(self):
+        return self
+
+    def putconn(self, conn):
+        pass
+
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+
+def test_copy_tasks_report_the_files_they_loaded(monkeypatch):
+    monkeypatch.setattr(task_runner.staging, 'scanned_files', lambda cur: [('s3://b/a.json', 10)])
+
+    copy = task_runner.run_task(FakePool(), 'staging_songs', "COPY staging_songs FROM 's3://b/'", 0)
+    insert = task_runner.run_task(FakePool(), 'songs', 'INSERT INTO songs SELECT * FROM staging_songs', 0)
+
+    assert (copy['rows'], copy['files']) == (2, [('s3://b/a.json', 10)])
+    assert insert['files'] == []
+
+
+def test_parallel_loads_return_the_files_of_the_copy_tasks(monkeypatch):
+    trace = [{'task': task, 'thread': 'load_0', 'start': 0.0, 'seconds': 1.0, 'rows': 1, 'files': files}
+             for task, files in [('staging_events', [('s3://b/e.json', 5)]), ('users', []),
+                                 ('staging_songs', [('s3://b/a.json', 10), ('s3://b/b.json', 20)])]]
+    monkeypatch.setattr(task_runner, 'run_tasks', lambda dsn, tasks, workers: trace)
+
+    assert etl.run_load_tasks('dsn', 4) == [('staging_events', 's3://b/e.json', 5),
+                                            ('staging_songs', 's3://b/a.json', 10),
+                                            ('staging_songs', 's3://b/b.json', 20)]